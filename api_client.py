@@ -1,19 +1,118 @@
-import requests
 from bs4 import BeautifulSoup
+from clock import SYSTEM_CLOCK
+from command_queue import CommandQueue
+from csnet_transport import CSNetTransport
 from device import Device
+from event_bus import COMMAND_SENT
+from metrics import (
+    CSNET_FAILURES_TOTAL,
+    CSNET_READS_SHARED_TOTAL,
+    CSNET_REAUTH_TOTAL,
+    CSNET_REQUEST_SECONDS,
+    CSNET_RETRIES_TOTAL,
+)
+from resilience import CircuitBreaker, RetryPolicy
+from session_store import SessionStore
 import logging
 import json
+import threading
+from urllib.parse import urljoin
+
+
+class _Flight:
+    """Lecture /data/elements en cours, partagée par les appelants concurrents."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
 
 
 class ApiClient:
     BASE_URL = "https://www.csnetmanager.com"
+    CSRF_TOKEN_TTL = 1800  # Validité max du token CSRF en cache (secondes)
+    SESSION_STORE_PATH = "/data/csnet_session.json"
+    READ_CACHE_TTL = 2  # Réutilisation d'une lecture réussie de /data/elements (secondes)
 
-    def __init__(self, config):
+    def __init__(self, config, clock=None):
         self.logger = logging.getLogger("Yutampo_ha_addon")
-        self.session = requests.Session()
+        self.clock = clock or SYSTEM_CLOCK
+        # Surchargeable pour viser une doublure locale (fake_csnet.py)
+        self.base_url = (config.get("csnet_base_url") or self.BASE_URL).rstrip("/")
+        self.transport = CSNetTransport()
         self.username = config["username"]
         self.password = config["password"]
         self.csrf_token = None
+        self.csrf_token_time = None
+        self.csrf_cache_hits = 0
+        self.csrf_cache_misses = 0
+        # Lectures concurrentes : une seule requête en vol, résultat gardé READ_CACHE_TTL
+        self.read_cache_ttl = self.READ_CACHE_TTL
+        self._read_lock = threading.Lock()
+        self._read_flight = None
+        self._read_cache = None
+        self._read_cache_time = None
+        self.read_count = 0
+        self.read_shared_count = 0
+        # Réauthentification sérialisée ; la génération change à chaque login réussi
+        self._auth_lock = threading.Lock()
+        self.session_generation = 0
+        self.command_queue = CommandQueue(self._post_heat_setting, clock=self.clock)
+        # Politique commune aux chemins de lecture (polling) et d'écriture (commandes)
+        self.retry_policy = RetryPolicy(clock=self.clock)
+        self.circuit_breaker = CircuitBreaker(
+            on_state_change=self._on_circuit_state_change, clock=self.clock
+        )
+        self.mqtt_handler = None
+        self.event_bus = None
+        self.session_store = SessionStore(
+            config.get("session_store_path") or self.SESSION_STORE_PATH,
+            clock=self.clock,
+        )
+
+    def restore_session(self):
+        """Réutilise la session persistée au dernier arrêt.
+
+        Un unique appel à /data/elements valide la session ; en cas d'échec,
+        la session est oubliée et l'appelant doit passer par authenticate().
+        """
+        stored = self.session_store.load()
+        if not stored:
+            self.logger.info("Aucune session CSNet persistée.")
+            return False
+
+        try:
+            self.transport.import_cookies(stored["cookies"], self.base_url)
+            with CSNET_REQUEST_SECONDS.time(endpoint="elements", method="GET"):
+                response = self.transport.get(f"{self.base_url}/data/elements")
+            data = self._handle_response(response, 1, 1)
+        except Exception as e:
+            self.logger.warning(f"Erreur lors de la validation de la session persistée : {str(e)}")
+            data = None
+
+        if data is None:
+            self.logger.info("Session CSNet persistée expirée, authentification requise.")
+            self.transport.clear_cookies()
+            self.session_store.clear()
+            return False
+
+        # La réponse de validation sert aussi au get_devices() qui suit
+        with self._read_lock:
+            self._read_cache = data
+            self._read_cache_time = self.clock.monotonic()
+
+        age = self.clock.timestamp() - stored.get("saved_at", 0)
+        if stored.get("csrf_token") and 0 <= age < self.CSRF_TOKEN_TTL:
+            self.csrf_token = stored["csrf_token"]
+            self.csrf_token_time = self.clock.monotonic() - age
+        self.logger.info("Session CSNet persistée restaurée, authentification évitée.")
+        return True
+
+    def save_session(self):
+        """Persiste les cookies et le token CSRF courants."""
+        try:
+            self.session_store.save(self.transport.export_cookies(), self.csrf_token)
+        except Exception as e:
+            self.logger.warning(f"Échec de la persistance de la session CSNet : {str(e)}")
 
     def authenticate(self):
         self.logger.info("Tentative d'authentification...")
@@ -28,15 +127,37 @@ class ApiClient:
             "password": self.password,
         }
 
-        response = self.session.post(f"{self.BASE_URL}/login", data=data)
+        try:
+            with CSNET_REQUEST_SECONDS.time(endpoint="login", method="POST"):
+                response = self.transport.post(f"{self.base_url}/login", data=data)
+        except Exception as e:
+            self.logger.error(f"Erreur lors de la requête d'authentification : {str(e)}")
+            return False
+        # Le token de la page de login n'est plus valable une fois la session ouverte
+        self._invalidate_csrf_token()
         if response.status_code == 200 or response.status_code == 302:
             self.logger.info("Authentification réussie.")
             if response.status_code == 302:
-                redirect_url = response.headers.get("Location", f"{self.BASE_URL}/")
-                response = self.session.get(redirect_url)
+                redirect_url = urljoin(
+                    f"{self.base_url}/", response.headers.get("Location", "/")
+                )
+                response = self.transport.get(redirect_url)
                 self.logger.debug(
-                    f"Cookies après redirection : {self.session.cookies.get_dict()}"
+                    f"Cookies après redirection : {self.transport.get_cookies()}"
                 )
+            # La page d'accueil authentifiée porte le token de la nouvelle session :
+            # la première commande n'a pas à recharger /login
+            token = (
+                self._extract_csrf_token(response.text)
+                if response.status_code == 200
+                else ""
+            )
+            if token:
+                self.csrf_token = token
+                self.csrf_token_time = self.clock.monotonic()
+                self.logger.debug("Token CSRF de la session récupéré après login.")
+            self.session_generation += 1
+            self.save_session()
             return True
         self.logger.error(
             f"Échec de l'authentification. Code HTTP: {response.status_code}"
@@ -45,7 +166,8 @@ class ApiClient:
 
     def _fetch_csrf_token(self):
         try:
-            login_page = self.session.get(f"{self.BASE_URL}/login")
+            with CSNET_REQUEST_SECONDS.time(endpoint="login", method="GET"):
+                login_page = self.transport.get(f"{self.base_url}/login")
             if login_page.status_code != 200:
                 self.logger.error(
                     f"Échec récupération page login pour CSRF. Code: {login_page.status_code}"
@@ -54,7 +176,9 @@ class ApiClient:
             self.csrf_token = self._extract_csrf_token(login_page.text)
             if not self.csrf_token:
                 self.logger.error("Token CSRF non trouvé dans la page de login.")
+                self._invalidate_csrf_token()
                 return False
+            self.csrf_token_time = self.clock.monotonic()
             self.logger.debug(f"Nouveau token CSRF récupéré : {self.csrf_token}")
             return True
         except Exception as e:
@@ -63,15 +187,60 @@ class ApiClient:
             )
             return False
 
+    def _get_csrf_token(self):
+        """Retourne le token CSRF en cache, ou en récupère un nouveau s'il est
+        absent ou expiré."""
+        if (
+            self.csrf_token
+            and self.csrf_token_time is not None
+            and self.clock.monotonic() - self.csrf_token_time < self.CSRF_TOKEN_TTL
+        ):
+            self.csrf_cache_hits += 1
+            self.logger.debug(
+                f"Token CSRF réutilisé depuis le cache (hits={self.csrf_cache_hits}, misses={self.csrf_cache_misses})"
+            )
+            return True
+        self.csrf_cache_misses += 1
+        self.logger.debug(
+            f"Token CSRF absent ou expiré, récupération (hits={self.csrf_cache_hits}, misses={self.csrf_cache_misses})"
+        )
+        return self._fetch_csrf_token()
+
+    def _on_circuit_state_change(self, state):
+        if self.mqtt_handler:
+            self.mqtt_handler.publish_circuit_state(state)
+
+    def _invalidate_csrf_token(self):
+        self.csrf_token = None
+        self.csrf_token_time = None
+
+    def get_csrf_cache_stats(self):
+        """Retourne les compteurs du cache de token CSRF."""
+        return {"hits": self.csrf_cache_hits, "misses": self.csrf_cache_misses}
+
     def _extract_csrf_token(self, html):
         soup = BeautifulSoup(html, "html.parser")
         token = soup.find("input", {"name": "_csrf"})
-        return token["value"] if token else ""
+        if token:
+            return token.get("value", "")
+        meta = soup.find("meta", {"name": "_csrf"})
+        return meta.get("content", "") if meta else ""
 
-    def _reset_session_and_authenticate(self):
-        self.logger.debug("Renouvellement de la session et réauthentification...")
-        self.session = requests.Session()
-        return self.authenticate()
+    def _reset_session_and_authenticate(self, generation):
+        """Réauthentifie si la session rejetée (`generation`, relevée avant la
+        requête) est toujours la session courante. Les appelants concurrents
+        attendent le login en cours et réutilisent la nouvelle session."""
+        with self._auth_lock:
+            if self.session_generation != generation:
+                self.logger.debug("Session déjà renouvelée par un autre appel, réutilisation.")
+                CSNET_REAUTH_TOTAL.inc(result="shared")
+                return True
+            self.logger.debug("Renouvellement de la session et réauthentification...")
+            self.transport.clear_cookies()
+            self._invalidate_csrf_token()
+            success = self.authenticate()
+            CSNET_REAUTH_TOTAL.inc(result="success" if success else "failure")
+            return success
 
     def _handle_response(self, response, attempt, max_retries):
         if response.status_code != 200:
@@ -104,55 +273,159 @@ class ApiClient:
         raw_data = self.get_raw_data()
         if not raw_data or "data" not in raw_data or "elements" not in raw_data["data"]:
             return None
-        return [
-            Device(str(element["deviceId"]), element["deviceName"], element["parentId"])
-            for element in raw_data["data"]["elements"]
-        ]
-
-    def get_raw_data(self, max_retries=3):
-        attempt = 0
-        while attempt < max_retries:
-            attempt += 1
+        devices = []
+        for element in raw_data["data"]["elements"]:
+            device = Device(str(element["deviceId"]), element["deviceName"], element["parentId"])
+            # L'élément contient déjà l'état : publié dès la discovery, sans attendre le premier poll
+            device.load_state(element)
+            devices.append(device)
+        return devices
+
+    def get_raw_data(self, max_retries=None):
+        """État des appareils (/data/elements). Les appels simultanés partagent la
+        requête en vol ; une lecture réussie est réutilisée pendant read_cache_ttl."""
+        with self._read_lock:
+            if (
+                self._read_cache is not None
+                and self.clock.monotonic() - self._read_cache_time < self.read_cache_ttl
+            ):
+                self.read_shared_count += 1
+                CSNET_READS_SHARED_TOTAL.inc(source="cache")
+                return self._read_cache
+            flight = self._read_flight
+            leader = flight is None
+            if leader:
+                flight = self._read_flight = _Flight()
+
+        if not leader:
+            self.logger.debug("Lecture /data/elements déjà en cours, attente de son résultat.")
+            self.read_shared_count += 1
+            CSNET_READS_SHARED_TOTAL.inc(source="in_flight")
+            flight.done.wait()
+            return flight.result
+
+        try:
+            flight.result = self._fetch_raw_data(max_retries)
+        finally:
+            with self._read_lock:
+                self.read_count += 1
+                if flight.result is not None:
+                    self._read_cache = flight.result
+                    self._read_cache_time = self.clock.monotonic()
+                self._read_flight = None
+            flight.done.set()
+        return flight.result
+
+    def _invalidate_read_cache(self):
+        with self._read_lock:
+            self._read_cache = None
+            self._read_cache_time = None
+
+    def get_read_stats(self):
+        """Retourne les compteurs de lectures effectuées / partagées."""
+        return {"reads": self.read_count, "shared": self.read_shared_count}
+
+    def _fetch_raw_data(self, max_retries=None):
+        max_retries = max_retries or self.retry_policy.max_attempts
+        if not self.circuit_breaker.allow_request():
+            self.logger.warning(
+                "Disjoncteur CSNet ouvert : récupération de l'état ignorée."
+            )
+            CSNET_FAILURES_TOTAL.inc(operation="elements", reason="circuit_open")
+            return None
+
+        reauthenticated = False
+        for attempt in range(1, max_retries + 1):
             self.logger.debug(
                 f"Tentative {attempt}/{max_retries} : Récupération de l'état des appareils..."
             )
+            generation = self.session_generation
             try:
-                response = self.session.get(f"{self.BASE_URL}/data/elements")
+                with CSNET_REQUEST_SECONDS.time(endpoint="elements", method="GET"):
+                    response = self.transport.get(f"{self.base_url}/data/elements")
                 data = self._handle_response(response, attempt, max_retries)
-                if data is not None:
-                    return data
+            except Exception as e:
+                self.logger.error(f"Erreur lors de la requête API : {str(e)}")
+                data = None
+            if data is not None:
+                self.circuit_breaker.record_success()
+                return data
 
-                if not self._reset_session_and_authenticate():
-                    self.logger.error("Échec de la réauthentification.")
-                    if attempt == max_retries:
-                        return None
+            # Une seule réauthentification par appel : les échecs suivants
+            # relèvent du serveur, pas de la session.
+            if not reauthenticated:
+                reauthenticated = True
+                if self._reset_session_and_authenticate(generation):
                     continue
+                self.logger.error("Échec de la réauthentification.")
+            if attempt < max_retries:
+                CSNET_RETRIES_TOTAL.inc(operation="elements")
+                self.retry_policy.wait(attempt)
 
-                response = self.session.get(f"{self.BASE_URL}/data/elements")
-                data = self._handle_response(response, attempt, max_retries)
-                if data is not None:
-                    return data
-
-                if attempt == max_retries:
-                    self.logger.error("Échec après toutes les tentatives.")
-                    return None
-            except Exception as e:
-                self.logger.error(f"Erreur lors de la requête API : {str(e)}")
-                if not self._reset_session_and_authenticate():
-                    self.logger.error("Échec de la réauthentification après exception.")
-                    if attempt == max_retries:
-                        return None
-                continue
+        self.logger.error("Échec après toutes les tentatives.")
+        CSNET_FAILURES_TOTAL.inc(operation="elements", reason="exhausted")
+        self.circuit_breaker.record_failure()
         return None
 
     def set_heat_setting(self, indoor_id, run_stop_dhw=None, setting_temp_dhw=None):
+        """Envoie une commande via la file (fusion et suppression des no-op)."""
+        return self.command_queue.submit(
+            indoor_id, run_stop_dhw=run_stop_dhw, setting_temp_dhw=setting_temp_dhw
+        )
+
+    def confirm_device_state(self, indoor_id, run_stop_dhw=None, setting_temp_dhw=None):
+        """Informe la file de commandes de l'état réellement rapporté par l'appareil."""
+        self.command_queue.confirm_state(indoor_id, run_stop_dhw, setting_temp_dhw)
+
+    def get_command_stats(self):
+        """Retourne les compteurs de commandes envoyées / ignorées / fusionnées."""
+        return self.command_queue.get_stats()
+
+    def _post_heat_setting(self, indoor_id, run_stop_dhw=None, setting_temp_dhw=None):
+        """Envoie la commande à CSNet sous la protection du disjoncteur,
+        en réessayant les échecs transitoires selon la politique de retry."""
+        if not self.circuit_breaker.allow_request():
+            self.logger.warning("Disjoncteur CSNet ouvert : commande non envoyée.")
+            CSNET_FAILURES_TOTAL.inc(operation="heat_setting", reason="circuit_open")
+            return False
+
+        for attempt in range(1, self.retry_policy.max_attempts + 1):
+            result = self._send_heat_setting(indoor_id, run_stop_dhw, setting_temp_dhw)
+            if result is not None:
+                # Le serveur a répondu (commande acceptée ou refusée) : il est joignable
+                self.circuit_breaker.record_success()
+                if result:
+                    # Les lectures suivantes doivent refléter la commande
+                    self._invalidate_read_cache()
+                if result and self.event_bus:
+                    self.event_bus.publish(
+                        COMMAND_SENT,
+                        indoor_id=indoor_id,
+                        run_stop_dhw=run_stop_dhw,
+                        setting_temp_dhw=setting_temp_dhw,
+                    )
+                return result
+            if attempt < self.retry_policy.max_attempts:
+                CSNET_RETRIES_TOTAL.inc(operation="heat_setting")
+                self.retry_policy.wait(attempt)
+
+        CSNET_FAILURES_TOTAL.inc(operation="heat_setting", reason="exhausted")
+        self.circuit_breaker.record_failure()
+        return False
+
+    def _send_heat_setting(
+        self, indoor_id, run_stop_dhw=None, setting_temp_dhw=None, _retried=False
+    ):
+        """Retourne True/False si le serveur a accepté/refusé la commande,
+        None en cas d'échec transitoire (réseau, 5xx, session irrécupérable)."""
         self.logger.info(
             f"Modification de l'état/temp pour indoorId={indoor_id}, runStopDHW={run_stop_dhw}, settingTempDHW={setting_temp_dhw}"
         )
 
-        if not self._fetch_csrf_token():
+        generation = self.session_generation
+        if not self._get_csrf_token():
             self.logger.error("Échec récupération token CSRF avant POST.")
-            return False
+            return None
 
         payload = {
             "indoorId": str(indoor_id),
@@ -169,15 +442,17 @@ class ApiClient:
             "accept-language": "fr,fr-FR;q=0.8,en-US;q=0.5,en;q=0.3",
             "content-type": "application/x-www-form-urlencoded; charset=UTF-8",
             "x-requested-with": "XMLHttpRequest",
-            "origin": "https://www.csnetmanager.com",
+            "origin": self.base_url,
         }
 
         try:
-            response = self.session.post(
-                f"{self.BASE_URL}/data/indoor/heat_setting",
-                data=payload,
-                headers=headers,
-            )
+            with CSNET_REQUEST_SECONDS.time(endpoint="heat_setting", method="POST"):
+                response = self.transport.post(
+                    f"{self.base_url}/data/indoor/heat_setting",
+                    data=payload,
+                    headers=headers,
+                    allow_redirects=False,  # Un 302 signale une session/token expiré
+                )
             if response.status_code == 200:
                 try:
                     resp_json = response.json()
@@ -187,25 +462,38 @@ class ApiClient:
                     else:
                         self.logger.error(f"Réponse API non réussie : {resp_json}")
                         return False
-                except requests.exceptions.JSONDecodeError:
+                except json.JSONDecodeError:
+                    self._invalidate_csrf_token()
                     self.logger.error(f"Réponse non JSON : {response.text}")
                     return False
             elif response.status_code in (302, 403):
+                # Token ou session rejeté par le serveur : on invalide le cache
+                self._invalidate_csrf_token()
+                if _retried:
+                    self.logger.error(
+                        f"Erreur {response.status_code} persistante après réauthentification."
+                    )
+                    return False
                 self.logger.warning(
                     f"Erreur {response.status_code}, réauthentification requise..."
                 )
-                if self._reset_session_and_authenticate():
-                    return self.set_heat_setting(
-                        indoor_id, run_stop_dhw, setting_temp_dhw
+                if self._reset_session_and_authenticate(generation):
+                    return self._send_heat_setting(
+                        indoor_id, run_stop_dhw, setting_temp_dhw, _retried=True
                     )
                 else:
                     self.logger.error("Échec de la réauthentification.")
-                    return False
+                    return None
             else:
                 self.logger.error(
                     f"Échec mise à jour. Code: {response.status_code}, Réponse: {response.text}"
                 )
-                return False
+                return None if response.status_code >= 500 else False
         except Exception as e:
             self.logger.error(f"Erreur lors de l'envoi de la requête POST : {str(e)}")
-            return False
+            return None
+
+    def close(self):
+        """Persiste la session puis ferme le transport HTTP (pool de connexions et boucle asyncio)."""
+        self.save_session()
+        self.transport.close()
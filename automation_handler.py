@@ -1,10 +1,29 @@
-from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.triggers.date import DateTrigger
 from apscheduler.triggers.interval import IntervalTrigger
-from datetime import datetime, timedelta
+from clock import SYSTEM_CLOCK, remove_job
+from datetime import timedelta
+from event_bus import EventBus, FORECAST_UPDATED, OFF_PEAK_CHANGED, SETTINGS_CHANGED
+from metrics import AUTOMATION_TICK_SECONDS
+from off_peak_client import off_peak_at
+from optimistic_state import OptimisticState
+from setpoint_planner import SetpointPlanner
 import logging
+import threading
 
 
 class AutomationHandler:
+    """Régulation interne de la consigne ECS.
+
+    - Réévaluation pilotée par événements (HC/HP, prévisions, réglages HA),
+      regroupés sur DEBOUNCE_SECONDS pour n'envoyer qu'une seule commande.
+    - Tick de sécurité toutes les SAFETY_TICK_MINUTES pour suivre l'horloge
+      (courbe progressive, entrée/sortie de fenêtre) et rattraper un événement perdu.
+    """
+
+    DEBOUNCE_SECONDS = 5
+    SAFETY_TICK_MINUTES = 5
+    REEVALUATE_JOB_ID = "regulation_reevaluate"
+    TICK_JOB_ID = "regulation_tick"
 
     def __init__(
         self,
@@ -19,13 +38,25 @@ class AutomationHandler:
         off_peak_client=None,
         regulation_priority="off_peak",
         eco_ratio=0.5,
+        event_bus=None,
+        clock=None,
+        scheduler=None,
+        optimistic_state=None,
     ):
         self.logger = logging.getLogger("Yutampo_ha_addon")
         self.api_client = api_client
         self.mqtt_handler = mqtt_handler
         self.physical_device = physical_device
         self.weather_client = weather_client
-        self.scheduler = BackgroundScheduler()
+        self.clock = clock or SYSTEM_CLOCK
+        # Publication optimiste et confirmation des commandes (partagée avec MqttHandler)
+        self.optimistic_state = optimistic_state or OptimisticState(
+            api_client, mqtt_handler, clock=self.clock
+        )
+        # Ordonnanceur partagé fourni par l'addon, ou propre à ce composant
+        self._owns_scheduler = scheduler is None
+        self.scheduler = scheduler or self.clock.create_scheduler()
+        self._running = False
         self.setpoint = setpoint
         self.amplitude = amplitude
         self.heating_duration = heating_duration
@@ -37,10 +68,20 @@ class AutomationHandler:
         self.locked_hottest_hour = None
         self._in_heating_window = False
         self._last_target_level = None
+        self.planner = SetpointPlanner(
+            self._resolve_minute, on_rebuild=self._on_plan_rebuilt
+        )
+        self._automation_lock = threading.Lock()
+        self.reevaluation_count = 0
+        self.event_bus = event_bus or EventBus()
+        for event in (OFF_PEAK_CHANGED, FORECAST_UPDATED, SETTINGS_CHANGED):
+            self.event_bus.subscribe(event, self._on_input_changed)
 
     def start(self):
+        self._running = True
         self._schedule_automation()
-        self.scheduler.start()
+        if self._owns_scheduler:
+            self.scheduler.start()
         self.logger.info(
             f"Automation interne démarrée avec amplitude initiale : {self.amplitude if self.amplitude is not None else 'non définie (inactive)'}."
         )
@@ -48,10 +89,45 @@ class AutomationHandler:
     def _schedule_automation(self):
         self.scheduler.add_job(
             self._run_automation,
-            trigger=IntervalTrigger(minutes=5),
-            next_run_time=datetime.now() + timedelta(seconds=5),
+            trigger=IntervalTrigger(minutes=self.SAFETY_TICK_MINUTES),
+            next_run_time=self.clock.now() + timedelta(seconds=5),
+            id=self.TICK_JOB_ID,
+            replace_existing=True,
+        )
+
+    def shutdown(self):
+        self._running = False
+        remove_job(self.scheduler, self.TICK_JOB_ID)
+        remove_job(self.scheduler, self.REEVALUATE_JOB_ID)
+        if self._owns_scheduler and self.scheduler.running:
+            self.scheduler.shutdown()
+        self.logger.info("Automation interne arrêtée.")
+
+    def _on_input_changed(self, event, data):
+        """Une entrée de la régulation a changé : réévaluation après debounce.
+
+        Chaque nouvel événement repousse l'échéance, une rafale de changements
+        ne déclenche donc qu'une seule réévaluation.
+        """
+        if not self._running:
+            return
+        self.logger.debug(
+            f"Événement {event} reçu, réévaluation dans {self.DEBOUNCE_SECONDS}s."
+        )
+        self.scheduler.add_job(
+            self._reevaluate,
+            trigger=DateTrigger(
+                run_date=self.clock.now() + timedelta(seconds=self.DEBOUNCE_SECONDS)
+            ),
+            id=self.REEVALUATE_JOB_ID,
+            replace_existing=True,
         )
 
+    def _reevaluate(self):
+        self.reevaluation_count += 1
+        self.logger.info("Réévaluation de la régulation suite à un changement d'entrée.")
+        self._run_automation()
+
     def set_forced_setpoint(self, forced_setpoint):
         self.forced_setpoint = forced_setpoint
         self.logger.info(
@@ -74,16 +150,19 @@ class AutomationHandler:
         """Met à jour l'amplitude thermique dynamiquement (via input_number HA)."""
         self.amplitude = amplitude
         self.logger.info(f"Amplitude mise à jour dynamiquement : {amplitude}°C")
+        self.event_bus.publish(SETTINGS_CHANGED, amplitude=amplitude)
 
     def set_heating_duration(self, duration):
         """Met à jour la durée de chauffe dynamiquement (via input_number HA)."""
         self.heating_duration = duration
         self.logger.info(f"Durée de chauffe mise à jour dynamiquement : {duration}h")
+        self.event_bus.publish(SETTINGS_CHANGED, heating_duration=duration)
 
     def set_setpoint(self, setpoint):
         """Met à jour la consigne haute dynamiquement (via number HA)."""
         self.setpoint = setpoint
         self.logger.info(f"Consigne haute mise à jour dynamiquement : {setpoint}°C")
+        self.event_bus.publish(SETTINGS_CHANGED, setpoint=setpoint)
 
     def _apply_forced_setpoint(self):
         if self.physical_device.mode != "heat":
@@ -96,22 +175,13 @@ class AutomationHandler:
             self.logger.warning("Aucune consigne forcée définie, rien à appliquer.")
             return
 
-        success = self.api_client.set_heat_setting(
-            self.physical_device.parent_id,
-            run_stop_dhw=1,
-            setting_temp_dhw=self.forced_setpoint,
+        success = self.optimistic_state.apply(
+            self.physical_device,
+            "user",
+            mode="heat",
+            setting_temperature=self.forced_setpoint,
         )
         if success:
-            self.physical_device.setting_temperature = self.forced_setpoint
-            self.mqtt_handler.publish_state(
-                self.physical_device.id,
-                self.physical_device.setting_temperature,
-                self.physical_device.current_temperature,
-                self.physical_device.mode,
-                self.physical_device.action,
-                self.physical_device.operation_label,
-                source="user",
-            )
             self.logger.info(f"Consigne forcée appliquée : {self.forced_setpoint}°C")
         else:
             self.logger.error("Échec de l'application de la consigne forcée")
@@ -122,6 +192,11 @@ class AutomationHandler:
         return self.forced_setpoint is None
 
     def _run_automation(self):
+        # Tick de sécurité, réévaluation et reprise manuelle peuvent se chevaucher
+        with self._automation_lock, AUTOMATION_TICK_SECONDS.time():
+            self._run_automation_locked()
+
+    def _run_automation_locked(self):
         self.logger.debug("Exécution de l'automation interne...")
 
         if not self._can_run_automation():
@@ -178,28 +253,91 @@ class AutomationHandler:
             )
             return self.setpoint
 
-        in_weather_window = self._is_in_weather_window()
+        # Maintient le verrouillage de l'heure la plus chaude (entrée/sortie de fenêtre)
+        self._is_in_weather_window()
         is_off_peak = (
             self.off_peak_client.is_off_peak()
             if self.off_peak_client
             else None
         )
+        off_peak_schedule = (
+            self.off_peak_client.off_peak_schedule() if self.off_peak_client else ()
+        )
 
-        # Déterminer le niveau de consigne et le label
-        target_temp, level = self._resolve_target_level(
-            in_weather_window, is_off_peak
+        # Le plan n'est recalculé que si l'une de ses entrées a changé
+        plan = self.planner.get(
+            self._plan_key(self.locked_hottest_hour, is_off_peak, off_peak_schedule)
         )
+        target_temp, level = plan.lookup(self._get_current_hour())
+        self.mqtt_handler.publish_setpoint_plan(target_temp)
 
         # Publier le niveau si changement
         if level != self._last_target_level:
             self._last_target_level = level
             self.mqtt_handler.publish_target_level(level)
 
-        # Clamper aux limites hardware de l'appareil (30-55°C)
-        target_temp = max(30.0, min(55.0, target_temp))
         return target_temp
 
-    def _resolve_target_level(self, in_weather_window, is_off_peak):
+    def seconds_to_next_edge(self):
+        """Secondes avant le prochain changement de niveau du plan courant
+        (entrée/sortie de fenêtre), None si inconnu."""
+        plan = self.planner.plan
+        if plan is None or not self._running:
+            return None
+        now = self.clock.now()
+        minutes = plan.minutes_to_level_change(self._get_current_hour())
+        if minutes is None:
+            return None
+        return minutes * 60 - now.second
+
+    def _plan_key(self, hottest_hour, is_off_peak, off_peak_schedule=()):
+        """Entrées dont dépend le plan de consigne."""
+        return (
+            hottest_hour,
+            is_off_peak,
+            off_peak_schedule,
+            self._has_weather(),
+            self.setpoint,
+            self.amplitude,
+            self.heating_duration,
+            self.eco_ratio,
+            self.regulation_mode,
+            self.regulation_priority,
+        )
+
+    def _resolve_minute(
+        self, current_hour, hottest_hour, is_off_peak, off_peak_schedule, *settings
+    ):
+        """Consigne et niveau pour une minute du plan (settings : lus sur self).
+        Avec un calendrier HC/HP observé, l'état HC/HP suit ce calendrier ;
+        sinon l'état courant est supposé constant."""
+        if off_peak_schedule:
+            is_off_peak = off_peak_at(off_peak_schedule, int(round(current_hour * 60)))
+        start_hour, end_hour = self._get_heating_window(hottest_hour)
+        in_weather_window = self._is_within_heating_window(
+            current_hour, start_hour, end_hour
+        )
+        target_temp, level = self._resolve_target_level(
+            in_weather_window, is_off_peak, current_hour, hottest_hour
+        )
+        # Clamper aux limites hardware de l'appareil (30-55°C)
+        return max(30.0, min(55.0, target_temp)), level
+
+    def _on_plan_rebuilt(self, plan):
+        hottest_hour = plan.key[0]
+        start_hour, end_hour = self._get_heating_window(hottest_hour)
+        self._log_heating_info(hottest_hour, start_hour, end_hour)
+        now = self.clock.now()
+        temperature, _ = plan.lookup(now.hour + now.minute / 60.0)
+        attributes = plan.to_attributes(now)
+        if self.off_peak_client:
+            # "assumed" : HC/HP supposé constant, le plan peut se tromper à la prochaine bascule
+            attributes["off_peak_schedule"] = "observed" if plan.key[2] else "assumed"
+        self.mqtt_handler.publish_setpoint_plan(temperature, attributes)
+
+    def _resolve_target_level(
+        self, in_weather_window, is_off_peak, current_hour, hottest_hour
+    ):
         """Résout la consigne et le label du niveau actif.
 
         Returns:
@@ -212,7 +350,7 @@ class AutomationHandler:
         # Cas dégradé : pas de HC configuré → comportement météo existant
         if is_off_peak is None:
             if in_weather_window:
-                return self._apply_weather_mode_in_window(), "max"
+                return self._apply_weather_mode_in_window(current_hour, hottest_hour), "max"
             return temp_min, "min"
 
         # Cas dégradé : pas de météo → HC/HP simple
@@ -231,18 +369,15 @@ class AutomationHandler:
                 return temp_min, "min"
         else:  # weather
             if in_weather_window:
-                return self._apply_weather_mode_in_window(), "max"
+                return self._apply_weather_mode_in_window(current_hour, hottest_hour), "max"
             elif is_off_peak:
                 return temp_eco, "eco"
             else:
                 return temp_min, "min"
 
-    def _apply_weather_mode_in_window(self):
+    def _apply_weather_mode_in_window(self, current_hour, hottest_hour):
         """Applique la logique existante (step/gradual) quand on est dans la plage météo."""
-        hottest_hour = self._get_locked_hottest_hour()
         start_hour, end_hour = self._get_heating_window(hottest_hour)
-        current_hour = self._get_current_hour()
-        self._log_heating_info(hottest_hour, start_hour, end_hour)
 
         if self.regulation_mode == "step":
             return self.setpoint
@@ -311,7 +446,7 @@ class AutomationHandler:
         return start_hour, end_hour
 
     def _get_current_hour(self):
-        current_time = datetime.now()
+        current_time = self.clock.now()
         return current_time.hour + current_time.minute / 60.0
 
     def _log_heating_info(self, hottest_hour, start_hour, end_hour):
@@ -345,6 +480,7 @@ class AutomationHandler:
             hottest_hour = (
                 hottest_hour + 24 if hottest_hour < start_hour else hottest_hour
             )
+            end_hour += 24  # Sinon la descente après le pic tombe à temp_min
 
         # Calcul linéaire de la progression
         if current_hour <= hottest_hour:
@@ -362,30 +498,13 @@ class AutomationHandler:
     def _apply_target_temperature(self, target_temp):
         self.logger.debug(f"Consigne calculée : {target_temp}°C")
         if self.physical_device.mode == "heat":
-            self.mqtt_handler.publish_state(
-                self.physical_device.id,
-                target_temp,
-                self.physical_device.current_temperature,
-                self.physical_device.mode,
-                self.physical_device.action,
-                self.physical_device.operation_label,
-                source="automation",
-            )
-            if self.api_client.set_heat_setting(
-                self.physical_device.parent_id,
-                run_stop_dhw=1,
-                setting_temp_dhw=target_temp,
+            # Publiée tout de suite en attente de confirmation, annulée si refusée
+            if self.optimistic_state.apply(
+                self.physical_device,
+                "automation",
+                mode="heat",
+                setting_temperature=target_temp,
             ):
-                self.physical_device.setting_temperature = target_temp
-                self.mqtt_handler.publish_state(
-                    self.physical_device.id,
-                    self.physical_device.setting_temperature,
-                    self.physical_device.current_temperature,
-                    self.physical_device.mode,
-                    self.physical_device.action,
-                    self.physical_device.operation_label,
-                    source="automation",
-                )
                 self.logger.info(
                     f"Changement de consigne automatique : {target_temp}°C appliqué"
                 )
@@ -394,24 +513,14 @@ class AutomationHandler:
 
     def set_mode(self, mode):  # Ajout pour gérer les changements de mode
         if mode == "off":
-            self.api_client.set_heat_setting(
-                self.physical_device.parent_id, run_stop_dhw=0, setting_temp_dhw=None
-            )
+            self.optimistic_state.apply(self.physical_device, "user", mode="off")
             self.logger.info(f"Changement de mode par l'utilisateur : heat -> off")
         elif mode == "heat":
-            self.api_client.set_heat_setting(
-                self.physical_device.parent_id,
-                run_stop_dhw=1,
-                setting_temp_dhw=self.physical_device.setting_temperature,
+            self.optimistic_state.apply(
+                self.physical_device,
+                "user",
+                mode="heat",
+                setting_temperature=self.physical_device.setting_temperature,
             )
             self.logger.info(f"Changement de mode par l'utilisateur : off -> heat")
             self.reset_forced_setpoint()  # Forcer la reprise de la régulation
-        self.mqtt_handler.publish_state(
-            self.physical_device.id,
-            self.physical_device.setting_temperature,
-            self.physical_device.current_temperature,
-            mode,
-            self.physical_device.action,
-            self.physical_device.operation_label,
-            source="user",
-        )
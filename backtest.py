@@ -0,0 +1,366 @@
+# backtest.py — Rejeu hors ligne des stratégies de régulation sur un historique
+# Dépendances : numpy (optionnel, uniquement pour ce module), csv, datetime
+#
+# Usage :
+#   python backtest.py --forecast forecast.csv --tank tank.csv \
+#       --off-peak 22:00-06:00 --setpoint 50 --duration 6 \
+#       --amplitudes 4,6,8,10 --eco-ratios 0.3,0.5,0.7
+
+import argparse
+import csv
+import logging
+import time
+from datetime import datetime
+from itertools import product
+
+try:
+    import numpy as np
+except ImportError:  # Dépendance optionnelle : l'addon lui-même n'en a pas besoin
+    np = None
+
+LEVEL_MIN, LEVEL_ECO, LEVEL_MAX = 0, 1, 2
+LEVEL_LABELS = ("min", "eco", "max")
+
+TIME_COLUMNS = ("last_changed", "datetime", "time")
+VALUE_COLUMNS = ("state", "temperature", "value")
+
+
+def _require_numpy():
+    if np is None:
+        raise RuntimeError(
+            "Le backtest nécessite numpy (pip install numpy), non requis par l'addon."
+        )
+
+
+def _to_local_naive(raw):
+    dt = datetime.fromisoformat(raw.replace("Z", "+00:00"))
+    if dt.tzinfo is not None:
+        dt = dt.astimezone().replace(tzinfo=None)
+    return dt
+
+
+def load_series(path):
+    """Lit un CSV horodaté (export d'historique HA ou `datetime,temperature`).
+
+    Retourne une liste triée de (datetime locale naïve, valeur brute) ;
+    les lignes `unavailable`/`unknown` sont ignorées.
+    """
+    with open(path, newline="") as f:
+        reader = csv.DictReader(f)
+        time_col = next((c for c in TIME_COLUMNS if c in reader.fieldnames), None)
+        value_col = next((c for c in VALUE_COLUMNS if c in reader.fieldnames), None)
+        if time_col is None or value_col is None:
+            raise ValueError(
+                f"{path} : colonnes attendues {TIME_COLUMNS} et {VALUE_COLUMNS}"
+            )
+        rows = [
+            (_to_local_naive(row[time_col]), row[value_col].strip())
+            for row in reader
+            if row[value_col].strip() not in ("", "unavailable", "unknown")
+        ]
+    rows.sort(key=lambda r: r[0])
+    return rows
+
+
+def parse_off_peak_ranges(spec):
+    """`22:00-06:00,12:30-14:00` -> [(22.0, 6.0), (12.5, 14.0)] en heures décimales."""
+    ranges = []
+    for item in spec.split(","):
+        start, end = item.strip().split("-")
+        ranges.append(tuple(int(h) + int(m) / 60.0 for h, m in (
+            start.split(":"), end.split(":")
+        )))
+    return ranges
+
+
+class BacktestInputs:
+    """Historique ramené sur une grille à la minute (heure locale).
+
+    - hour : heure décimale de chaque minute (même calcul que _get_current_hour).
+    - hottest_hour : heure la plus chaude de la journée selon les prévisions
+      (première heure en cas d'égalité, comme ForecastCurve).
+    - is_off_peak : booléens HC/HP, ou None sans signal HC/HP.
+    - tank : température ECS observée (maintien de la dernière valeur).
+    - outdoor : température extérieure prévue (maintien de la valeur horaire).
+    """
+
+    def __init__(self, start, minutes, hottest_hour, is_off_peak, tank, outdoor):
+        _require_numpy()
+        self.start = start
+        self.minutes = minutes
+        index = np.arange(minutes)
+        self.hour = (index // 60) % 24 + (index % 60) / 60.0
+        self.hottest_hour = hottest_hour
+        self.is_off_peak = is_off_peak
+        self.tank = tank
+        self.outdoor = outdoor
+
+    @classmethod
+    def from_history(
+        cls,
+        forecast,
+        tank=None,
+        off_peak=None,
+        off_peak_ranges=None,
+        default_hottest_hour=15.0,
+    ):
+        """Construit la grille couvrant les jours complets de la prévision.
+
+        forecast, tank, off_peak : listes (datetime, valeur) issues de load_series ;
+        off_peak_ranges : alternative à off_peak, plages fixes parse_off_peak_ranges.
+        """
+        _require_numpy()
+        start = forecast[0][0].replace(hour=0, minute=0, second=0, microsecond=0)
+        days = (forecast[-1][0] - start).days + 1
+        minutes = days * 1440
+
+        outdoor = _step_hold(start, minutes, [(t, float(v)) for t, v in forecast])
+        hottest_hour = _daily_hottest_hour(start, days, forecast, default_hottest_hour)
+
+        is_off_peak = None
+        if off_peak is not None:
+            is_off_peak = _step_hold(
+                start, minutes, [(t, 1.0 if v == "on" else 0.0) for t, v in off_peak]
+            ) > 0.5
+        elif off_peak_ranges:
+            hour = (np.arange(minutes) // 60) % 24 + (np.arange(minutes) % 60) / 60.0
+            is_off_peak = np.zeros(minutes, dtype=bool)
+            for range_start, range_end in off_peak_ranges:
+                is_off_peak |= _within(hour, range_start, range_end)
+
+        tank_series = (
+            _step_hold(start, minutes, [(t, float(v)) for t, v in tank])
+            if tank
+            else None
+        )
+        return cls(start, minutes, hottest_hour, is_off_peak, tank_series, outdoor)
+
+
+def _step_hold(start, minutes, series):
+    """Valeur en vigueur à chaque minute (dernier point connu, NaN avant le premier)."""
+    offsets = np.array(
+        [(t - start).total_seconds() // 60 for t, _ in series], dtype=np.int64
+    )
+    values = np.array([v for _, v in series], dtype=float)
+    idx = np.searchsorted(offsets, np.arange(minutes), side="right") - 1
+    result = np.where(idx >= 0, values[np.clip(idx, 0, None)], np.nan)
+    return result
+
+
+def _daily_hottest_hour(start, days, forecast, default_hottest_hour):
+    hottest = np.full(days, float(default_hottest_hour))
+    best = np.full(days, -np.inf)
+    for t, v in forecast:
+        day = (t - start).days
+        temp = float(v)
+        if 0 <= day < days and temp > best[day]:
+            best[day] = temp
+            hottest[day] = t.hour + t.minute / 60.0
+    return np.repeat(hottest, 1440)
+
+
+def _within(hour, start_hour, end_hour):
+    # Vectorisation de AutomationHandler._is_within_heating_window
+    return ((hour >= start_hour) & (hour < end_hour)) | (
+        (start_hour > end_hour) & ((hour >= start_hour) | (hour < end_hour))
+    )
+
+
+def resolve_targets(
+    inputs,
+    setpoint,
+    amplitude,
+    heating_duration,
+    regulation_mode="step",
+    regulation_priority="off_peak",
+    eco_ratio=0.5,
+    has_weather=True,
+):
+    """Consigne et niveau de chaque minute, identiques à AutomationHandler.
+
+    Reprend _get_heating_window, _is_within_heating_window,
+    _compute_temperature_during_heating et _resolve_target_level, puis le
+    clamp matériel 30-55°C. Retourne (consignes float, niveaux LEVEL_*).
+    """
+    _require_numpy()
+    hour = inputs.hour
+    hottest = inputs.hottest_hour
+    temp_max = float(setpoint)
+    temp_eco = setpoint - amplitude * eco_ratio
+    temp_min = setpoint - amplitude
+
+    # _get_heating_window
+    half = heating_duration / 2
+    start = hottest - half
+    end = hottest + half
+    start = np.where(start < 0, start + 24, start)
+    end = np.where(end >= 24, end - 24, end)
+    in_window = _within(hour, start, end)
+
+    # Température dans la plage : step ou courbe progressive
+    if regulation_mode == "step":
+        weather_temp = np.full(inputs.minutes, temp_max)
+    else:
+        wraps = start > end
+        current = np.where(wraps & (hour < end), hour + 24, hour)
+        peak = np.where(wraps & (hottest < start), hottest + 24, hottest)
+        window_end = np.where(wraps, end + 24, end)
+        progress = np.where(
+            current <= peak, (current - start) / half, (window_end - current) / half
+        )
+        progress = np.clip(progress, 0, 1)
+        weather_temp = np.round(temp_min + amplitude * progress, 1)
+
+    is_off_peak = inputs.is_off_peak
+    if is_off_peak is None:
+        # Pas de HC/HP : comportement météo seul
+        temps = np.where(in_window, weather_temp, temp_min)
+        levels = np.where(in_window, LEVEL_MAX, LEVEL_MIN)
+    elif not has_weather:
+        temps = np.where(is_off_peak, temp_max, temp_min)
+        levels = np.where(is_off_peak, LEVEL_MAX, LEVEL_MIN)
+    elif regulation_priority == "off_peak":
+        temps = np.select([is_off_peak, in_window], [temp_max, temp_eco], temp_min)
+        levels = np.select([is_off_peak, in_window], [LEVEL_MAX, LEVEL_ECO], LEVEL_MIN)
+    else:  # weather
+        temps = np.select([in_window, is_off_peak], [weather_temp, temp_eco], temp_min)
+        levels = np.select([in_window, is_off_peak], [LEVEL_MAX, LEVEL_ECO], LEVEL_MIN)
+
+    return np.clip(temps, 30.0, 55.0), levels.astype(np.int8)
+
+
+def score(inputs, temps, levels):
+    """Indicateurs comparatifs d'une stratégie (approximations, pas un modèle thermique).
+
+    - mean_setpoint : consigne moyenne (°C).
+    - level_share : part du temps passée à chaque niveau.
+    - demand_deg_h : besoin de chauffe, somme de (consigne - ECS observée)+ en °C·h.
+    - off_peak_demand_share : part de ce besoin placée en HC (si HC/HP connu).
+    - demand_outdoor_temp : température extérieure moyenne pondérée par le besoin
+      (plus elle est haute, meilleur est le COP de la pompe à chaleur).
+    - setpoint_changes : nombre de changements de consigne (commandes CSNet).
+    """
+    result = {
+        "mean_setpoint": round(float(temps.mean()), 2),
+        "level_share": {
+            label: round(float((levels == code).mean()), 3)
+            for code, label in enumerate(LEVEL_LABELS)
+        },
+        "setpoint_changes": int(np.count_nonzero(np.diff(temps))),
+    }
+    if inputs.tank is not None:
+        demand = np.nan_to_num(np.maximum(temps - inputs.tank, 0.0))
+        total = demand.sum()
+        result["demand_deg_h"] = round(float(total) / 60.0, 1)
+        if inputs.is_off_peak is not None:
+            result["off_peak_demand_share"] = (
+                round(float(demand[inputs.is_off_peak].sum() / total), 3) if total else None
+            )
+        outdoor = np.nan_to_num(inputs.outdoor)
+        result["demand_outdoor_temp"] = (
+            round(float((demand * outdoor).sum() / total), 2) if total else None
+        )
+    return result
+
+
+def sweep(
+    inputs,
+    setpoint,
+    heating_duration,
+    amplitudes,
+    eco_ratios,
+    modes=("step", "gradual"),
+    priorities=("off_peak", "weather"),
+    has_weather=True,
+):
+    """Évalue toutes les combinaisons mode × priorité × amplitude × eco_ratio."""
+    results = []
+    for mode, priority, amplitude, eco_ratio in product(
+        modes, priorities, amplitudes, eco_ratios
+    ):
+        temps, levels = resolve_targets(
+            inputs,
+            setpoint,
+            amplitude,
+            heating_duration,
+            regulation_mode=mode,
+            regulation_priority=priority,
+            eco_ratio=eco_ratio,
+            has_weather=has_weather,
+        )
+        results.append(
+            {
+                "regulation": mode,
+                "regulation_priority": priority,
+                "amplitude": amplitude,
+                "eco_ratio": eco_ratio,
+                **score(inputs, temps, levels),
+            }
+        )
+    return results
+
+
+def _format_table(results):
+    columns = [
+        "regulation",
+        "regulation_priority",
+        "amplitude",
+        "eco_ratio",
+        "mean_setpoint",
+        "demand_deg_h",
+        "off_peak_demand_share",
+        "demand_outdoor_temp",
+        "setpoint_changes",
+    ]
+    columns = [c for c in columns if any(c in r for r in results)]
+    lines = ["\t".join(columns)]
+    for r in results:
+        lines.append("\t".join(str(r.get(c, "")) for c in columns))
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Rejeu des stratégies de régulation Yutampo sur un historique."
+    )
+    parser.add_argument("--forecast", required=True, help="CSV des prévisions horaires")
+    parser.add_argument("--tank", help="CSV des températures ECS observées")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--off-peak-history", help="CSV d'historique du binary_sensor HC/HP")
+    group.add_argument("--off-peak", help="Plages HC fixes, ex. 22:00-06:00,12:00-14:00")
+    parser.add_argument("--setpoint", type=float, default=50.0)
+    parser.add_argument("--duration", type=float, default=6.0)
+    parser.add_argument("--amplitudes", default="4,6,8,10")
+    parser.add_argument("--eco-ratios", default="0.3,0.5,0.7")
+    parser.add_argument("--default-hottest-hour", type=float, default=15.0)
+    args = parser.parse_args(argv)
+
+    _require_numpy()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    logger = logging.getLogger("Yutampo_ha_addon")
+
+    inputs = BacktestInputs.from_history(
+        load_series(args.forecast),
+        tank=load_series(args.tank) if args.tank else None,
+        off_peak=load_series(args.off_peak_history) if args.off_peak_history else None,
+        off_peak_ranges=parse_off_peak_ranges(args.off_peak) if args.off_peak else None,
+        default_hottest_hour=args.default_hottest_hour,
+    )
+    started = time.perf_counter()
+    results = sweep(
+        inputs,
+        args.setpoint,
+        args.duration,
+        [float(a) for a in args.amplitudes.split(",")],
+        [float(r) for r in args.eco_ratios.split(",")],
+    )
+    elapsed = time.perf_counter() - started
+    logger.info(
+        f"{len(results)} configurations évaluées sur {inputs.minutes} minutes "
+        f"({inputs.minutes // 1440} jours) en {elapsed:.2f}s"
+    )
+    print(_format_table(results))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,308 @@
+# run.py — Benchmarks de bout en bout de l'addon contre des doublures locales
+# Dépendances : paho-mqtt, stand_ins.py (CSNet, broker MQTT, WebSocket HA)
+#
+# Usage :
+#   python benchmarks/run.py                    # compare à baseline.json, code 1 si régression
+#   python benchmarks/run.py --update-baseline  # réenregistre la référence (machine de référence)
+
+import argparse
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from yutampo_addon import YutampoAddon  # noqa: E402
+
+BASELINE_PATH = os.path.join(BENCH_DIR, "baseline.json")
+DEFAULT_TOLERANCE = 0.25  # Régression tolérée par défaut (25 %)
+PROBE_CLIENT_ID = "bench_probe"
+
+# Modèle thermique accéléré : l'état change à chaque poll, donc chaque cycle publie
+CSNET_OPTIONS = {"comm_interval": 0, "heating_rate": 200.0, "loss_rate": 100.0}
+
+
+class MqttProbe:
+    """Client MQTT de mesure : horodate la réception de chaque message yutampo/#."""
+
+    def __init__(self, port):
+        self.client = mqtt.Client(
+            mqtt.CallbackAPIVersion.VERSION2,
+            client_id=PROBE_CLIENT_ID,
+            protocol=mqtt.MQTTv311,
+        )
+        self.client.on_message = self._on_message
+        self._condition = threading.Condition()
+        self.messages = []  # (instant de réception, topic, payload)
+        self.client.connect("127.0.0.1", port)
+        self.client.subscribe("yutampo/#")
+        self.client.loop_start()
+
+    def _on_message(self, client, userdata, msg):
+        with self._condition:
+            self.messages.append((time.perf_counter(), msg.topic, msg.payload.decode()))
+            self._condition.notify_all()
+
+    def wait_for(self, predicate, after=0.0, timeout=90.0):
+        """Instant du premier message reçu après `after` qui satisfait predicate(topic, payload)."""
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while True:
+                for received, topic, payload in self.messages:
+                    if received >= after and predicate(topic, payload):
+                        return received
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError("Message attendu non reçu par la sonde MQTT")
+                self._condition.wait(remaining)
+
+    def count(self, predicate, after=0.0):
+        with self._condition:
+            return sum(
+                1 for received, topic, payload in self.messages
+                if received >= after and predicate(topic, payload)
+            )
+
+    def publish(self, topic, payload):
+        self.client.publish(topic, payload)
+
+    def stop(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+
+def _start_stand_ins():
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(BENCH_DIR, "stand_ins.py"), json.dumps(CSNET_OPTIONS)],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    return process, json.loads(process.stdout.readline())
+
+
+def _write_options(directory, endpoints):
+    options = {
+        "username": "sim",
+        "password": "sim",
+        "mqtt_host": "127.0.0.1",
+        "mqtt_port": str(endpoints["mqtt_port"]),
+        "mqtt_user": "bench",
+        "mqtt_password": "bench",
+        "ha_token": "bench",
+        "scan_interval": 60,
+        "setpoint": 50.0,
+        "regulation_amplitude": 8,
+        "regulation": "gradual",
+        "weather_entity": "weather.bench",
+        "off_peak_entity": "binary_sensor.bench_hc",
+        "log_level": "WARNING",
+        "csnet_base_url": endpoints["csnet_base_url"],
+        "ha_websocket_url": endpoints["ha_websocket_url"],
+        "session_store_path": os.path.join(directory, "session.json"),
+    }
+    path = os.path.join(directory, "options.json")
+    with open(path, "w") as f:
+        json.dump(options, f)
+    return path
+
+
+def _rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _addon_threads():
+    # La sonde MQTT n'appartient pas à l'addon
+    return sum(
+        1 for t in threading.enumerate() if PROBE_CLIENT_ID not in t.name
+    )
+
+
+def bench_startup(addon, probe, results):
+    started = time.perf_counter()
+    addon.start(block=False)
+    results["startup_ready_s"] = time.perf_counter() - started
+    first_state = probe.wait_for(
+        lambda topic, _: topic.startswith("yutampo/climate/") and topic.endswith("/state"),
+        after=started,
+        timeout=addon.config["scan_interval"] + 30,
+    )
+    results["startup_first_state_s"] = first_state - started
+
+
+def bench_steady_state(addon, results, settle=2.0):
+    # Le worker de l'ordonnanceur partagé ne démarre qu'au premier job exécuté :
+    # en faire passer un pour mesurer le régime établi, pas la fin du démarrage.
+    job_ran = threading.Event()
+    addon.job_scheduler.add_job(job_ran.set)
+    if not job_ran.wait(30):
+        raise TimeoutError("Aucun job exécuté par l'ordonnanceur de l'addon")
+    time.sleep(settle)
+    results["steady_rss_mb"] = _rss_mb()
+    results["steady_threads"] = _addon_threads()
+
+
+def bench_poll_throughput(addon, probe, results, cycles=200):
+    """Cycles complets CSNet -> _update_data -> update_state -> PUBLISH reçu par la sonde."""
+    device_id = addon.devices[0].id
+    # Chaque cycle doit faire sa requête CSNet, pas relire le cache court
+    addon.api_client.read_cache_ttl = 0
+
+    def is_state(topic, _):
+        return topic == f"yutampo/climate/{device_id}/state"
+
+    durations = []
+    started = time.perf_counter()
+    for _ in range(cycles):
+        cycle_start = time.perf_counter()
+        addon.scheduler._update_data()
+        durations.append(time.perf_counter() - cycle_start)
+    # Attendre la livraison de la dernière publication
+    addon.mqtt_handler.client.publish("yutampo/bench/marker", "end").wait_for_publish(10)
+    probe.wait_for(lambda topic, _: topic == "yutampo/bench/marker", after=started)
+    elapsed = time.perf_counter() - started
+    delivered = probe.count(is_state, after=started)
+    results["poll_cycles_per_s"] = cycles / elapsed
+    results["poll_cycle_p50_ms"] = statistics.median(durations) * 1000
+    results["poll_states_delivered_ratio"] = delivered / cycles
+
+
+def bench_command_latency(addon, probe, results, commands=5):
+    """Commande MQTT (consigne climate) -> set_heat_setting -> état confirmé publié."""
+    device_id = addon.devices[0].id
+    latencies = []
+    for i in range(commands):
+        temperature = 45 + (i % 2)
+        if addon.devices[0].setting_temperature == temperature:
+            temperature += 2
+        sent = time.perf_counter()
+        probe.publish(f"yutampo/climate/{device_id}/set", str(temperature))
+        confirmed = probe.wait_for(
+            lambda topic, payload: topic == f"yutampo/climate/{device_id}/temperature_state"
+            and float(payload) == temperature,
+            after=sent,
+            timeout=30,
+        )
+        latencies.append(confirmed - sent)
+    results["command_latency_p50_ms"] = statistics.median(latencies) * 1000
+    results["command_latency_max_ms"] = max(latencies) * 1000
+
+
+def bench_command_burst(addon, results, commands=4):
+    """Rafale de commandes concurrentes pour un même appareil : un seul POST
+    attendu (fusion dans la fenêtre de CommandQueue)."""
+    device = addon.devices[0]
+    barrier = threading.Barrier(commands)
+    sent_before = addon.api_client.get_command_stats()["sent"]
+
+    def submit(temperature):
+        barrier.wait()
+        addon.api_client.set_heat_setting(device.parent_id, setting_temp_dhw=temperature)
+
+    # Valeurs différentes de la consigne courante : aucune n'est un no-op
+    base = 40 if (device.setting_temperature or 0) >= 45 else 50
+    threads = [
+        threading.Thread(target=submit, args=(base + i,)) for i in range(commands)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+    results["command_burst_posts"] = (
+        addon.api_client.get_command_stats()["sent"] - sent_before
+    )
+
+
+def run_benchmarks():
+    stand_ins, endpoints = _start_stand_ins()
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="yutampo-bench-") as directory:
+        addon = YutampoAddon(config_path=_write_options(directory, endpoints))
+        probe = MqttProbe(endpoints["mqtt_port"])
+        try:
+            bench_startup(addon, probe, results)
+            bench_steady_state(addon, results)
+            bench_poll_throughput(addon, probe, results)
+            bench_command_latency(addon, probe, results)
+            bench_command_burst(addon, results)
+        finally:
+            addon.shutdown()
+            probe.stop()
+            stand_ins.stdin.close()
+            stand_ins.wait(timeout=10)
+    return {name: round(value, 3) for name, value in results.items()}
+
+
+def compare(results, baseline):
+    """Retourne la liste des régressions au-delà de la tolérance de chaque métrique."""
+    regressions = []
+    for name, reference in baseline.get("metrics", {}).items():
+        if name not in results:
+            continue
+        value = results[name]
+        tolerance = reference.get("tolerance", DEFAULT_TOLERANCE)
+        if reference["better"] == "lower":
+            limit = reference["value"] * (1 + tolerance)
+            failed = value > limit
+        else:
+            limit = reference["value"] * (1 - tolerance)
+            failed = value < limit
+        status = "RÉGRESSION" if failed else "ok"
+        print(f"{name:32} {value:>10} (référence {reference['value']}, limite {round(limit, 3)}) {status}")
+        if failed:
+            regressions.append(name)
+    return regressions
+
+
+def update_baseline(results, baseline):
+    metrics = baseline.setdefault("metrics", {})
+    for name, value in results.items():
+        entry = metrics.setdefault(name, {"better": "lower", "tolerance": DEFAULT_TOLERANCE})
+        entry["value"] = value
+    with open(BASELINE_PATH, "w") as f:
+        json.dump(baseline, f, indent=2, ensure_ascii=False)
+        f.write("\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks de bout en bout Yutampo.")
+    parser.add_argument("--update-baseline", action="store_true")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+
+    with open(BASELINE_PATH) as f:
+        baseline = json.load(f)
+    results = run_benchmarks()
+    print(json.dumps(results, indent=2))
+
+    if args.update_baseline:
+        update_baseline(results, baseline)
+        print(f"Référence mise à jour : {BASELINE_PATH}")
+        return 0
+    regressions = compare(results, baseline)
+    if regressions:
+        print(f"{len(regressions)} régression(s) : {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
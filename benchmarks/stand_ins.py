@@ -0,0 +1,218 @@
+# stand_ins.py — Doublures locales pour les benchmarks : CSNet, broker MQTT, WebSocket HA
+# Dépendances : aiohttp, asyncio, fake_csnet
+#
+# Lancé en sous-processus par benchmarks/run.py : affiche une ligne JSON avec les
+# URLs/ports d'écoute puis tourne jusqu'à la fermeture de son entrée standard.
+
+import asyncio
+import json
+import math
+import os
+import sys
+import threading
+from datetime import datetime
+
+from aiohttp import WSMsgType, web
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_csnet import FakeCSNet, FakeCSNetServer  # noqa: E402
+
+
+class MiniMqttBroker:
+    """Broker MQTT 3.1.1 minimal (asyncio) suffisant pour l'addon et la sonde.
+
+    CONNECT, PUBLISH QoS 0/1 (PUBACK), SUBSCRIBE avec jokers + et #, messages
+    retained, PINGREQ, DISCONNECT. Les messages sont relayés en QoS 0.
+    Pas de QoS 2, de sessions persistantes ni de last will.
+    """
+
+    def __init__(self):
+        self.retained = {}
+        self.clients = {}  # writer -> [filtres]
+        self.publish_count = 0
+        self.server = None
+
+    async def start(self, host="127.0.0.1", port=0):
+        self.server = await asyncio.start_server(self._handle_client, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    @staticmethod
+    def _matches(topic_filter, topic):
+        filter_parts = topic_filter.split("/")
+        topic_parts = topic.split("/")
+        for i, part in enumerate(filter_parts):
+            if part == "#":
+                return True
+            if i >= len(topic_parts) or (part != "+" and part != topic_parts[i]):
+                return False
+        return len(filter_parts) == len(topic_parts)
+
+    @staticmethod
+    def _encode_length(length):
+        encoded = bytearray()
+        while True:
+            byte, length = length % 128, length // 128
+            encoded.append(byte | 0x80 if length else byte)
+            if not length:
+                return bytes(encoded)
+
+    def _publish_packet(self, topic, payload, retain=False):
+        topic_bytes = topic.encode()
+        body = len(topic_bytes).to_bytes(2, "big") + topic_bytes + payload
+        return bytes([0x30 | (1 if retain else 0)]) + self._encode_length(len(body)) + body
+
+    async def _read_packet(self, reader):
+        header = await reader.readexactly(1)
+        multiplier, length = 1, 0
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length += (byte & 0x7F) * multiplier
+            if not byte & 0x80:
+                break
+            multiplier *= 128
+        return header[0], await reader.readexactly(length)
+
+    async def _handle_client(self, reader, writer):
+        self.clients[writer] = []
+        try:
+            while True:
+                header, body = await self._read_packet(reader)
+                packet_type = header >> 4
+                if packet_type == 1:  # CONNECT
+                    writer.write(b"\x20\x02\x00\x00")
+                elif packet_type == 3:  # PUBLISH
+                    qos = (header >> 1) & 0x03
+                    topic_length = int.from_bytes(body[:2], "big")
+                    topic = body[2 : 2 + topic_length].decode()
+                    offset = 2 + topic_length
+                    if qos:
+                        writer.write(b"\x40\x02" + body[offset : offset + 2])
+                        offset += 2
+                    self._route(topic, body[offset:], bool(header & 0x01))
+                elif packet_type == 8:  # SUBSCRIBE
+                    packet_id, offset, granted = body[:2], 2, bytearray()
+                    filters = []
+                    while offset < len(body):
+                        length = int.from_bytes(body[offset : offset + 2], "big")
+                        filters.append(body[offset + 2 : offset + 2 + length].decode())
+                        offset += 3 + length
+                        granted.append(0)
+                    self.clients[writer].extend(filters)
+                    writer.write(bytes([0x90, 2 + len(granted)]) + packet_id + bytes(granted))
+                    for topic, payload in self.retained.items():
+                        if any(self._matches(f, topic) for f in filters):
+                            writer.write(self._publish_packet(topic, payload, retain=True))
+                elif packet_type == 10:  # UNSUBSCRIBE
+                    writer.write(b"\xb0\x02" + body[:2])
+                elif packet_type == 12:  # PINGREQ
+                    writer.write(b"\xd0\x00")
+                elif packet_type == 14:  # DISCONNECT
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.clients.pop(writer, None)
+            writer.close()
+
+    def _route(self, topic, payload, retain):
+        self.publish_count += 1
+        if retain:
+            self.retained[topic] = payload
+        packet = self._publish_packet(topic, payload)
+        for writer, filters in list(self.clients.items()):
+            if any(self._matches(f, topic) for f in filters):
+                writer.write(packet)
+
+
+class MiniHaWebSocket:
+    """API WebSocket HA minimale : auth, subscribe_entities, weather/subscribe_forecast."""
+
+    def __init__(self, off_peak_entity, off_peak_state="off"):
+        self.states = {off_peak_entity: off_peak_state}
+        self.runner = None
+
+    async def start(self, host="127.0.0.1", port=0):
+        app = web.Application()
+        app.router.add_get("/core/websocket", self._handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        return site._server.sockets[0].getsockname()[1]
+
+    @staticmethod
+    def _forecast():
+        base = int(datetime.now().timestamp()) // 3600 * 3600
+        forecast = []
+        for i in range(48):
+            moment = datetime.fromtimestamp(base + i * 3600).astimezone()
+            temperature = 12 + 8 * math.cos((moment.hour - 15) / 24 * 2 * math.pi)
+            forecast.append({"datetime": moment.isoformat(), "temperature": round(temperature, 1)})
+        return forecast
+
+    async def _handle(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        await ws.send_json({"type": "auth_required"})
+        async for msg in ws:
+            if msg.type != WSMsgType.TEXT:
+                break
+            data = json.loads(msg.data)
+            msg_type, msg_id = data.get("type"), data.get("id")
+            if msg_type == "auth":
+                await ws.send_json({"type": "auth_ok"})
+                continue
+            await ws.send_json({"id": msg_id, "type": "result", "success": True, "result": None})
+            if msg_type == "subscribe_entities":
+                event = {
+                    "a": {
+                        entity: {"s": self.states[entity]}
+                        for entity in data.get("entity_ids", [])
+                        if entity in self.states
+                    }
+                }
+                await ws.send_json({"id": msg_id, "type": "event", "event": event})
+            elif msg_type == "weather/subscribe_forecast":
+                event = {"type": "hourly", "forecast": self._forecast()}
+                await ws.send_json({"id": msg_id, "type": "event", "event": event})
+        return ws
+
+
+async def _serve(csnet_options):
+    broker = MiniMqttBroker()
+    mqtt_port = await broker.start()
+    ha = MiniHaWebSocket(csnet_options.pop("off_peak_entity"))
+    ha_port = await ha.start()
+    csnet = FakeCSNetServer(FakeCSNet(**csnet_options)).start()
+    print(
+        json.dumps(
+            {
+                "csnet_base_url": csnet.base_url,
+                "mqtt_port": mqtt_port,
+                "ha_websocket_url": f"ws://127.0.0.1:{ha_port}/core/websocket",
+                "pid": os.getpid(),
+            }
+        ),
+        flush=True,
+    )
+    # S'arrête quand le processus parent ferme notre entrée standard
+    stdin_closed = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    threading.Thread(
+        target=lambda: (sys.stdin.read(), loop.call_soon_threadsafe(stdin_closed.set)),
+        daemon=True,
+    ).start()
+    await stdin_closed.wait()
+    csnet.stop()
+
+
+def main():
+    options = json.loads(sys.argv[1]) if len(sys.argv) > 1 else {}
+    options.setdefault("off_peak_entity", "binary_sensor.bench_hc")
+    asyncio.run(_serve(options))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+# clock.py — Horloge injectable (système ou virtuelle) et ordonnanceur associé
+# Dépendances : apscheduler, heapq, threading
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+from apscheduler.executors.pool import ThreadPoolExecutor
+from apscheduler.jobstores.base import JobLookupError
+from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.triggers.date import DateTrigger
+from apscheduler.triggers.interval import IntervalTrigger
+
+
+class Clock:
+    """Horloge système : toutes les lectures de l'heure passent par ici.
+
+    - now() : datetime locale naïve (comme datetime.now()).
+    - timestamp() / monotonic() / sleep() : équivalents de time.*.
+    - create_scheduler() : ordonnanceur APScheduler cadencé par cette horloge,
+      avec un pool borné à `max_workers` threads si précisé.
+    """
+
+    def now(self):
+        return datetime.now()
+
+    def timestamp(self):
+        return time.time()
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def create_scheduler(self, max_workers=None):
+        if max_workers:
+            return BackgroundScheduler(
+                executors={"default": ThreadPoolExecutor(max_workers)}
+            )
+        return BackgroundScheduler()
+
+
+SYSTEM_CLOCK = Clock()
+
+
+def remove_job(scheduler, job_id):
+    """Retire un job par id d'un ordonnanceur (partagé) s'il existe encore."""
+    try:
+        scheduler.remove_job(job_id)
+    except JobLookupError:
+        pass
+
+
+class VirtualClock(Clock):
+    """Horloge simulée, avancée explicitement par advance() / run_until().
+
+    - L'heure locale suit le fuseau du processus (variable TZ) : minuit et les
+      changements d'heure se produisent comme en production.
+    - sleep() avance l'heure sans bloquer ; les jobs planifiés ne s'exécutent
+      que dans advance(), dans l'ordre de leurs échéances, sur le thread appelant.
+    """
+
+    def __init__(self, start):
+        self.logger = logging.getLogger("Yutampo_ha_addon")
+        self._ts = start.timestamp()
+        self._lock = threading.RLock()
+        self._queue = []  # (échéance, séquence, job)
+        self._sequence = itertools.count()
+        self.executed_jobs = 0
+
+    def now(self):
+        return datetime.fromtimestamp(self._ts)
+
+    def timestamp(self):
+        return self._ts
+
+    def monotonic(self):
+        return self._ts
+
+    def sleep(self, seconds):
+        with self._lock:
+            self._ts += max(0.0, seconds)
+
+    def create_scheduler(self, max_workers=None):
+        return VirtualScheduler(self)
+
+    def advance(self, seconds):
+        self.run_until(self._ts + seconds)
+
+    def run_until(self, target):
+        """Exécute tous les jobs dus jusqu'à `target` (epoch s ou datetime)."""
+        if isinstance(target, datetime):
+            target = target.timestamp()
+        while True:
+            with self._lock:
+                if not self._queue or self._queue[0][0] > target:
+                    self._ts = max(self._ts, target)
+                    return
+                due, _, job = heapq.heappop(self._queue)
+                if job.cancelled:
+                    continue
+                self._ts = max(self._ts, due)
+            job.run()
+
+    def _push(self, due, job):
+        with self._lock:
+            heapq.heappush(self._queue, (due, next(self._sequence), job))
+
+
+class _VirtualJob:
+    def __init__(self, scheduler, func, interval, job_id):
+        self.scheduler = scheduler
+        self.func = func
+        self.interval = interval  # secondes, None pour un job ponctuel
+        self.id = job_id
+        self.cancelled = False
+
+    def run(self):
+        if not self.scheduler.running:
+            return
+        if self.interval is not None:
+            # Replanifié avant exécution, comme APScheduler
+            self.scheduler.clock._push(self.scheduler.clock.timestamp() + self.interval, self)
+        else:
+            self.scheduler._jobs.pop(self.id, None)
+        self.scheduler.clock.executed_jobs += 1
+        try:
+            self.func()
+        except Exception as e:
+            self.scheduler.clock.logger.error(
+                f"Erreur dans le job simulé {self.func.__name__} : {str(e)}"
+            )
+
+
+class VirtualScheduler:
+    """Sous-ensemble de l'API BackgroundScheduler utilisé par l'addon,
+    exécuté sur une VirtualClock (triggers interval et date)."""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.running = False
+        self._jobs = {}
+        self._ids = itertools.count(1)
+
+    def add_job(
+        self, func, trigger=None, next_run_time=None, id=None, replace_existing=False, **trigger_args
+    ):
+        interval, run_date = self._parse_trigger(trigger, trigger_args)
+        job_id = id or f"job-{next(self._ids)}"
+        if job_id in self._jobs:
+            if not replace_existing:
+                raise ValueError(f"Job {job_id} déjà planifié")
+            self._jobs[job_id].cancelled = True
+        job = _VirtualJob(self, func, interval, job_id)
+        self._jobs[job_id] = job
+        if next_run_time is not None:
+            due = next_run_time.timestamp()
+        elif run_date is not None:
+            due = run_date.timestamp()
+        else:
+            due = self.clock.timestamp() + interval
+        self.clock._push(due, job)
+        return job
+
+    @staticmethod
+    def _parse_trigger(trigger, trigger_args):
+        if isinstance(trigger, IntervalTrigger):
+            return trigger.interval.total_seconds(), None
+        if isinstance(trigger, DateTrigger):
+            return None, trigger.run_date
+        if trigger == "interval":
+            return timedelta(**trigger_args).total_seconds(), None
+        if trigger == "date":
+            return None, trigger_args["run_date"]
+        raise ValueError(f"Trigger non supporté par l'horloge virtuelle : {trigger}")
+
+    def remove_job(self, job_id):
+        job = self._jobs.pop(job_id, None)
+        if job is None:
+            raise JobLookupError(job_id)
+        job.cancelled = True
+
+    def remove_all_jobs(self):
+        for job in self._jobs.values():
+            job.cancelled = True
+        self._jobs.clear()
+
+    def start(self):
+        self.running = True
+
+    def shutdown(self, wait=True):
+        self.running = False
+        self.remove_all_jobs()
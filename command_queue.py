@@ -0,0 +1,155 @@
+# command_queue.py — File de commandes heat_setting par indoorId
+# Dépendances : threading, time
+
+import logging
+import threading
+
+from clock import SYSTEM_CLOCK
+
+
+class _PendingCommand:
+    """Commande en attente d'envoi pour un indoorId (fusion latest-wins)."""
+
+    def __init__(self):
+        self.fields = {}
+        self.done = threading.Event()
+        self.result = False
+
+    def merge(self, run_stop_dhw, setting_temp_dhw):
+        if run_stop_dhw is not None:
+            self.fields["runStopDHW"] = run_stop_dhw
+        if setting_temp_dhw is not None:
+            self.fields["settingTempDHW"] = setting_temp_dhw
+
+
+class CommandQueue:
+    """File de commandes placée devant l'envoi heat_setting.
+
+    - Les commandes d'un même indoorId arrivant pendant COALESCE_WINDOW sont
+      fusionnées (la dernière valeur de chaque champ l'emporte) et envoyées en un POST.
+    - Les POST d'un même indoorId sont sérialisés : une commande arrivée pendant
+      un envoi part après lui, avec la dernière valeur demandée.
+    - Une commande qui ne changerait rien à l'état confirmé de l'appareil
+      n'est pas envoyée (et est considérée comme réussie).
+    - Compteurs : commandes envoyées, supprimées (no-op) et fusionnées.
+    """
+
+    COALESCE_WINDOW = 1.0  # Fenêtre de fusion des commandes (secondes)
+
+    def __init__(self, sender, window=None, clock=None):
+        self.logger = logging.getLogger("Yutampo_ha_addon")
+        self.clock = clock or SYSTEM_CLOCK
+        self.sender = sender
+        self.window = self.COALESCE_WINDOW if window is None else window
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)  # Fin d'un envoi en cours
+        self._pending = {}
+        self._in_flight = set()  # indoorId dont un POST est en cours
+        self._confirmed = {}
+        self.sent_count = 0
+        self.suppressed_count = 0
+        self.coalesced_count = 0
+
+    def submit(self, indoor_id, run_stop_dhw=None, setting_temp_dhw=None):
+        """Soumet une commande et attend le résultat de l'envoi groupé."""
+        key = str(indoor_id)
+        with self._lock:
+            pending = self._pending.get(key)
+            leader = pending is None
+            if leader:
+                pending = _PendingCommand()
+                pending.merge(run_stop_dhw, setting_temp_dhw)
+                if key not in self._in_flight and self._is_noop(key, pending.fields):
+                    # Rien à fusionner ni à envoyer : inutile d'attendre la fenêtre
+                    self._suppress(key, pending.fields)
+                    return True
+                self._pending[key] = pending
+            else:
+                self.coalesced_count += 1
+                pending.merge(run_stop_dhw, setting_temp_dhw)
+
+        if not leader:
+            # Un autre appelant enverra la commande fusionnée
+            pending.done.wait()
+            return pending.result
+
+        # Le premier appelant attend la fin de la fenêtre puis envoie pour tous
+        if self.window > 0:
+            self.clock.sleep(self.window)
+        with self._lock:
+            # Un seul POST à la fois par indoorId : la commande reste ouverte à la
+            # fusion jusqu'à la fin de l'envoi en cours, la plus récente part en dernier
+            while key in self._in_flight:
+                self._idle.wait()
+            del self._pending[key]
+            self._in_flight.add(key)
+        try:
+            pending.result = self._flush(key, pending.fields)
+        finally:
+            with self._lock:
+                self._in_flight.discard(key)
+                self._idle.notify_all()
+            pending.done.set()
+        return pending.result
+
+    def _flush(self, key, fields):
+        with self._lock:
+            if self._is_noop(key, fields):
+                self._suppress(key, fields)
+                return True
+            self.sent_count += 1
+
+        success = self.sender(
+            key,
+            run_stop_dhw=fields.get("runStopDHW"),
+            setting_temp_dhw=fields.get("settingTempDHW"),
+        )
+        if success:
+            self.confirm_state(
+                key, fields.get("runStopDHW"), fields.get("settingTempDHW")
+            )
+        return success
+
+    def _suppress(self, key, fields):
+        # Appelé sous self._lock
+        self.suppressed_count += 1
+        self.logger.info(
+            f"Commande ignorée pour indoorId={key}, état déjà confirmé : {fields} "
+            f"(envoyées={self.sent_count}, ignorées={self.suppressed_count})"
+        )
+
+    def _is_noop(self, key, fields):
+        confirmed = self._confirmed.get(key, {})
+        for field, value in fields.items():
+            if field not in confirmed:
+                return False
+            if self._normalize(field, value) != confirmed[field]:
+                return False
+        return True
+
+    @staticmethod
+    def _normalize(field, value):
+        # L'API ne reçoit que des entiers (cf. ApiClient._post_heat_setting)
+        if field == "settingTempDHW":
+            return int(float(value))
+        return int(value)
+
+    def confirm_state(self, indoor_id, run_stop_dhw=None, setting_temp_dhw=None):
+        """Enregistre le dernier état connu de l'appareil (réponse API ou poll)."""
+        key = str(indoor_id)
+        with self._lock:
+            confirmed = self._confirmed.setdefault(key, {})
+            if run_stop_dhw is not None:
+                confirmed["runStopDHW"] = self._normalize("runStopDHW", run_stop_dhw)
+            if setting_temp_dhw is not None:
+                confirmed["settingTempDHW"] = self._normalize(
+                    "settingTempDHW", setting_temp_dhw
+                )
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "sent": self.sent_count,
+                "suppressed": self.suppressed_count,
+                "coalesced": self.coalesced_count,
+            }
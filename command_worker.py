@@ -0,0 +1,126 @@
+# command_worker.py — Traitement des commandes MQTT hors du thread réseau paho
+# Dépendances : collections, threading, clock
+
+import logging
+import threading
+from collections import OrderedDict
+
+from clock import SYSTEM_CLOCK
+
+
+class CommandWorker:
+    """File bornée de commandes MQTT traitée par un thread dédié.
+
+    - Le callback paho se contente d'appeler submit() : il ne bloque jamais sur CSNet.
+    - Les commandes sont traitées dans leur ordre d'arrivée (donc dans l'ordre par appareil).
+    - Latest-wins par topic : une commande encore en attente est remplacée par la
+      plus récente du même topic, sans perdre sa place dans la file.
+    - Métriques : profondeur de file, latence (réception → fin de traitement),
+      commandes traitées, remplacées et rejetées.
+    """
+
+    MAX_QUEUE_SIZE = 32
+
+    def __init__(self, handler, max_size=None, on_processed=None, clock=None):
+        self.logger = logging.getLogger("Yutampo_ha_addon")
+        self.clock = clock or SYSTEM_CLOCK
+        self.handler = handler
+        self.max_size = max_size or self.MAX_QUEUE_SIZE
+        self.on_processed = on_processed
+        self._queue = OrderedDict()  # topic -> (payload, received_at)
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopping = False
+        self.processed_count = 0
+        self.replaced_count = 0
+        self.dropped_count = 0
+        self.max_depth = 0
+        self.last_latency = None
+        self.max_latency = 0.0
+        self._total_latency = 0.0
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopping = False
+        self._thread = threading.Thread(
+            target=self._run, name="mqtt-commands", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def submit(self, topic, payload):
+        """Met une commande en file. Retourne False si elle a été rejetée (file pleine)."""
+        with self._condition:
+            if topic in self._queue:
+                self._queue[topic] = (payload, self.clock.monotonic())
+                self.replaced_count += 1
+                self.logger.debug(f"Commande en attente remplacée pour {topic}")
+            elif len(self._queue) >= self.max_size:
+                self.dropped_count += 1
+                self.logger.warning(
+                    f"File de commandes pleine ({self.max_size}), commande rejetée : {topic}"
+                )
+                return False
+            else:
+                self._queue[topic] = (payload, self.clock.monotonic())
+            self.max_depth = max(self.max_depth, len(self._queue))
+            self._condition.notify()
+        return True
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._queue and not self._stopping:
+                    self._condition.wait()
+                if self._stopping:
+                    return
+                topic, (payload, received_at) = self._queue.popitem(last=False)
+
+            try:
+                self.handler(topic, payload)
+            except Exception as e:
+                self.logger.error(
+                    f"Erreur lors du traitement de la commande {topic} : {str(e)}"
+                )
+
+            latency = self.clock.monotonic() - received_at
+            with self._condition:
+                self.processed_count += 1
+                self.last_latency = latency
+                self.max_latency = max(self.max_latency, latency)
+                self._total_latency += latency
+            self.logger.debug(
+                f"Commande {topic} traitée en {latency:.3f}s (file : {self.depth()})"
+            )
+            if self.on_processed:
+                self.on_processed(self.get_metrics())
+
+    def depth(self):
+        with self._condition:
+            return len(self._queue)
+
+    def get_metrics(self):
+        with self._condition:
+            return {
+                "depth": len(self._queue),
+                "max_depth": self.max_depth,
+                "processed": self.processed_count,
+                "replaced": self.replaced_count,
+                "dropped": self.dropped_count,
+                "last_latency": (
+                    round(self.last_latency, 3) if self.last_latency is not None else None
+                ),
+                "avg_latency": (
+                    round(self._total_latency / self.processed_count, 3)
+                    if self.processed_count
+                    else None
+                ),
+                "max_latency": round(self.max_latency, 3),
+            }
@@ -0,0 +1,186 @@
+# csnet_transport.py — Transport HTTP asynchrone (aiohttp) vers csnetmanager.com
+# Dépendances : aiohttp, asyncio, threading
+
+import asyncio
+import json
+import logging
+import threading
+from http.cookies import SimpleCookie
+
+import aiohttp
+from yarl import URL
+
+
+class TransportResponse:
+    """Réponse HTTP entièrement lue, exposant le sous-ensemble de
+    requests.Response utilisé par ApiClient (status_code, headers, text, json())."""
+
+    def __init__(self, status_code, headers, text, url):
+        self.status_code = status_code
+        self.headers = headers
+        self.text = text
+        self.url = url
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class CSNetTransport:
+    """Transport asyncio vers CSNet avec façade synchrone.
+
+    - Une boucle asyncio dédiée (un thread) porte une unique ClientSession aiohttp.
+    - Pool de connexions borné, keep-alive HTTP et réponses compressées (gzip/deflate).
+    - Timeout par requête (connexion + total).
+    - get()/post() sont thread-safe : les appels des différents threads
+      (scheduler, automation, MQTT) sont multiplexés sur la boucle du transport
+      au lieu de partager une requests.Session sans coordination.
+    """
+
+    POOL_SIZE = 4  # Connexions simultanées max vers CSNet
+    KEEPALIVE_TIMEOUT = 60  # Durée de conservation d'une connexion inactive (s)
+    CONNECT_TIMEOUT = 10  # Timeout d'établissement de connexion (s)
+    REQUEST_TIMEOUT = 30  # Timeout total par requête (s)
+
+    def __init__(self, pool_size=None, request_timeout=None):
+        self.logger = logging.getLogger("Yutampo_ha_addon")
+        self.pool_size = pool_size or self.POOL_SIZE
+        self.request_timeout = request_timeout or self.REQUEST_TIMEOUT
+        self._session = None
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._run_loop, name="csnet-transport", daemon=True
+        )
+        self._thread.start()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+
+    def _run(self, coro, timeout=None):
+        """Exécute une coroutine sur la boucle du transport et attend son résultat."""
+        future = asyncio.run_coroutine_threadsafe(coro, self._loop)
+        return future.result(timeout)
+
+    async def _get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size,
+                limit_per_host=self.pool_size,
+                keepalive_timeout=self.KEEPALIVE_TIMEOUT,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                # unsafe : accepte les cookies d'un hôte IP (doublure locale de CSNet)
+                cookie_jar=aiohttp.CookieJar(unsafe=True),
+                headers={"Accept-Encoding": "gzip, deflate"},
+                auto_decompress=True,
+            )
+            self.logger.debug(
+                f"Session aiohttp créée (pool={self.pool_size}, keep-alive={self.KEEPALIVE_TIMEOUT}s)"
+            )
+        return self._session
+
+    async def request_async(
+        self,
+        method,
+        url,
+        data=None,
+        headers=None,
+        allow_redirects=True,
+        timeout=None,
+    ):
+        session = await self._get_session()
+        request_timeout = aiohttp.ClientTimeout(
+            total=timeout or self.request_timeout, connect=self.CONNECT_TIMEOUT
+        )
+        async with session.request(
+            method,
+            url,
+            data=data,
+            headers=headers,
+            allow_redirects=allow_redirects,
+            timeout=request_timeout,
+        ) as response:
+            text = await response.text(errors="replace")
+            return TransportResponse(
+                response.status,
+                response.headers.copy(),
+                text,
+                str(response.url),
+            )
+
+    def request(self, method, url, timeout=None, **kwargs):
+        """Façade synchrone : bloque l'appelant jusqu'à la réponse ou au timeout."""
+        total = timeout or self.request_timeout
+        # Marge au-delà du timeout aiohttp pour ne pas couper une réponse en cours de lecture
+        return self._run(
+            self.request_async(method, url, timeout=total, **kwargs), total + 5
+        )
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        return self.request("POST", url, data=data, **kwargs)
+
+    def get_cookies(self):
+        """Retourne les cookies courants sous forme {nom: valeur}."""
+
+        async def _collect():
+            session = await self._get_session()
+            return {cookie.key: cookie.value for cookie in session.cookie_jar}
+
+        return self._run(_collect(), self.request_timeout)
+
+    def export_cookies(self):
+        """Retourne les cookies sous une forme sérialisable en JSON."""
+
+        async def _export():
+            session = await self._get_session()
+            return [
+                {
+                    "name": cookie.key,
+                    "value": cookie.value,
+                    "domain": cookie["domain"],
+                    "path": cookie["path"] or "/",
+                }
+                for cookie in session.cookie_jar
+            ]
+
+        return self._run(_export(), self.request_timeout)
+
+    def import_cookies(self, cookies, base_url):
+        """Recharge des cookies exportés par export_cookies()."""
+
+        async def _import():
+            session = await self._get_session()
+            for cookie in cookies:
+                jar = SimpleCookie()
+                jar[cookie["name"]] = cookie["value"]
+                jar[cookie["name"]]["path"] = cookie.get("path") or "/"
+                if cookie.get("domain"):
+                    jar[cookie["name"]]["domain"] = cookie["domain"]
+                session.cookie_jar.update_cookies(jar, response_url=URL(base_url))
+
+        self._run(_import(), self.request_timeout)
+
+    def clear_cookies(self):
+        """Oublie la session serveur en conservant le pool de connexions."""
+
+        async def _clear():
+            session = await self._get_session()
+            session.cookie_jar.clear()
+
+        self._run(_clear(), self.request_timeout)
+
+    def close(self):
+        async def _close():
+            if self._session is not None and not self._session.closed:
+                await self._session.close()
+
+        try:
+            self._run(_close(), self.request_timeout)
+        except Exception as e:
+            self.logger.warning(f"Erreur lors de la fermeture du transport CSNet : {str(e)}")
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=5)
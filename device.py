@@ -1,7 +1,51 @@
 import logging
 
 
+OPERATION_STATUS_MAP = {
+    0: "idle",
+    1: "idle",
+    2: "off",
+    3: "cooling",
+    4: "idle",
+    5: "off",
+    6: "heating",
+    7: "off",
+    8: "heating",
+    9: "off",
+    10: "heating",
+}
+
+OPERATION_LABEL_MAP = {
+    0: "Inactif",
+    1: "Froid - Pas de demande",
+    2: "Froid - Thermo OFF",
+    3: "Froid - En demande",
+    4: "Chaud - Pas de demande",
+    5: "Chaud - Thermo OFF",
+    6: "Chaud - En demande",
+    7: "ECS Arrêt",
+    8: "ECS Marche",
+    9: "Piscine Arrêt",
+    10: "Piscine Marche",
+}
+
+
 class Device:
+    __slots__ = (
+        "logger",
+        "id",
+        "name",
+        "parent_id",
+        "setting_temperature",
+        "current_temperature",
+        "mode",
+        "action",
+        "operation_status",
+        "operation_label",
+        "run_stop_dhw",
+        "_published",
+    )
+
     def __init__(self, id, name, parent_id):
         self.logger = logging.getLogger("Yutampo_ha_addon")
         self.id = id
@@ -14,11 +58,13 @@ class Device:
         self.operation_status = None
         self.operation_label = None
         self.run_stop_dhw = None
+        self._published = {}  # Dernière valeur publiée par champ d'état
 
     def register(self, mqtt_handler):
         mqtt_handler.publish_discovery(self)
 
-    def update_state(self, mqtt_handler, state_data):
+    def load_state(self, state_data):
+        """Charge l'état rapporté par CSNet (élément de /data/elements) sans le publier."""
         self.setting_temperature = state_data.get(
             "settingTemperature", self.setting_temperature
         )
@@ -28,35 +74,28 @@ class Device:
         self.operation_status = state_data.get("operationStatus", 0)
         self.run_stop_dhw = state_data.get("runStopDHW", "N/A")
         self.mode = "heat" if state_data.get("onOff") == 1 else "off"
+        self.action = OPERATION_STATUS_MAP.get(self.operation_status, "idle")
+        self.operation_label = OPERATION_LABEL_MAP.get(self.operation_status, "Inconnu")
 
-        operation_status_map = {
-            0: "idle",
-            1: "idle",
-            2: "off",
-            3: "cooling",
-            4: "idle",
-            5: "off",
-            6: "heating",
-            7: "off",
-            8: "heating",
-            9: "off",
-            10: "heating",
+    def update_state(self, mqtt_handler, state_data, pending=False):
+        self.load_state(state_data)
+        current = {
+            "temperature": self.setting_temperature,
+            "current_temperature": self.current_temperature,
+            "mode": self.mode,
+            "action": self.action,
+            "operation_label": self.operation_label,
+            # Seul l'état global le porte, mais sa bascule doit être publiée
+            "pending": pending,
         }
-        operation_label_map = {
-            0: "Inactif",
-            1: "Froid - Pas de demande",
-            2: "Froid - Thermo OFF",
-            3: "Froid - En demande",
-            4: "Chaud - Pas de demande",
-            5: "Chaud - Thermo OFF",
-            6: "Chaud - En demande",
-            7: "ECS Arrêt",
-            8: "ECS Marche",
-            9: "Piscine Arrêt",
-            10: "Piscine Marche",
+        changed = {
+            field
+            for field, value in current.items()
+            if field not in self._published or self._published[field] != value
         }
-        self.action = operation_status_map.get(self.operation_status, "idle")
-        self.operation_label = operation_label_map.get(self.operation_status, "Inconnu")
+        if not changed:
+            self.logger.debug(f"État inchangé pour {self.id}, aucune publication.")
+            return
 
         mqtt_handler.publish_state(
             self.id,
@@ -65,8 +104,14 @@ class Device:
             self.mode,
             self.action,
             self.operation_label,
+            fields=changed,
+            pending=pending,
         )
 
+    def mark_published(self, values):
+        """Enregistre les valeurs publiées sur MQTT, quelle que soit leur origine."""
+        self._published.update(values)
+
     def set_unavailable(self, mqtt_handler):
         mqtt_handler.publish_availability(self.id, "offline")
         mqtt_handler.publish_state(
@@ -0,0 +1,43 @@
+# event_bus.py — Bus d'événements interne entre les sources d'entrée et la régulation
+# Dépendances : threading
+
+import logging
+import threading
+
+# Événements publiés par les sources d'entrée
+OFF_PEAK_CHANGED = "off_peak_changed"  # OffPeakClient : bascule HC/HP
+FORECAST_UPDATED = "forecast_updated"  # WeatherClient : heure la plus chaude modifiée
+SETTINGS_CHANGED = "settings_changed"  # Réglages HA : amplitude, durée, consigne
+COMMAND_SENT = "command_sent"  # ApiClient : commande heat_setting acceptée par CSNet
+
+
+class EventBus:
+    """Publication/abonnement synchrone et minimal.
+
+    - Les callbacks sont appelés dans le thread de l'émetteur : ils doivent rester
+      courts (la régulation se contente de planifier une réévaluation).
+    - Une erreur dans un abonné est journalisée sans bloquer les autres.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger("Yutampo_ha_addon")
+        self._subscribers = {}  # événement -> [callbacks]
+        self._lock = threading.Lock()
+        self.published_count = 0
+
+    def subscribe(self, event, callback):
+        with self._lock:
+            self._subscribers.setdefault(event, []).append(callback)
+
+    def publish(self, event, **data):
+        with self._lock:
+            callbacks = list(self._subscribers.get(event, ()))
+            self.published_count += 1
+        self.logger.debug(f"Événement {event} publié : {data}")
+        for callback in callbacks:
+            try:
+                callback(event, data)
+            except Exception as e:
+                self.logger.error(
+                    f"Erreur dans un abonné à l'événement {event} : {str(e)}"
+                )
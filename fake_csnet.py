@@ -0,0 +1,377 @@
+# fake_csnet.py — Doublure locale de csnetmanager.com construite sur les paquets capturés
+# Dépendances : http.server, json, random, threading
+#
+# Usage :
+#   python fake_csnet.py --port 8765 --latency 0.2 --error-rate 0.05 --session-ttl 600
+#   puis "csnet_base_url": "http://127.0.0.1:8765" dans les options de l'addon.
+
+import argparse
+import copy
+import json
+import logging
+import os
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+from clock import SYSTEM_CLOCK
+
+PACKETS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "packets")
+
+
+def _load_packet(name):
+    with open(os.path.join(PACKETS_DIR, name)) as f:
+        return json.load(f)
+
+
+class FakeCSNet:
+    """CSNet simulé : login avec CSRF, /data/elements, heat_setting.
+
+    - Réponses construites à partir de packets/ (elements, heatSettings,
+      installationdevices), mises à jour avec l'état simulé.
+    - Le ballon suit un modèle thermique sommaire : chauffe jusqu'à la consigne
+      reçue, pertes le reste du temps, relance sous consigne - HYSTERESIS.
+    - L'appareil ne remonte son état que toutes les `comm_interval` secondes
+      (champ lastComm), avec le déphasage `comm_phase` (par défaut celui du
+      paquet capturé), comme l'unité réelle.
+    - Défauts injectables : `latency` (s, via l'horloge), `error_rate` (HTTP 500
+      aléatoires sur /data/*), `session_ttl` (s) après lequel la session expire :
+      302 vers /login, ou `expiry_status` (302/403) sur heat_setting ;
+      `reject_commands` : heat_setting répond `status: error` sans rien appliquer.
+    - `heating_rate` / `loss_rate` (°C/s) accélèrent le modèle thermique (benchmarks).
+    """
+
+    HEATING_RATE = 10.0 / 3600  # °C/s en chauffe
+    LOSS_RATE = 1.0 / 3600  # °C/s au repos (pertes et puisages moyens)
+    HYSTERESIS = 3.0  # Écart déclenchant une relance de chauffe (°C)
+
+    def __init__(
+        self,
+        clock=None,
+        username="sim",
+        password="sim",
+        latency=0.0,
+        error_rate=0.0,
+        session_ttl=None,
+        expiry_status=302,
+        comm_interval=60,
+        comm_phase=None,
+        reject_commands=False,
+        seed=None,
+        heating_rate=None,
+        loss_rate=None,
+    ):
+        self.logger = logging.getLogger("Yutampo_ha_addon")
+        self.clock = clock or SYSTEM_CLOCK
+        self.username = username
+        self.password = password
+        self.latency = latency
+        self.error_rate = error_rate
+        self.session_ttl = session_ttl
+        self.expiry_status = expiry_status
+        self.comm_interval = comm_interval
+        self.reject_commands = reject_commands
+        self.heating_rate = self.HEATING_RATE if heating_rate is None else heating_rate
+        self.loss_rate = self.LOSS_RATE if loss_rate is None else loss_rate
+        self._random = random.Random(seed)
+        self._lock = threading.RLock()
+
+        self._elements = _load_packet("elements.json")
+        self._heat_settings = _load_packet("heatSettings.json")
+        self._installation = _load_packet("installationdevices.json")
+        self.elements = self._elements["data"]["elements"]
+        if comm_phase is None and comm_interval:
+            captured = self._elements["data"]["device_status"][0]["lastComm"] / 1000
+            comm_phase = captured % comm_interval
+        self.comm_phase = comm_phase or 0
+        self._reported = copy.deepcopy(self.elements)  # État remonté au dernier lastComm
+        self._sessions = {}  # id de session -> {"csrf": token, "created": ts}
+        self._next_id = 1
+        self._heating = {}
+        self._temperatures = {}  # Température non arrondie (l'API n'expose que le dixième)
+        self._last_update = self.clock.timestamp()
+        self._last_comm = self._comm_time()
+
+        self.login_count = 0
+        self.elements_count = 0
+        self.error_count = 0
+        self.expired_count = 0
+        self.commands = []  # (datetime, champs reçus)
+        self.rejected_commands = []  # (datetime, champs reçus) refusés
+        self.polls = []  # datetime de chaque GET /data/elements
+
+    # --- Routage -------------------------------------------------------------
+
+    def handle(self, method, path, params, cookies):
+        """Traite une requête. Retourne (statut, en-têtes, corps, cookies à poser)."""
+        if self.latency:
+            self.clock.sleep(self.latency)
+        with self._lock:
+            self._advance()
+            session_id = cookies.get("SESSION")
+            if path == "/login":
+                return self._login(method, params, session_id)
+
+            session = self._valid_session(session_id)
+            if session is None:
+                if path == "/data/indoor/heat_setting" and method == "POST":
+                    return self.expiry_status, {"Location": "/login"}, "", {}
+                return 302, {"Location": "/login"}, "", {}
+
+            if path.startswith("/data/") and self._random.random() < self.error_rate:
+                self.error_count += 1
+                return 500, {"Content-Type": "text/html"}, "Internal Server Error", {}
+            if path == "/":
+                return self._html(f'<input type="hidden" name="_csrf" value="{session["csrf"]}"/>')
+            if path == "/data/elements" and method == "GET":
+                self.elements_count += 1
+                self.polls.append(self.clock.now())
+                return self._json(self._elements_body())
+            if path == "/data/indoor/heat_setting" and method == "GET":
+                return self._json(self._heat_settings_body())
+            if path == "/data/indoor/heat_setting" and method == "POST":
+                if params.get("_csrf") != session["csrf"]:
+                    return 403, {"Content-Type": "text/html"}, "Forbidden", {}
+                if self.reject_commands:
+                    self.rejected_commands.append((self.clock.now(), dict(params)))
+                    return self._json({"status": "error"})
+                self._apply_heat_setting(params)
+                return self._json({"status": "success"})
+            if path == "/data/installationdevices" and method == "GET":
+                body = copy.deepcopy(self._installation)
+                for device in body["data"]:
+                    device["lastComm"] = int(self._last_comm * 1000)
+                return self._json(body)
+            return 404, {"Content-Type": "text/html"}, "Not Found", {}
+
+    def _login(self, method, params, session_id):
+        if method == "GET":
+            session_id = session_id or self._new_id("anon")
+            token = self._new_id("csrf")
+            self._sessions[session_id] = {"csrf": token, "created": self.clock.timestamp()}
+            html = f'<form><input type="hidden" name="_csrf" value="{token}"/></form>'
+            return 200, {"Content-Type": "text/html"}, html, {"SESSION": session_id}
+        pending = self._sessions.get(session_id)
+        if (
+            pending is None
+            or params.get("_csrf") != pending["csrf"]
+            or params.get("username") != self.username
+            or params.get("password") != self.password
+        ):
+            return 302, {"Location": "/login?error"}, "", {}
+        self.login_count += 1
+        del self._sessions[session_id]
+        authenticated = self._new_id("auth")
+        self._sessions[authenticated] = {
+            "csrf": self._new_id("csrf"),
+            "created": self.clock.timestamp(),
+        }
+        return 302, {"Location": "/"}, "", {"SESSION": authenticated}
+
+    def _valid_session(self, session_id):
+        session = self._sessions.get(session_id)
+        if session is None or not session_id.startswith("auth"):
+            return None
+        if self.session_ttl and self.clock.timestamp() - session["created"] > self.session_ttl:
+            self.expired_count += 1
+            del self._sessions[session_id]
+            return None
+        return session
+
+    def _new_id(self, prefix):
+        value = f"{prefix}-{self._next_id}"
+        self._next_id += 1
+        return value
+
+    @staticmethod
+    def _html(text):
+        return 200, {"Content-Type": "text/html"}, text, {}
+
+    @staticmethod
+    def _json(body):
+        return 200, {"Content-Type": "application/json"}, json.dumps(body), {}
+
+    def expire_sessions(self):
+        """Invalide toutes les sessions (expiration côté serveur)."""
+        with self._lock:
+            self._sessions.clear()
+
+    # --- Réponses ------------------------------------------------------------
+
+    def _elements_body(self):
+        body = dict(self._elements)
+        body["timestamp"] = int(self.clock.timestamp() * 1000)
+        data = dict(body["data"])
+        data["elements"] = self._reported
+        data["device_status"] = [
+            {
+                **status,
+                "lastComm": int(self._last_comm * 1000),
+                "currentTimeMillis": int(self.clock.timestamp() * 1000),
+            }
+            for status in data["device_status"]
+        ]
+        body["data"] = data
+        return body
+
+    def _heat_settings_body(self):
+        body = copy.deepcopy(self._heat_settings)
+        element = self._reported[0]
+        for section in ("heatingSetting", "heatingStatus"):
+            body["data"][section]["runStopDHW"] = element["onOff"]
+            body["data"][section]["settingTempDHW"] = int(element["settingTemperature"])
+        body["data"]["heatingStatus"]["tempDHW"] = int(element["currentTemperature"])
+        body["timestamp"] = int(self.clock.timestamp() * 1000)
+        return body
+
+    def _apply_heat_setting(self, params):
+        self.commands.append((self.clock.now(), dict(params)))
+        for element in self.elements:
+            if str(element["parentId"]) != params.get("indoorId"):
+                continue
+            if "settingTempDHW" in params:
+                element["settingTemperature"] = float(params["settingTempDHW"])
+            if "runStopDHW" in params:
+                element["onOff"] = int(params["runStopDHW"])
+
+    # --- Modèle thermique ----------------------------------------------------
+
+    def _comm_time(self):
+        now = self.clock.timestamp()
+        if not self.comm_interval:
+            return now
+        phase = self.comm_phase
+        return (now - phase) // self.comm_interval * self.comm_interval + phase
+
+    def _advance(self):
+        now = self.clock.timestamp()
+        elapsed, self._last_update = now - self._last_update, now
+        for element in self.elements:
+            key = element["deviceId"]
+            current = self._temperatures.get(key, element["currentTemperature"])
+            target = element["settingTemperature"]
+            heating = self._heating.get(key, False)
+            if element["onOff"] != 1:
+                heating = False
+            elif not heating and current <= target - self.HYSTERESIS:
+                heating = True
+            if heating:
+                current = min(target, current + self.heating_rate * elapsed)
+                heating = current < target
+            else:
+                current -= self.loss_rate * elapsed
+            self._heating[key] = heating
+            self._temperatures[key] = current
+            element["currentTemperature"] = round(current, 1)
+            element["operationStatus"] = (
+                8 if heating else (4 if element["onOff"] == 1 else 7)
+            )
+        last_comm = self._comm_time()
+        if last_comm != self._last_comm:
+            self._last_comm = last_comm
+            self._reported = copy.deepcopy(self.elements)
+
+
+class _FakeCSNetHandler(BaseHTTPRequestHandler):
+    backend = None  # Renseigné par FakeCSNetServer
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def _dispatch(self, method):
+        url = urlsplit(self.path)
+        params = dict(parse_qsl(url.query))
+        if method == "POST":
+            length = int(self.headers.get("Content-Length") or 0)
+            params.update(parse_qsl(self.rfile.read(length).decode()))
+        cookies = {}
+        for item in (self.headers.get("Cookie") or "").split(";"):
+            if "=" in item:
+                name, value = item.strip().split("=", 1)
+                cookies[name] = value
+
+        status, headers, body, set_cookies = self.backend.handle(
+            method, url.path, params, cookies
+        )
+        payload = body.encode()
+        self.send_response(status)
+        for name, value in headers.items():
+            if name == "Location" and value.startswith("/"):
+                value = f"http://{self.headers.get('Host')}{value}"
+            self.send_header(name, value)
+        for name, value in set_cookies.items():
+            self.send_header("Set-Cookie", f"{name}={value}; Path=/; HttpOnly")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        logging.getLogger("Yutampo_ha_addon").debug(f"FakeCSNet : {format % args}")
+
+
+class FakeCSNetServer:
+    """Sert un FakeCSNet en HTTP sur 127.0.0.1 (port 0 = port libre)."""
+
+    def __init__(self, backend=None, host="127.0.0.1", port=0):
+        self.backend = backend or FakeCSNet()
+        handler = type("Handler", (_FakeCSNetHandler,), {"backend": self.backend})
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self.httpd.serve_forever, name="fake-csnet", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Doublure locale de csnetmanager.com.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--username", default="sim")
+    parser.add_argument("--password", default="sim")
+    parser.add_argument("--latency", type=float, default=0.0, help="Latence par requête (s)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Part de HTTP 500 sur /data/*")
+    parser.add_argument("--session-ttl", type=float, help="Expiration des sessions (s)")
+    parser.add_argument("--expiry-status", type=int, choices=[302, 403], default=302)
+    parser.add_argument("--comm-interval", type=float, default=60, help="Période lastComm (s)")
+    parser.add_argument("--comm-phase", type=float, help="Déphasage lastComm (s)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    backend = FakeCSNet(
+        username=args.username,
+        password=args.password,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        session_ttl=args.session_ttl,
+        expiry_status=args.expiry_status,
+        comm_interval=args.comm_interval,
+        comm_phase=args.comm_phase,
+    )
+    server = FakeCSNetServer(backend, args.host, args.port)
+    logging.getLogger("Yutampo_ha_addon").info(f"FakeCSNet en écoute sur {server.base_url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+# forecast_curve.py — Courbe de prévisions horaires compacte et mise à jour incrémentale
+# Dépendances : array, bisect, datetime
+
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+
+
+class ForecastCurve:
+    """Prévisions horaires stockées en tableaux compacts triés par horodatage.
+
+    - timestamps (epoch s), températures (°C, -inf si absente) et décalage UTC
+      d'origine de chaque entrée (pour restituer l'heure telle que fournie par HA).
+    - update() ne réécrit que les entrées dont la température a changé quand la
+      nouvelle prévision prolonge la précédente (cas nominal : la fenêtre glisse
+      d'une heure) ; sinon la courbe est reconstruite à partir du cache de parsing.
+    - hottest() donne l'heure la plus chaude d'une fenêtre quelconque sans reparsing.
+    """
+
+    PARSE_CACHE_MAX = 512
+
+    def __init__(self):
+        self._timestamps = array("d")
+        self._temperatures = array("d")
+        self._offsets = array("i")
+        self._parse_cache = {}  # chaîne ISO-8601 -> (epoch, décalage UTC en s)
+
+    def __len__(self):
+        return len(self._timestamps)
+
+    def _parse(self, raw):
+        parsed = self._parse_cache.get(raw)
+        if parsed is None:
+            dt = datetime.fromisoformat(raw)
+            offset = dt.utcoffset()
+            parsed = (dt.timestamp(), int(offset.total_seconds()) if offset else 0)
+            self._parse_cache[raw] = parsed
+        return parsed
+
+    def update(self, forecast):
+        """Intègre une prévision HA. Retourne le nombre d'entrées modifiées."""
+        entries = []
+        for entry in forecast:
+            timestamp, offset = self._parse(entry["datetime"])
+            temp = entry.get("temperature")
+            entries.append(
+                (timestamp, float(temp) if temp is not None else float("-inf"), offset)
+            )
+        entries.sort(key=lambda e: e[0])
+
+        changed = self._update_in_place(entries)
+        if changed is None:
+            changed = self._rebuild(entries)
+        self._prune_parse_cache()
+        return changed
+
+    def _update_in_place(self, entries):
+        if not entries or not self._timestamps:
+            return None
+        # La nouvelle prévision doit commencer à l'intérieur de l'ancienne...
+        start = bisect_left(self._timestamps, entries[0][0])
+        if start >= len(self._timestamps) or self._timestamps[start] != entries[0][0]:
+            return None
+        overlap = min(len(self._timestamps) - start, len(entries))
+        # ...et reprendre exactement ses horodatages sur la partie commune.
+        for i in range(overlap):
+            if self._timestamps[start + i] != entries[i][0]:
+                return None
+
+        changed = 0
+        del self._timestamps[:start]
+        del self._temperatures[:start]
+        del self._offsets[:start]
+        # Tronquer si la nouvelle prévision est plus courte
+        del self._timestamps[overlap:]
+        del self._temperatures[overlap:]
+        del self._offsets[overlap:]
+        for i in range(overlap):
+            if self._temperatures[i] != entries[i][1]:
+                self._temperatures[i] = entries[i][1]
+                changed += 1
+        for timestamp, temp, offset in entries[overlap:]:
+            self._timestamps.append(timestamp)
+            self._temperatures.append(temp)
+            self._offsets.append(offset)
+            changed += 1
+        return changed
+
+    def _rebuild(self, entries):
+        self._timestamps = array("d", (e[0] for e in entries))
+        self._temperatures = array("d", (e[1] for e in entries))
+        self._offsets = array("i", (e[2] for e in entries))
+        return len(entries)
+
+    def _prune_parse_cache(self):
+        if len(self._parse_cache) <= self.PARSE_CACHE_MAX:
+            return
+        oldest = self._timestamps[0] if self._timestamps else float("inf")
+        self._parse_cache = {
+            raw: parsed for raw, parsed in self._parse_cache.items() if parsed[0] >= oldest
+        }
+
+    def hottest(self, start=None, end=None):
+        """Entrée la plus chaude strictement après `start` et jusqu'à `end` inclus
+        (epoch s, bornes optionnelles).
+
+        Retourne (timestamp, température, heure décimale dans le fuseau fourni par HA)
+        ou None si aucune entrée avec température dans la fenêtre.
+        """
+        lo = 0 if start is None else bisect_right(self._timestamps, start)
+        hi = len(self._timestamps) if end is None else bisect_right(self._timestamps, end)
+        best = None
+        best_temp = float("-inf")
+        for i in range(lo, hi):
+            # Comparaison stricte : à égalité, la première heure l'emporte
+            if self._temperatures[i] > best_temp:
+                best_temp = self._temperatures[i]
+                best = i
+        if best is None:
+            return None
+        local_seconds = (int(self._timestamps[best]) + self._offsets[best]) % 86400
+        return self._timestamps[best], best_temp, local_seconds / 3600.0
+
+    def count_after(self, start):
+        """Nombre d'entrées strictement postérieures à `start` (epoch s)."""
+        return len(self._timestamps) - bisect_right(self._timestamps, start)
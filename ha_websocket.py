@@ -0,0 +1,224 @@
+# ha_websocket.py — Session WebSocket Home Assistant partagée (météo, HC/HP)
+# Dépendances : websocket-client, json, threading
+
+import json
+import logging
+import threading
+
+import websocket
+
+from metrics import HA_WEBSOCKET_RECONNECTS_TOTAL
+
+
+class HaWebSocket:
+    """Connexion unique et multiplexée à l'API WebSocket de Home Assistant.
+
+    - Une seule socket, une seule authentification, un seul thread.
+    - Les réponses `result` et les `event` sont routés vers l'abonné par id de message.
+    - subscribe() enregistre un abonnement persistant, rejoué après chaque reconnexion.
+    - send_command() envoie une commande ponctuelle ; ses éventuels événements
+      ne sont routés que jusqu'à la fin de la connexion courante.
+    - Reconnexion automatique avec backoff exponentiel (5s, 10s, 20s... max 300s).
+    """
+
+    MAX_RECONNECT_DELAY = 300  # 5 minutes max
+    INITIAL_RECONNECT_DELAY = 5
+
+    def __init__(self, config):
+        self.logger = logging.getLogger("Yutampo_ha_addon")
+        self.ha_token = config["ha_token"]
+        self.ws_url = config.get("ha_websocket_url") or "ws://supervisor/core/websocket"
+        self.ws = None
+        self.ws_thread = None
+        self.connected = False  # True une fois authentifié
+        self._lock = threading.RLock()
+        self._stop_event = threading.Event()
+        self._reconnect_delay = self.INITIAL_RECONNECT_DELAY
+        self._message_id = 1
+        self._routes = {}  # id de message -> (on_result, on_event)
+        self._subscriptions = {}  # handle -> {"message", "on_event", "on_result", "id"}
+        self._next_handle = 1
+        self._listeners = []  # (on_connected, on_disconnected)
+        self._has_connected = False
+
+    def start(self):
+        if self.ws_thread and self.ws_thread.is_alive():
+            return
+        self._stop_event.clear()
+        self.ws_thread = threading.Thread(
+            target=self._run, name="ha-websocket", daemon=True
+        )
+        self.ws_thread.start()
+        self.logger.info("Session WebSocket HA démarrée.")
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.ws = websocket.WebSocketApp(
+                    self.ws_url,
+                    on_message=self._on_message,
+                    on_error=self._on_error,
+                    on_close=self._on_close,
+                    header={"Authorization": f"Bearer {self.ha_token}"},
+                )
+                self.ws.run_forever()
+            except Exception as e:
+                self.logger.error(f"Erreur de la session WebSocket HA : {str(e)}")
+            self._set_disconnected()
+            if self._stop_event.is_set():
+                break
+            delay = self._reconnect_delay
+            self._reconnect_delay = min(delay * 2, self.MAX_RECONNECT_DELAY)
+            self.logger.info(f"WebSocket HA : reconnexion dans {delay}s...")
+            self._stop_event.wait(delay)
+
+    def add_listener(self, on_connected=None, on_disconnected=None):
+        """Enregistre des callbacks appelés après authentification / à la déconnexion."""
+        self._listeners.append((on_connected, on_disconnected))
+
+    def subscribe(self, message, on_event, on_result=None):
+        """Abonnement persistant. Retourne un handle utilisable avec unsubscribe()."""
+        with self._lock:
+            handle = self._next_handle
+            self._next_handle += 1
+            subscription = {
+                "message": message,
+                "on_event": on_event,
+                "on_result": on_result,
+                "id": None,
+            }
+            self._subscriptions[handle] = subscription
+            if self.connected:
+                subscription["id"] = self._send(message, on_result, on_event)
+        return handle
+
+    def unsubscribe(self, handle):
+        with self._lock:
+            subscription = self._subscriptions.pop(handle, None)
+            if not subscription or subscription["id"] is None:
+                return
+            self._routes.pop(subscription["id"], None)
+            if self.connected:
+                self._send(
+                    {"type": "unsubscribe_events", "subscription": subscription["id"]}
+                )
+
+    def send_command(self, message, on_result=None, on_event=None):
+        """Envoie une commande ponctuelle. Retourne son id, ou None si non connecté."""
+        with self._lock:
+            if not self.connected:
+                self.logger.warning(
+                    f"WebSocket HA non connectée, commande {message.get('type')} ignorée."
+                )
+                return None
+            return self._send(message, on_result, on_event)
+
+    def subscription_id(self, handle):
+        """Id serveur courant d'un abonnement, ou None s'il n'est pas actif."""
+        with self._lock:
+            subscription = self._subscriptions.get(handle)
+            return subscription["id"] if subscription else None
+
+    def subscription_count(self):
+        """Nombre d'abonnements persistants actuellement actifs côté serveur."""
+        with self._lock:
+            return sum(
+                1 for sub in self._subscriptions.values() if sub["id"] is not None
+            )
+
+    def _send(self, message, on_result=None, on_event=None):
+        # Appelé sous self._lock : HA exige des id strictement croissants sur la socket
+        message_id = self._message_id
+        self._message_id += 1
+        if on_result or on_event:
+            self._routes[message_id] = (on_result, on_event)
+        self.ws.send(json.dumps({**message, "id": message_id}))
+        return message_id
+
+    def _on_message(self, ws, message):
+        try:
+            data = json.loads(message)
+            msg_type = data.get("type")
+
+            if msg_type == "auth_required":
+                ws.send(json.dumps({"type": "auth", "access_token": self.ha_token}))
+
+            elif msg_type == "auth_ok":
+                self.logger.info("WebSocket HA : authentification réussie.")
+                self._on_authenticated()
+
+            elif msg_type == "auth_invalid":
+                self.logger.error(
+                    f"WebSocket HA : authentification refusée : {data.get('message')}"
+                )
+
+            elif msg_type in ("result", "event"):
+                with self._lock:
+                    route = self._routes.get(data.get("id"))
+                    if route and msg_type == "result" and route[1] is None:
+                        # Commande ponctuelle sans événements : route terminée
+                        self._routes.pop(data.get("id"), None)
+                if not route:
+                    return
+                on_result, on_event = route
+                if msg_type == "result":
+                    if not data.get("success"):
+                        self.logger.error(
+                            f"WebSocket HA : commande {data.get('id')} en échec : {data.get('error')}"
+                        )
+                    if on_result:
+                        on_result(data)
+                elif on_event:
+                    on_event(data.get("event", {}))
+
+        except Exception as e:
+            self.logger.error(
+                f"WebSocket HA : erreur traitement message : {str(e)}"
+            )
+
+    def _on_authenticated(self):
+        with self._lock:
+            if self._has_connected:
+                HA_WEBSOCKET_RECONNECTS_TOTAL.inc()
+            self._has_connected = True
+            self.connected = True
+            self._reconnect_delay = self.INITIAL_RECONNECT_DELAY
+            for subscription in self._subscriptions.values():
+                subscription["id"] = self._send(
+                    subscription["message"],
+                    subscription["on_result"],
+                    subscription["on_event"],
+                )
+            count = len(self._subscriptions)
+        if count:
+            self.logger.info(f"WebSocket HA : {count} abonnement(s) (ré)établi(s).")
+        for on_connected, _ in self._listeners:
+            if on_connected:
+                on_connected()
+
+    def _on_error(self, ws, error):
+        self.logger.error(f"WebSocket HA : erreur : {str(error)}")
+
+    def _on_close(self, ws, close_status_code, close_msg):
+        self.logger.info(
+            f"WebSocket HA : connexion fermée : {close_status_code} - {close_msg}"
+        )
+
+    def _set_disconnected(self):
+        with self._lock:
+            was_connected = self.connected
+            self.connected = False
+            self._message_id = 1
+            self._routes.clear()
+            for subscription in self._subscriptions.values():
+                subscription["id"] = None
+        if was_connected:
+            for _, on_disconnected in self._listeners:
+                if on_disconnected:
+                    on_disconnected()
+
+    def shutdown(self):
+        self._stop_event.set()
+        if self.ws:
+            self.ws.close()
+        self.logger.info("Session WebSocket HA arrêtée.")
@@ -0,0 +1,377 @@
+# metrics.py — Métriques internes et endpoint HTTP au format texte Prometheus
+# Dépendances : http.server, threading, time
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Bornes des histogrammes (secondes)
+NETWORK_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+CPU_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values)) + list(extra or [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    """Base commune : une série par combinaison de valeurs de labels."""
+
+    TYPE = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                f"Labels {sorted(labels)} invalides pour {self.name} (attendus : {self.labelnames})"
+            )
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {_escape(self.documentation)}",
+            f"# TYPE {self.name} {self.TYPE}",
+        ]
+        with self._lock:
+            series = sorted(self._series.items())
+        for key, value in series:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    """Compteur monotone (le suffixe _total fait partie du nom)."""
+
+    TYPE = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        if not self.labelnames:
+            self._series[()] = 0  # Exposé à 0 dès le démarrage
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._series.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    """Valeur instantanée, fixée par set() ou lue à chaque collecte (set_function)."""
+
+    TYPE = "gauge"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._function = None
+        if not self.labelnames:
+            self._series[()] = 0
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function):
+        """Valeur calculée à la collecte (jauge sans label uniquement)."""
+        self._function = function
+
+    def value(self, **labels):
+        if self._function:
+            return self._function()
+        with self._lock:
+            return self._series.get(self._key(labels), 0)
+
+    def render(self):
+        if not self._function:
+            return super().render()
+        try:
+            value = self._function()
+        except Exception:
+            return []
+        return [
+            f"# HELP {self.name} {_escape(self.documentation)}",
+            f"# TYPE {self.name} {self.TYPE}",
+            f"{self.name} {_format_value(value)}",
+        ]
+
+
+class Histogram(_Metric):
+    """Histogramme à bornes fixes : _bucket (cumulé), _sum et _count par série."""
+
+    TYPE = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=NETWORK_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {"counts": [0] * len(self.buckets), "sum": 0.0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["counts"][i] += 1
+                    break
+            series["sum"] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Mesure la durée réelle du bloc (y compris en cas d'exception)."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels):
+        with self._lock:
+            series = self._series.get(self._key(labels))
+            return sum(series["counts"]) if series else 0
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {_escape(self.documentation)}",
+            f"# TYPE {self.name} {self.TYPE}",
+        ]
+        with self._lock:
+            series = sorted(
+                (key, list(data["counts"]), data["sum"]) for key, data in self._series.items()
+            )
+        for key, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, [("le", _format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """Ensemble des métriques exposées, dans leur ordre de déclaration."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Métrique {metric.name} déjà déclarée")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=NETWORK_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+# CSNet (ApiClient)
+CSNET_REQUEST_SECONDS = REGISTRY.histogram(
+    "yutampo_csnet_request_seconds",
+    "Durée des requêtes HTTP vers CSNet par endpoint.",
+    ("endpoint", "method"),
+)
+CSNET_REAUTH_TOTAL = REGISTRY.counter(
+    "yutampo_csnet_reauth_total",
+    "Réauthentifications CSNet après rejet de la session ou du token (shared : login déjà fait par un appel concurrent).",
+    ("result",),
+)
+CSNET_READS_SHARED_TOTAL = REGISTRY.counter(
+    "yutampo_csnet_reads_shared_total",
+    "Lectures de /data/elements servies sans requête : requête en vol partagée ou cache court.",
+    ("source",),
+)
+CSNET_RETRIES_TOTAL = REGISTRY.counter(
+    "yutampo_csnet_retries_total",
+    "Nouvelles tentatives (après backoff) d'un appel CSNet.",
+    ("operation",),
+)
+CSNET_FAILURES_TOTAL = REGISTRY.counter(
+    "yutampo_csnet_failures_total",
+    "Appels CSNet en échec après toutes les tentatives ou refusés par le disjoncteur.",
+    ("operation", "reason"),
+)
+
+# Polling (Scheduler)
+POLL_INTERVAL_SECONDS = REGISTRY.gauge(
+    "yutampo_poll_interval_seconds",
+    "Intervalle choisi avant le prochain poll CSNet.",
+)
+POLLS_SCHEDULED_TOTAL = REGISTRY.counter(
+    "yutampo_polls_scheduled_total",
+    "Polls CSNet planifiés, par raison du choix de l'intervalle.",
+    ("reason",),
+)
+
+POLL_STALENESS_SECONDS = REGISTRY.histogram(
+    "yutampo_poll_staleness_seconds",
+    "Âge de la dernière remontée de l'appareil (lastComm) au moment du poll.",
+    buckets=(1, 2, 5, 10, 15, 20, 30, 45, 60, 90, 120, 300),
+)
+POLLS_UNCHANGED_TOTAL = REGISTRY.counter(
+    "yutampo_polls_unchanged_total",
+    "Polls sans nouvelle remontée de l'appareil, non traités.",
+)
+
+# Commandes (OptimisticState)
+COMMAND_CONFIRM_SECONDS = REGISTRY.histogram(
+    "yutampo_command_confirm_seconds",
+    "Délai entre une commande et l'état correspondant rapporté par l'appareil.",
+    buckets=(5, 10, 30, 60, 90, 120, 180, 300, 600),
+)
+COMMAND_OUTCOMES_TOTAL = REGISTRY.counter(
+    "yutampo_command_outcomes_total",
+    "Issues des commandes suivies : confirmée, renvoyée ou annulée (rollback).",
+    ("outcome",),
+)
+
+# MQTT (MqttHandler)
+MQTT_PUBLISHED_TOTAL = REGISTRY.counter(
+    "yutampo_mqtt_published_total",
+    "Messages publiés sur le broker MQTT.",
+)
+MQTT_SUPPRESSED_TOTAL = REGISTRY.counter(
+    "yutampo_mqtt_publish_suppressed_total",
+    "Publications retained ignorées car identiques à la précédente.",
+)
+MQTT_RECEIVED_TOTAL = REGISTRY.counter(
+    "yutampo_mqtt_received_total",
+    "Commandes MQTT reçues.",
+)
+MQTT_OUTBOUND_QUEUE = REGISTRY.gauge(
+    "yutampo_mqtt_outbound_queue",
+    "Messages MQTT sortants non encore écrits ou non acquittés (QoS 1).",
+)
+MQTT_COMMAND_QUEUE = REGISTRY.gauge(
+    "yutampo_mqtt_command_queue",
+    "Commandes MQTT en attente de traitement.",
+)
+
+# Régulation (AutomationHandler)
+AUTOMATION_TICK_SECONDS = REGISTRY.histogram(
+    "yutampo_automation_tick_seconds",
+    "Durée d'une évaluation de la régulation.",
+    buckets=CPU_BUCKETS + (2.5, 5.0),
+)
+
+# Home Assistant (WeatherClient, OffPeakClient)
+FORECAST_PARSE_SECONDS = REGISTRY.histogram(
+    "yutampo_forecast_parse_seconds",
+    "Durée d'intégration d'une prévision météo reçue.",
+    buckets=CPU_BUCKETS,
+)
+HA_WEBSOCKET_RECONNECTS_TOTAL = REGISTRY.counter(
+    "yutampo_ha_websocket_reconnects_total",
+    "Reconnexions de la session WebSocket HA après une déconnexion.",
+)
+OFF_PEAK_TRANSITIONS_TOTAL = REGISTRY.counter(
+    "yutampo_off_peak_transitions_total",
+    "Bascules HC/HP reçues de Home Assistant.",
+    ("state",),
+)
+
+
+class MetricsServer:
+    """Endpoint HTTP local servant le registre sur /metrics (thread dédié)."""
+
+    PORT = 9464  # Port interne déclaré dans config.yaml (ports: 9464/tcp)
+
+    def __init__(self, port=None, host="0.0.0.0", registry=None):
+        self.logger = logging.getLogger("Yutampo_ha_addon")
+        self.host = host
+        self.port = port or self.PORT
+        self.registry = registry or REGISTRY
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # Pas de journal d'accès à chaque collecte
+
+        self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="metrics-http", daemon=True
+        )
+        self._thread.start()
+        self.logger.info(f"Endpoint de métriques démarré sur le port {self.port} (/metrics).")
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        self.logger.info("Endpoint de métriques arrêté.")
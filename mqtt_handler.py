@@ -1,7 +1,17 @@
 import paho.mqtt.client as mqtt
+from clock import SYSTEM_CLOCK
+from command_worker import CommandWorker
+from optimistic_state import OptimisticState
+from metrics import (
+    MQTT_COMMAND_QUEUE,
+    MQTT_OUTBOUND_QUEUE,
+    MQTT_PUBLISHED_TOTAL,
+    MQTT_RECEIVED_TOTAL,
+    MQTT_SUPPRESSED_TOTAL,
+)
 import json
 import logging
-import time
+import threading
 
 
 # Constantes pour les payloads des capteurs
@@ -63,6 +73,28 @@ TARGET_LEVEL_PAYLOAD = {
     "device": DEVICE_INFO,
 }
 
+CIRCUIT_STATE_PAYLOAD = {
+    "name": "Yutampo Disjoncteur CSNet",
+    "unique_id": "yutampo_circuit_state",
+    "state_topic": "yutampo/sensor/yutampo_circuit_state/state",
+    "device_class": "enum",
+    "options": ["closed", "open", "half_open"],
+    "icon": "mdi:electric-switch",
+    "retain": True,
+    "device": DEVICE_INFO,
+}
+
+SETPOINT_PLAN_PAYLOAD = {
+    "name": "Yutampo Consigne Planifiée",
+    "unique_id": "yutampo_setpoint_plan",
+    "state_topic": "yutampo/sensor/yutampo_setpoint_plan/state",
+    "json_attributes_topic": "yutampo/sensor/yutampo_setpoint_plan/attributes",
+    "unit_of_measurement": "°C",
+    "device_class": "temperature",
+    "retain": True,
+    "device": DEVICE_INFO,
+}
+
 # Constantes pour les payloads des number (MQTT Discovery)
 AMPLITUDE_PAYLOAD = {
     "name": "Yutampo Amplitude Thermique",
@@ -107,6 +139,32 @@ SETPOINT_PAYLOAD = {
     "mode": "box",
 }
 
+COMMAND_QUEUE_PAYLOAD = {
+    "name": "Yutampo File de Commandes",
+    "unique_id": "yutampo_command_queue",
+    "state_topic": "yutampo/sensor/yutampo_command_queue/state",
+    "json_attributes_topic": "yutampo/sensor/yutampo_command_queue/attributes",
+    "state_class": "measurement",
+    "entity_category": "diagnostic",
+    "icon": "mdi:tray-full",
+    "retain": True,
+    "device": DEVICE_INFO,
+}
+
+COMMAND_LATENCY_PAYLOAD = {
+    "name": "Yutampo Latence de Confirmation",
+    "unique_id": "yutampo_command_latency",
+    "state_topic": "yutampo/sensor/yutampo_command_latency/state",
+    "json_attributes_topic": "yutampo/sensor/yutampo_command_latency/attributes",
+    "unit_of_measurement": "s",
+    "device_class": "duration",
+    "state_class": "measurement",
+    "entity_category": "diagnostic",
+    "icon": "mdi:timer-check-outline",
+    "retain": True,
+    "device": DEVICE_INFO,
+}
+
 FORECAST_UPDATED_PAYLOAD = {
     "name": "Yutampo Dernière MAJ Forecast",
     "unique_id": "yutampo_forecast_updated",
@@ -118,8 +176,16 @@ FORECAST_UPDATED_PAYLOAD = {
 
 
 class MqttHandler:
-    def __init__(self, config, api_client=None):
+    CONNECT_TIMEOUT = 10  # Attente max du CONNACK au démarrage (secondes)
+    DISCOVERY_ACK_TIMEOUT = 10  # Attente max cumulée des PUBACK de discovery (secondes)
+    # Attributs de la file de commandes : des compteurs qui ne bougent qu'en cas de
+    # saturation. Latences et commandes traitées changeraient à chaque commande et
+    # rendraient inopérante la déduplication des messages retenus.
+    COMMAND_QUEUE_ATTRIBUTES = ("max_depth", "replaced", "dropped")
+
+    def __init__(self, config, api_client=None, clock=None):
         self.logger = logging.getLogger("Yutampo_ha_addon")
+        self.clock = clock or SYSTEM_CLOCK
         self.client = mqtt.Client(client_id="yutampo_addon", protocol=mqtt.MQTTv311)
         self.client.will_set(
             topic="yutampo/status", payload="offline", qos=1, retain=True
@@ -136,7 +202,22 @@ class MqttHandler:
         self.api_client = api_client
         self.devices = {}
         self.automation_handler = None
+        self._connected = threading.Event()
+        self._has_connected = False
+        self._retained_cache = {}  # topic -> dernier payload retained publié
+        self._cache_lock = threading.Lock()
+        self.published_count = 0
+        self.suppressed_count = 0
+        self._pending_discovery = []
+        self.command_worker = CommandWorker(
+            self._handle_message,
+            on_processed=self.publish_command_queue_metrics,
+            clock=self.clock,
+        )
+        self.optimistic_state = OptimisticState(api_client, self, clock=self.clock)
         self.client.username_pw_set(self.mqtt_user, self.mqtt_password)
+        MQTT_OUTBOUND_QUEUE.set_function(self.outbound_depth)
+        MQTT_COMMAND_QUEUE.set_function(self.command_worker.depth)
 
     def connect(self):
         if not self.mqtt_host:
@@ -145,19 +226,29 @@ class MqttHandler:
         self.logger.info(
             f"Tentative de connexion au broker MQTT : {self.mqtt_host}:{self.mqtt_port}"
         )
+        self.command_worker.start()
         try:
             self.client.connect(self.mqtt_host, self.mqtt_port, 60)
             self.client.loop_start()
         except Exception as e:
             self.logger.error(f"Échec de la connexion au broker MQTT : {str(e)}")
             raise
+        if not self._connected.wait(self.CONNECT_TIMEOUT):
+            self.logger.warning(
+                f"Pas de CONNACK après {self.CONNECT_TIMEOUT}s, les publications seront différées."
+            )
 
     def _on_connect(self, client, userdata, flags, rc):
         if rc == 0:
             self.logger.info("Connecté au broker MQTT")
+            self._connected.set()
             self.client.publish(
                 topic="yutampo/status", payload="online", qos=1, retain=True
             )
+            if self._has_connected:
+                # Reconnexion : le broker a pu perdre ses messages retained
+                self._replay_retained_cache()
+            self._has_connected = True
             for device_id in self.devices:
                 self.publish_availability(device_id, "online")
 
@@ -167,6 +258,51 @@ class MqttHandler:
                 f"Échec de la connexion au broker MQTT, code de retour : {rc}"
             )
 
+    def _publish(self, topic, payload, qos=0, retain=False, force=False):
+        """Point de publication unique.
+
+        Les publications retained sont mémorisées par topic ; une publication
+        retained identique à la précédente est ignorée (sauf `force`).
+        Retourne le MQTTMessageInfo, ou None si la publication a été ignorée.
+        """
+        if isinstance(payload, (int, float)):
+            payload = str(payload)
+        if retain:
+            with self._cache_lock:
+                if not force and self._retained_cache.get(topic) == payload:
+                    self.suppressed_count += 1
+                    MQTT_SUPPRESSED_TOTAL.inc()
+                    return None
+                self._retained_cache[topic] = payload
+        self.published_count += 1
+        MQTT_PUBLISHED_TOTAL.inc()
+        return self.client.publish(topic, payload, qos=qos, retain=retain)
+
+    def _replay_retained_cache(self):
+        """Republie une fois l'ensemble des valeurs retained connues."""
+        with self._cache_lock:
+            entries = list(self._retained_cache.items())
+        for topic, payload in entries:
+            self.client.publish(topic, payload, qos=1, retain=True)
+        self.logger.info(
+            f"Reconnexion MQTT : {len(entries)} valeurs retained republiées."
+        )
+
+    def outbound_depth(self):
+        """Paquets en file d'écriture paho + messages QoS 1 en attente de PUBACK."""
+        return len(getattr(self.client, "_out_packet", ())) + len(
+            getattr(self.client, "_out_messages", ())
+        )
+
+    def get_publish_stats(self):
+        """Retourne les compteurs de publications envoyées / ignorées."""
+        with self._cache_lock:
+            return {
+                "published": self.published_count,
+                "suppressed": self.suppressed_count,
+                "cached_topics": len(self._retained_cache),
+            }
+
     def subscribe_topics(self):
         topics = [
             f"yutampo/climate/+/mode/set",
@@ -180,15 +316,21 @@ class MqttHandler:
         self.logger.debug("Souscriptions aux topics MQTT effectuées.")
 
     def _on_message(self, client, userdata, msg):
+        """Callback paho : met la commande en file sans appel bloquant."""
+        payload = msg.payload.decode()
+        MQTT_RECEIVED_TOTAL.inc()
         self.logger.info(
-            f"Commande utilisateur reçue sur le topic {msg.topic}: {msg.payload.decode()}"
+            f"Commande utilisateur reçue sur le topic {msg.topic}: {payload}"
         )
+        self.command_worker.submit(msg.topic, payload)
+
+    def _handle_message(self, topic, payload):
+        """Traite une commande utilisateur (thread du CommandWorker)."""
         try:
-            topic_parts = msg.topic.split("/")
+            topic_parts = topic.split("/")
             entity_type = topic_parts[1]
             device_id = topic_parts[2]
             command = topic_parts[3]
-            payload = msg.payload.decode()
 
             if entity_type == "climate":
                 if device_id not in self.devices:
@@ -204,29 +346,13 @@ class MqttHandler:
                     if self.automation_handler:
                         # Utiliser set_mode pour gérer le changement de mode
                         self.automation_handler.set_mode(new_mode)
-                    else:
+                    elif self.optimistic_state.apply(device, "user", mode=new_mode):
                         # Fallback si pas d'automation_handler
-                        run_stop_dhw = 1 if new_mode == "heat" else 0
-                        if self.api_client.set_heat_setting(
-                            device.parent_id, run_stop_dhw=run_stop_dhw
-                        ):
-                            device.mode = new_mode
-                            self.logger.info(
-                                f"Changement de mode par l'utilisateur : {old_mode} -> {new_mode}"
-                            )
-                            self.publish_state(
-                                device.id,
-                                device.setting_temperature,
-                                device.current_temperature,
-                                device.mode,
-                                device.action,
-                                device.operation_label,
-                                source="user",
-                            )
-                        else:
-                            self.logger.error(
-                                f"Échec de l'application du mode {new_mode}"
-                            )
+                        self.logger.info(
+                            f"Changement de mode par l'utilisateur : {old_mode} -> {new_mode}"
+                        )
+                    else:
+                        self.logger.error(f"Échec de l'application du mode {new_mode}")
                 elif command == "set":
                     new_temp = float(payload)
                     if not (30 <= new_temp <= 60):
@@ -236,23 +362,16 @@ class MqttHandler:
                         return
                     old_temp = device.setting_temperature
                     if self.automation_handler:
+                        # Envoyée et publiée par la régulation quand le mode est heat
                         self.automation_handler.set_forced_setpoint(new_temp)
-                    if self.api_client.set_heat_setting(
-                        device.parent_id, setting_temp_dhw=new_temp
+                        if device.mode == "heat":
+                            return
+                    if self.optimistic_state.apply(
+                        device, "user", setting_temperature=new_temp
                     ):
-                        device.setting_temperature = new_temp
                         self.logger.info(
                             f"Changement de consigne par l'utilisateur : {old_temp}°C -> {new_temp}°C"
                         )
-                        self.publish_state(
-                            device.id,
-                            device.setting_temperature,
-                            device.current_temperature,
-                            device.mode,
-                            device.action,
-                            device.operation_label,
-                            source="user",
-                        )
                     else:
                         self.logger.error(
                             f"Échec de l'application de la température {new_temp}"
@@ -299,17 +418,49 @@ class MqttHandler:
     def _publish_discovery(
         self, entity_type, entity_id, payload, publish_state_func=None, state_args=None
     ):
-        """Méthode générique pour publier un message MQTT Discovery."""
+        """Publie un message MQTT Discovery en QoS 1 sans attendre l'acquittement.
+        L'état initial associé est publié par flush_discovery() une fois le lot acquitté."""
         topic = f"{self.discovery_prefix}/{entity_type}/{entity_id}/config"
-        self.client.publish(topic, json.dumps(payload), retain=True)
-        self.logger.info(f"Capteur MQTT Discovery publié pour {entity_id}")
-        time.sleep(1)  # Délai pour garantir la découverte
-        if publish_state_func and state_args:
-            publish_state_func(*state_args)
+        info = self._publish(
+            topic, json.dumps(payload), qos=1, retain=True, force=True
+        )
+        self._pending_discovery.append((entity_id, info, publish_state_func, state_args))
+        self.logger.debug(f"Capteur MQTT Discovery envoyé pour {entity_id}")
+
+    def flush_discovery(self, timeout=None):
+        """Attend les PUBACK de toutes les configurations envoyées (timeout global),
+        puis publie les états initiaux associés."""
+        pending, self._pending_discovery = self._pending_discovery, []
+        if not pending:
+            return
+        timeout = self.DISCOVERY_ACK_TIMEOUT if timeout is None else timeout
+        started = self.clock.monotonic()
+        deadline = started + timeout
+        unacked = []
+        for entity_id, info, _, _ in pending:
+            try:
+                info.wait_for_publish(max(0.0, deadline - self.clock.monotonic()))
+                if not info.is_published():
+                    unacked.append(entity_id)
+            except (ValueError, RuntimeError) as e:
+                self.logger.error(f"Échec de publication discovery pour {entity_id} : {str(e)}")
+                unacked.append(entity_id)
+        elapsed = self.clock.monotonic() - started
+        if unacked:
+            self.logger.warning(
+                f"Discovery non acquittée après {elapsed:.2f}s pour : {', '.join(unacked)}"
+            )
+        else:
+            self.logger.info(
+                f"{len(pending)} configurations MQTT Discovery acquittées en {elapsed:.2f}s"
+            )
+
+        for _, _, publish_state_func, state_args in pending:
+            if publish_state_func and state_args:
+                publish_state_func(*state_args)
 
     def publish_discovery(self, device):
         self.devices[device.id] = device
-        discovery_topic = f"{self.discovery_prefix}/climate/{device.id}/config"
         payload = {
             "name": device.name,
             "unique_id": device.id,
@@ -337,9 +488,29 @@ class MqttHandler:
                 "model": "RS32",
             },
         }
-        self.client.publish(discovery_topic, json.dumps(payload), retain=True)
+        # Acquittée avec les autres entités ; état initial publié par flush_discovery()
+        self._publish_discovery(
+            entity_type="climate",
+            entity_id=device.id,
+            payload=payload,
+            publish_state_func=self.publish_initial_state,
+            state_args=(device,),
+        )
         self.logger.info(f"Configuration MQTT Discovery publiée pour {device.name}")
+
+    def publish_initial_state(self, device):
+        """Publie la disponibilité et l'état connu du climate (chargé par get_devices)."""
         self.publish_availability(device.id, "online")
+        if device.mode is None:
+            return
+        self.publish_state(
+            device.id,
+            device.setting_temperature,
+            device.current_temperature,
+            device.mode,
+            device.action,
+            device.operation_label,
+        )
 
     def publish_state(
         self,
@@ -350,31 +521,32 @@ class MqttHandler:
         action=None,
         operation_label=None,
         source="automation",
+        fields=None,
+        pending=False,
     ):
-        if temperature is not None:
-            self.client.publish(
-                f"yutampo/climate/{device_id}/temperature_state",
-                temperature,
-                retain=True,
-            )
-        if current_temperature is not None:
-            self.client.publish(
-                f"yutampo/climate/{device_id}/current_temperature",
-                current_temperature,
-                retain=True,
-            )
-        if mode is not None:
-            self.client.publish(f"yutampo/climate/{device_id}/mode", mode, retain=True)
-        if action is not None:
-            self.client.publish(
-                f"yutampo/climate/{device_id}/hvac_action", action, retain=True
-            )
-        if operation_label is not None:
-            self.client.publish(
-                f"yutampo/climate/{device_id}/operation_label",
-                operation_label,
-                retain=True,
-            )
+        """Publie l'état d'un climate. Si `fields` est fourni, seuls ces champs
+        sont publiés sur leur topic dédié ; l'état global JSON est toujours complet.
+        `pending` signale une commande envoyée mais pas encore rapportée par l'appareil."""
+        values = {
+            "temperature": temperature,
+            "current_temperature": current_temperature,
+            "mode": mode,
+            "action": action,
+            "operation_label": operation_label,
+        }
+        topics = {
+            "temperature": f"yutampo/climate/{device_id}/temperature_state",
+            "current_temperature": f"yutampo/climate/{device_id}/current_temperature",
+            "mode": f"yutampo/climate/{device_id}/mode",
+            "action": f"yutampo/climate/{device_id}/hvac_action",
+            "operation_label": f"yutampo/climate/{device_id}/operation_label",
+        }
+        published = {}
+        for field, value in values.items():
+            if value is None or (fields is not None and field not in fields):
+                continue
+            self._publish(topics[field], value, retain=True)
+            published[field] = value
 
         global_state = {
             "mode": mode if mode is not None else "",
@@ -385,16 +557,19 @@ class MqttHandler:
             "action": action if action is not None else "",
             "operation_label": operation_label if operation_label is not None else "",
             "source": source,  # Nouvel attribut pour indiquer la source
+            "pending": pending,
         }
-        self.client.publish(
+        self._publish(
             f"yutampo/climate/{device_id}/state", json.dumps(global_state), retain=True
         )
+        if device_id in self.devices:
+            self.devices[device_id].mark_published({**published, "pending": pending})
         self.logger.info(
-            f"État publié pour {device_id} (source: {source}): {global_state}"
+            f"État publié pour {device_id} (source: {source}, champs: {sorted(published)}): {global_state}"
         )
 
     def publish_availability(self, device_id, state):
-        self.client.publish(
+        self._publish(
             f"yutampo/climate/{device_id}/availability", state, retain=True
         )
         self.logger.debug(f"Disponibilité publiée pour {device_id}: {state}")
@@ -439,10 +614,11 @@ class MqttHandler:
 
     def publish_input_number_state(self, entity_id, value):
         state_topic = f"yutampo/number/{entity_id}/state"
-        self.client.publish(state_topic, str(value), retain=True)
+        self._publish(state_topic, str(value), retain=True)
         self.logger.info(f"État publié pour {entity_id}: {value}")
 
     def disconnect(self):
+        self.command_worker.stop()
         self.client.loop_stop()
         self.client.disconnect()
 
@@ -502,6 +678,46 @@ class MqttHandler:
             payload=FORECAST_UPDATED_PAYLOAD,
         )
 
+        # Capteur du plan de consigne sur 24h (attributs : points de changement)
+        self._publish_discovery(
+            entity_type="sensor",
+            entity_id="yutampo_setpoint_plan",
+            payload=SETPOINT_PLAN_PAYLOAD,
+        )
+
+        # Capteur d'état du disjoncteur CSNet
+        self._publish_discovery(
+            entity_type="sensor",
+            entity_id="yutampo_circuit_state",
+            payload=CIRCUIT_STATE_PAYLOAD,
+            publish_state_func=self.publish_circuit_state,
+            state_args=(
+                (
+                    self.api_client.circuit_breaker.state
+                    if self.api_client
+                    else "closed"
+                ),
+            ),
+        )
+
+        # Capteur de diagnostic de la file de commandes MQTT
+        self._publish_discovery(
+            entity_type="sensor",
+            entity_id="yutampo_command_queue",
+            payload=COMMAND_QUEUE_PAYLOAD,
+            publish_state_func=self.publish_command_queue_metrics,
+            state_args=(self.command_worker.get_metrics(),),
+        )
+
+        # Capteur de latence commande -> état confirmé par l'appareil
+        self._publish_discovery(
+            entity_type="sensor",
+            entity_id="yutampo_command_latency",
+            payload=COMMAND_LATENCY_PAYLOAD,
+            publish_state_func=self.publish_command_latency,
+            state_args=(self.optimistic_state.get_metrics(),),
+        )
+
         # Capteur binaire pour l'état HC/HP (conditionnel)
         if (
             self.automation_handler
@@ -528,7 +744,7 @@ class MqttHandler:
 
     def publish_regulation_state(self, is_automatic):
         """Publie l’état du capteur binaire yutampo_regulation_state."""
-        self.client.publish(
+        self._publish(
             "yutampo/binary_sensor/yutampo_regulation_state/state",
             "true" if is_automatic else "false",
             retain=True,
@@ -537,13 +753,13 @@ class MqttHandler:
 
     def publish_sensor_states(self, hottest_hour, hottest_temperature):
         if hottest_hour is not None:
-            self.client.publish(
+            self._publish(
                 "yutampo/sensor/yutampo_hottest_hour/state",
                 str(round(hottest_hour, 2)) if hottest_hour is not None else "unknown",
                 retain=True,
             )
         if hottest_temperature is not None:
-            self.client.publish(
+            self._publish(
                 "yutampo/sensor/yutampo_hottest_temperature/state",
                 (
                     str(hottest_temperature)
@@ -558,7 +774,7 @@ class MqttHandler:
 
     def publish_off_peak_state(self, is_off_peak):
         """Publie l'état HC/HP sur le binary_sensor yutampo_off_peak_state."""
-        self.client.publish(
+        self._publish(
             "yutampo/binary_sensor/yutampo_off_peak_state/state",
             "ON" if is_off_peak else "OFF",
             retain=True,
@@ -568,18 +784,74 @@ class MqttHandler:
 
     def publish_target_level(self, level):
         """Publie le niveau de consigne actif (max/eco/min)."""
-        self.client.publish(
+        self._publish(
             "yutampo/sensor/yutampo_target_level/state",
             str(level),
             retain=True,
         )
         self.logger.info(f"Niveau de consigne publié : {level}")
 
+    def publish_setpoint_plan(self, temperature, attributes=None):
+        """Publie la consigne planifiée courante et, si fourni, le plan 24h en attributs."""
+        self._publish(
+            "yutampo/sensor/yutampo_setpoint_plan/state",
+            str(temperature),
+            retain=True,
+        )
+        if attributes is not None:
+            self._publish(
+                "yutampo/sensor/yutampo_setpoint_plan/attributes",
+                json.dumps(attributes),
+                retain=True,
+            )
+            self.logger.info(
+                f"Plan de consigne publié : {len(attributes.get('plan', []))} points de changement"
+            )
+
+    def publish_circuit_state(self, state):
+        """Publie l'état du disjoncteur CSNet (closed/open/half_open)."""
+        self._publish(
+            "yutampo/sensor/yutampo_circuit_state/state",
+            str(state),
+            retain=True,
+        )
+        self.logger.info(f"État du disjoncteur CSNet publié : {state}")
+
+    def publish_command_queue_metrics(self, metrics):
+        """Publie la profondeur de la file de commandes et ses compteurs de saturation en attributs."""
+        self._publish(
+            "yutampo/sensor/yutampo_command_queue/state",
+            str(metrics["depth"]),
+            retain=True,
+        )
+        attributes = {name: metrics[name] for name in self.COMMAND_QUEUE_ATTRIBUTES}
+        self._publish(
+            "yutampo/sensor/yutampo_command_queue/attributes",
+            json.dumps(attributes),
+            retain=True,
+        )
+        self.logger.debug(f"Métriques de la file de commandes publiées : {metrics}")
+
+    def publish_command_latency(self, metrics):
+        """Publie la dernière latence de confirmation d'une commande et ses compteurs en attributs."""
+        latency = metrics["last_latency"]
+        self._publish(
+            "yutampo/sensor/yutampo_command_latency/state",
+            str(latency) if latency is not None else "unknown",
+            retain=True,
+        )
+        self._publish(
+            "yutampo/sensor/yutampo_command_latency/attributes",
+            json.dumps(metrics),
+            retain=True,
+        )
+        self.logger.debug(f"Latence de confirmation des commandes publiée : {metrics}")
+
     def publish_forecast_updated(self):
         """Publie l'horodatage de la dernière mise à jour du forecast."""
         from datetime import datetime, timezone
-        now = datetime.now(timezone.utc).isoformat()
-        self.client.publish(
+        now = datetime.fromtimestamp(self.clock.timestamp(), timezone.utc).isoformat()
+        self._publish(
             "yutampo/sensor/yutampo_forecast_updated/state",
             now,
             retain=True,
@@ -1,186 +1,153 @@
 # off_peak_client.py — Écoute l'état d'un binary_sensor HC/HP via WebSocket HA
-# Dépendances : websocket-client, json, threading
+# Dépendances : ha_websocket (session WebSocket partagée), clock
 
+import bisect
 import logging
-import json
-import websocket
-import threading
-import time
+
+from clock import SYSTEM_CLOCK
+from event_bus import OFF_PEAK_CHANGED
+from metrics import OFF_PEAK_TRANSITIONS_TOTAL
+
+
+def off_peak_at(schedule, minute):
+    """État HC/HP à une minute de la journée d'après un calendrier
+    ((minute, is_off_peak), ...) trié : celui de la dernière bascule passée."""
+    index = bisect.bisect_right([entry[0] for entry in schedule], minute % (24 * 60))
+    return schedule[index - 1][1]  # index 0 : dernière bascule de la veille
 
 
 class OffPeakClient:
-    """Client WebSocket pour suivre l'état HC/HP d'un binary_sensor HA.
+    """Client pour suivre l'état HC/HP d'un binary_sensor HA.
 
     - is_off_peak() retourne True en heures creuses (binary_sensor = on).
     - Fallback conservateur : False (HP) si déconnecté ou erreur.
-    - Reconnexion automatique avec backoff exponentiel.
+    - Connexion, authentification et reconnexion assurées par la session HaWebSocket partagée.
+    - Les bascules observées (heure de la journée) forment un calendrier
+      quotidien, utilisé pour planifier les niveaux à venir (off_peak_schedule).
     """
 
-    MAX_RECONNECT_DELAY = 300  # 5 minutes max
+    SCHEDULE_MEMORY_SECONDS = 2 * 24 * 3600  # Bascule oubliée si non revue depuis
+    TRANSITION_TOLERANCE_MINUTES = 15  # Même bascule revue à quelques minutes près
 
-    def __init__(self, config):
+    def __init__(self, config, ha_ws=None, clock=None):
         self.logger = logging.getLogger("Yutampo_ha_addon")
+        self.clock = clock or SYSTEM_CLOCK
         self.entity_id = config.get("off_peak_entity")
-        self.ha_token = config["ha_token"]
-        self.ws_url = "ws://supervisor/core/websocket"
-        self.ws = None
-        self.ws_thread = None
-        self.message_id = 1
-        self.connected = False
+        self.ha_ws = ha_ws
         self._is_off_peak = False
         self._state_received = False
-        self._shutdown_requested = False
-        self._reconnect_delay = 5
+        self._subscription = None
+        self._transitions = {}  # minute de la journée -> (is_off_peak, timestamp)
         self.mqtt_handler = None
+        self.event_bus = None
 
     def start(self):
-        """Démarre la connexion WebSocket et souscrit aux changements d'état."""
+        """Souscrit aux changements d'état via la session WebSocket partagée."""
         if not self.entity_id:
             self.logger.info(
                 "Aucune entité HC/HP configurée, OffPeakClient inactif."
             )
             return
-        self._connect_websocket()
+        self.ha_ws.add_listener(on_disconnected=self._on_disconnected)
+        self._subscribe_entity()
         self.logger.info(
             f"OffPeakClient démarré, surveillance de {self.entity_id}."
         )
 
-    def _connect_websocket(self):
-        try:
-            self.ws = websocket.WebSocketApp(
-                self.ws_url,
-                on_open=self._on_open,
-                on_message=self._on_message,
-                on_error=self._on_error,
-                on_close=self._on_close,
-                header={"Authorization": f"Bearer {self.ha_token}"},
-            )
-            self.ws_thread = threading.Thread(target=self.ws.run_forever)
-            self.ws_thread.daemon = True
-            self.ws_thread.start()
-            self.logger.info("OffPeakClient : connexion WebSocket démarrée.")
-            for _ in range(10):
-                if self.connected:
-                    break
-                time.sleep(0.5)
-        except Exception as e:
-            self.logger.error(
-                f"OffPeakClient : erreur connexion WebSocket : {str(e)}"
-            )
-
-    def _on_open(self, ws):
-        self.connected = True
-        self.message_id = 1
-        self._reconnect_delay = 5  # Reset backoff
-        self.logger.info("OffPeakClient : connexion WebSocket ouverte.")
-
-    def _on_message(self, ws, message):
-        try:
-            data = json.loads(message)
-            msg_type = data.get("type")
-
-            if msg_type == "auth_required":
-                ws.send(json.dumps({
-                    "type": "auth",
-                    "access_token": self.ha_token,
-                }))
-
-            elif msg_type == "auth_ok":
-                self.logger.info("OffPeakClient : authentification réussie.")
-                self._request_initial_state()
-                self._subscribe_state_changes()
-
-            elif msg_type == "result" and data.get("success"):
-                # Réponse à get_states : extraction de l'état initial
-                result = data.get("result")
-                if isinstance(result, list):
-                    for entity in result:
-                        if entity.get("entity_id") == self.entity_id:
-                            self._update_state(entity.get("state"))
-                            break
-
-            elif msg_type == "event":
-                event_data = data.get("event", {}).get("data", {})
-                entity_id = event_data.get("entity_id")
-                if entity_id == self.entity_id:
-                    new_state = event_data.get("new_state", {}).get("state")
-                    self._update_state(new_state)
-
-        except Exception as e:
-            self.logger.error(
-                f"OffPeakClient : erreur traitement message : {str(e)}"
-            )
-
-    def _on_error(self, ws, error):
-        self.connected = False
-        self._is_off_peak = False  # Fallback conservateur → HP
-        self.logger.error(f"OffPeakClient : erreur WebSocket : {str(error)}")
-        self._reconnect()
-
-    def _on_close(self, ws, close_status_code, close_msg):
-        self.connected = False
+    def _on_disconnected(self):
+        previous = self._is_off_peak
         self._is_off_peak = False  # Fallback conservateur → HP
-        self.logger.info(
-            f"OffPeakClient : WebSocket fermée : {close_status_code} - {close_msg}"
+        self._state_received = False  # L'état renvoyé à la reconnexion n'est pas une bascule
+        self.logger.info("OffPeakClient : WebSocket déconnectée, repli sur HP.")
+        if previous:
+            if self.mqtt_handler:
+                self.mqtt_handler.publish_off_peak_state(False)
+            if self.event_bus:
+                self.event_bus.publish(OFF_PEAK_CHANGED, is_off_peak=False)
+
+    def _subscribe_entity(self):
+        """Souscrit à la seule entité HC/HP via subscribe_entities.
+
+        Le filtrage est fait côté serveur ; le premier événement contient
+        l'état courant (pas besoin de get_states).
+        """
+        self._subscription = self.ha_ws.subscribe(
+            {"type": "subscribe_entities", "entity_ids": [self.entity_id]},
+            on_event=self._on_entities_event,
         )
-        self._reconnect()
 
-    def _reconnect(self):
-        """Reconnexion avec backoff exponentiel (5s, 10s, 20s... max 300s)."""
-        if self._shutdown_requested:
+    def _on_entities_event(self, event):
+        # Format compressé HA : "a" = états complets, "c" = différences, "r" = suppressions
+        added = event.get("a", {}).get(self.entity_id)
+        if added is not None:
+            self._update_state(added.get("s"))
             return
-        delay = self._reconnect_delay
-        self._reconnect_delay = min(delay * 2, self.MAX_RECONNECT_DELAY)
-        self.logger.info(
-            f"OffPeakClient : reconnexion dans {delay}s..."
-        )
-
-        def _do_reconnect():
-            time.sleep(delay)
-            if not self._shutdown_requested:
-                self._connect_websocket()
-
-        t = threading.Thread(target=_do_reconnect)
-        t.daemon = True
-        t.start()
-
-    def _request_initial_state(self):
-        """Récupère l'état initial via get_states."""
-        request = {
-            "id": self.message_id,
-            "type": "get_states",
-        }
-        self.ws.send(json.dumps(request))
-        self.message_id += 1
-
-    def _subscribe_state_changes(self):
-        """Souscrit aux changements d'état via state_changed."""
-        request = {
-            "id": self.message_id,
-            "type": "subscribe_events",
-            "event_type": "state_changed",
-        }
-        self.ws.send(json.dumps(request))
-        self.message_id += 1
+        changed = event.get("c", {}).get(self.entity_id)
+        if changed is not None and "s" in changed.get("+", {}):
+            self._update_state(changed["+"]["s"])
+            return
+        if self.entity_id in event.get("r", []):
+            self.logger.warning(f"OffPeakClient : entité {self.entity_id} supprimée.")
+            self._update_state(None)
 
     def _update_state(self, state):
         """Met à jour l'état HC/HP et publie sur MQTT si disponible."""
         previous = self._is_off_peak
+        was_received = self._state_received
         self._is_off_peak = (state == "on")
         self._state_received = True
 
         label = "HC (off-peak)" if self._is_off_peak else "HP (peak)"
         self.logger.info(f"OffPeakClient : état mis à jour → {label}")
 
-        if self._is_off_peak != previous and self.mqtt_handler:
-            self.mqtt_handler.publish_off_peak_state(self._is_off_peak)
+        if self._is_off_peak != previous:
+            if was_received and state is not None:
+                self._record_transition(self._is_off_peak)
+            OFF_PEAK_TRANSITIONS_TOTAL.inc(state="off_peak" if self._is_off_peak else "peak")
+            if self.mqtt_handler:
+                self.mqtt_handler.publish_off_peak_state(self._is_off_peak)
+            if self.event_bus:
+                self.event_bus.publish(OFF_PEAK_CHANGED, is_off_peak=self._is_off_peak)
+
+    def _record_transition(self, is_off_peak):
+        now = self.clock.now()
+        minute = now.hour * 60 + now.minute
+        tolerance = self.TRANSITION_TOLERANCE_MINUTES
+        for known in list(self._transitions):
+            distance = abs(known - minute)
+            if min(distance, 24 * 60 - distance) <= tolerance:
+                del self._transitions[known]
+        self._transitions[minute] = (is_off_peak, self.clock.timestamp())
+
+    def off_peak_schedule(self):
+        """Calendrier HC/HP observé ((minute, is_off_peak), ...), vide tant
+        qu'une bascule de chaque sens n'a pas été vue (ou s'il contredit l'état
+        courant, par exemple après un changement d'horaires)."""
+        horizon = self.clock.timestamp() - self.SCHEDULE_MEMORY_SECONDS
+        for minute, (_, seen_at) in list(self._transitions.items()):
+            if seen_at < horizon:
+                del self._transitions[minute]
+        schedule = tuple(
+            (minute, state) for minute, (state, _) in sorted(self._transitions.items())
+        )
+        if len({state for _, state in schedule}) < 2:
+            return ()
+        now = self.clock.now()
+        minute = now.hour * 60 + now.minute
+        tolerance = self.TRANSITION_TOLERANCE_MINUTES
+        if all(
+            off_peak_at(schedule, minute + offset) != self._is_off_peak
+            for offset in (-tolerance, 0, tolerance)
+        ):
+            return ()
+        return schedule
 
     def is_off_peak(self):
         """Retourne True si HC, False si HP. Fallback : False (conservateur)."""
         return self._is_off_peak
 
     def shutdown(self):
-        self._shutdown_requested = True
-        if self.ws:
-            self.ws.close()
+        if self._subscription is not None:
+            self.ha_ws.unsubscribe(self._subscription)
+            self._subscription = None
         self.logger.info("OffPeakClient arrêté.")
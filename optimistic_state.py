@@ -0,0 +1,279 @@
+# optimistic_state.py — État optimiste des commandes climate et confirmation par poll
+# Dépendances : clock, metrics, threading
+
+import logging
+import threading
+
+from clock import SYSTEM_CLOCK
+from metrics import COMMAND_CONFIRM_SECONDS, COMMAND_OUTCOMES_TOTAL
+
+
+class _PendingCommand:
+    """Commande acceptée (ou en cours d'envoi) dont l'effet n'est pas encore rapporté."""
+
+    def __init__(self, fields, previous, source, started_at):
+        self.fields = fields  # {"temperature": °C, "mode": "heat"/"off"} attendus
+        self.previous = previous  # Valeurs confirmées avant la commande (rollback)
+        self.source = source
+        self.started_at = started_at
+        self.accepted_at = None
+        self.retries = 0
+
+
+class OptimisticState:
+    """Couche d'état optimiste devant set_heat_setting.
+
+    - apply() publie immédiatement la valeur demandée avec `pending: true`,
+      envoie la commande puis demande un poll de confirmation CONFIRM_DELAY_SECONDS
+      plus tard ; un refus de CSNet restaure aussitôt l'état précédent.
+    - reconcile() est appelé à chaque poll : tant que l'appareil ne rapporte pas
+      la valeur attendue, elle est maintenue ; après CONFIRM_TIMEOUT_SECONDS la
+      commande est renvoyée (MAX_RETRIES fois) puis abandonnée au profit de l'état
+      rapporté (rollback).
+    - La latence commande → état confirmé est publiée sur un capteur dédié.
+    """
+
+    CONFIRM_DELAY_SECONDS = 5
+    CONFIRM_TIMEOUT_SECONDS = 180
+    MAX_RETRIES = 1
+
+    def __init__(self, api_client, mqtt_handler, clock=None):
+        self.logger = logging.getLogger("Yutampo_ha_addon")
+        self.api_client = api_client
+        self.mqtt_handler = mqtt_handler
+        self.clock = clock or SYSTEM_CLOCK
+        self.request_poll = None  # (délai en s) -> None, fourni par le Scheduler
+        self._pending = {}  # device.id -> _PendingCommand
+        self._lock = threading.Lock()
+        self.confirmed_count = 0
+        self.retried_count = 0
+        self.rolled_back_count = 0
+        self.last_latency = None
+        self.max_latency = 0.0
+        self._total_latency = 0.0
+
+    def apply(self, device, source, mode=None, setting_temperature=None):
+        """Publie l'état demandé puis envoie la commande. Retourne le résultat de l'envoi."""
+        fields = {}
+        if setting_temperature is not None:
+            fields["temperature"] = self._temperature(setting_temperature)
+        if mode is not None:
+            fields["mode"] = mode
+        if not fields:
+            return True
+
+        with self._lock:
+            pending = self._pending.get(device.id)
+            if pending is None:
+                if self._matches(fields, device):
+                    pending = False  # Déjà l'état rapporté : rien à confirmer
+                else:
+                    previous = {
+                        "temperature": device.setting_temperature,
+                        "mode": device.mode,
+                    }
+                    pending = _PendingCommand({}, previous, source, self.clock.monotonic())
+                    self._pending[device.id] = pending
+            elif all(pending.fields.get(field) == value for field, value in fields.items()):
+                return True  # Déjà envoyée, confirmation en cours
+            if pending:
+                pending.fields.update(fields)
+                pending.source = source
+                expected = dict(pending.fields)
+        if not pending:
+            return self._send(device, fields)  # La file ignore le no-op
+
+        self._set_device(device, expected)
+        self._publish(device, source, pending=True)
+
+        if not self._send(device, expected):
+            self.logger.error(
+                f"Commande refusée pour {device.id} ({expected}), retour à l'état précédent."
+            )
+            self._rollback(device)
+            return False
+
+        with self._lock:
+            if self._pending.get(device.id) is pending:
+                pending.accepted_at = self.clock.monotonic()
+        if self.request_poll:
+            self.request_poll(self.CONFIRM_DELAY_SECONDS)
+        return True
+
+    def is_pending(self, device_id):
+        with self._lock:
+            return device_id in self._pending
+
+    def has_pending(self):
+        with self._lock:
+            return bool(self._pending)
+
+    def reconcile(self, device, element):
+        """Retourne l'élément à appliquer au Device : les champs en attente
+        gardent leur valeur optimiste tant que l'appareil ne les a pas rapportés."""
+        with self._lock:
+            pending = self._pending.get(device.id)
+            if pending is None:
+                return element
+            expected = dict(pending.fields)
+            if pending.accepted_at is None:
+                # Commande encore en cours d'envoi : l'état rapporté la précède
+                return self._hold(element, expected)
+            waited = self.clock.monotonic() - pending.accepted_at
+
+        reported = self._reported(element)
+        if all(reported.get(field) == value for field, value in expected.items()):
+            self._confirm(device, pending)
+            return element
+
+        if waited < self.CONFIRM_TIMEOUT_SECONDS:
+            self.logger.debug(
+                f"Commande en attente de confirmation pour {device.id} : "
+                f"attendu {expected}, rapporté {reported}"
+            )
+            return self._hold(element, expected)
+
+        with self._lock:
+            retry = pending.retries < self.MAX_RETRIES
+            if retry:
+                pending.retries += 1
+                self.retried_count += 1
+        if retry:
+            COMMAND_OUTCOMES_TOTAL.inc(outcome="retried")
+            self.logger.warning(
+                f"Commande non confirmée après {waited:.0f}s pour {device.id} "
+                f"(attendu {expected}, rapporté {reported}), nouvel envoi."
+            )
+            if self._send(device, expected):
+                with self._lock:
+                    pending.accepted_at = self.clock.monotonic()
+                if self.request_poll:
+                    self.request_poll(self.CONFIRM_DELAY_SECONDS)
+                return self._hold(element, expected)
+
+        self.logger.error(
+            f"Commande non confirmée pour {device.id} (attendu {expected}, "
+            f"rapporté {reported}), état rapporté par l'appareil rétabli."
+        )
+        with self._lock:
+            self._pending.pop(device.id, None)
+            self.rolled_back_count += 1
+        COMMAND_OUTCOMES_TOTAL.inc(outcome="rolled_back")
+        self.publish_metrics()
+        return element
+
+    def _send(self, device, expected):
+        run_stop_dhw = None
+        if "mode" in expected:
+            run_stop_dhw = 1 if expected["mode"] == "heat" else 0
+        return self.api_client.set_heat_setting(
+            device.parent_id,
+            run_stop_dhw=run_stop_dhw,
+            setting_temp_dhw=expected.get("temperature"),
+        )
+
+    @staticmethod
+    def _temperature(value):
+        # CSNet ne reçoit et ne rapporte que des consignes entières
+        # (cf. CommandQueue._normalize) : 49.8 demandé sera confirmé par 49.
+        return float(int(float(value)))
+
+    @classmethod
+    def _matches(cls, fields, device):
+        current = {
+            "temperature": (
+                cls._temperature(device.setting_temperature)
+                if device.setting_temperature is not None
+                else None
+            ),
+            "mode": device.mode,
+        }
+        return all(
+            current[field] is not None and current[field] == value
+            for field, value in fields.items()
+        )
+
+    @classmethod
+    def _reported(cls, element):
+        reported = {"mode": "heat" if element.get("onOff") == 1 else "off"}
+        if element.get("settingTemperature") is not None:
+            reported["temperature"] = cls._temperature(element["settingTemperature"])
+        return reported
+
+    @staticmethod
+    def _hold(element, expected):
+        held = dict(element)
+        if "temperature" in expected:
+            held["settingTemperature"] = expected["temperature"]
+        if "mode" in expected:
+            held["onOff"] = 1 if expected["mode"] == "heat" else 0
+        return held
+
+    @staticmethod
+    def _set_device(device, values):
+        if "temperature" in values:
+            device.setting_temperature = values["temperature"]
+        if "mode" in values:
+            device.mode = values["mode"]
+
+    def _confirm(self, device, pending):
+        with self._lock:
+            if self._pending.get(device.id) is not pending:
+                return
+            del self._pending[device.id]
+            latency = self.clock.monotonic() - pending.started_at
+            self.confirmed_count += 1
+            self.last_latency = latency
+            self.max_latency = max(self.max_latency, latency)
+            self._total_latency += latency
+        COMMAND_CONFIRM_SECONDS.observe(latency)
+        COMMAND_OUTCOMES_TOTAL.inc(outcome="confirmed")
+        self.logger.info(
+            f"Commande confirmée par l'appareil {device.id} en {latency:.1f}s : {pending.fields}"
+        )
+        self._publish(device, pending.source, pending=False)
+        self.publish_metrics()
+
+    def _rollback(self, device):
+        with self._lock:
+            pending = self._pending.pop(device.id, None)
+            if pending is None:
+                return
+            self.rolled_back_count += 1
+        self._set_device(device, pending.previous)
+        self._publish(device, pending.source, pending=False)
+        COMMAND_OUTCOMES_TOTAL.inc(outcome="rolled_back")
+        self.publish_metrics()
+
+    def _publish(self, device, source, pending):
+        self.mqtt_handler.publish_state(
+            device.id,
+            device.setting_temperature,
+            device.current_temperature,
+            device.mode,
+            device.action,
+            device.operation_label,
+            source=source,
+            pending=pending,
+        )
+
+    def get_metrics(self):
+        with self._lock:
+            return {
+                "pending": len(self._pending),
+                "confirmed": self.confirmed_count,
+                "retried": self.retried_count,
+                "rolled_back": self.rolled_back_count,
+                "last_latency": (
+                    round(self.last_latency, 1) if self.last_latency is not None else None
+                ),
+                "avg_latency": (
+                    round(self._total_latency / self.confirmed_count, 1)
+                    if self.confirmed_count
+                    else None
+                ),
+                "max_latency": round(self.max_latency, 1),
+            }
+
+    def publish_metrics(self):
+        self.mqtt_handler.publish_command_latency(self.get_metrics())
@@ -0,0 +1,248 @@
+# polling_policy.py — Intervalle de polling CSNet adapté à l'activité du ballon
+# Dépendances : collections, math, statistics, clock
+
+import logging
+import math
+import statistics
+from collections import deque
+
+from clock import SYSTEM_CLOCK
+
+
+class CloudSyncTracker:
+    """Suit les remontées de l'appareil vers le cloud (device_status[].lastComm).
+
+    - La période est estimée sur les derniers écarts entre lastComm distincts ;
+      un écart couvrant plusieurs remontées manquées est ramené à la période.
+    - Le décalage entre l'heure serveur (currentTimeMillis) et l'horloge locale
+      permet de prédire localement la prochaine remontée.
+    """
+
+    MAX_SAMPLES = 8
+    MIN_PERIOD = 10  # Écart minimal retenu entre deux remontées (s)
+
+    def __init__(self, clock=None):
+        self.clock = clock or SYSTEM_CLOCK
+        self._devices = {}  # id -> {"last_comm": s, "deltas": deque}
+        self.offset = 0.0  # Heure serveur - heure locale (s)
+        self.last_staleness = None  # Âge de la dernière remontée au moment du poll (s)
+
+    def observe(self, device_status):
+        """Enregistre un poll ; retourne True si au moins un appareil a remonté
+        un nouvel état (ou si lastComm est absent)."""
+        if not device_status:
+            return True
+        fresh = False
+        staleness = []
+        for status in device_status:
+            last_comm = status.get("lastComm")
+            if last_comm is None:
+                return True
+            last_comm /= 1000
+            server_now = status.get("currentTimeMillis")
+            if server_now is not None:
+                self.offset = server_now / 1000 - self.clock.timestamp()
+                staleness.append(max(0.0, server_now / 1000 - last_comm))
+            state = self._devices.setdefault(
+                status.get("id"), {"last_comm": None, "deltas": deque(maxlen=self.MAX_SAMPLES)}
+            )
+            previous = state["last_comm"]
+            if previous is None or last_comm > previous:
+                fresh = True
+                if previous is not None and last_comm - previous >= self.MIN_PERIOD:
+                    state["deltas"].append(last_comm - previous)
+                state["last_comm"] = last_comm
+        if staleness:
+            self.last_staleness = max(staleness)
+        return fresh
+
+    def period(self, device_id):
+        deltas = self._devices.get(device_id, {}).get("deltas")
+        if not deltas:
+            return None
+        shortest = min(deltas)
+        return statistics.median(d / max(1, round(d / shortest)) for d in deltas)
+
+    def next_upload(self, after):
+        """Instant local de la première remontée attendue à partir de `after`
+        (timestamp local), None tant que la période est inconnue."""
+        candidates = []
+        for device_id, state in self._devices.items():
+            period = self.period(device_id)
+            if period is None:
+                continue
+            server_after = after + self.offset
+            cycles = max(0, math.ceil((server_after - state["last_comm"]) / period))
+            candidates.append(state["last_comm"] + cycles * period - self.offset)
+        return min(candidates) if candidates else None
+
+    def known_period(self):
+        periods = [self.period(device_id) for device_id in self._devices]
+        periods = [period for period in periods if period]
+        return min(periods) if periods else None
+
+
+class AdaptivePollingPolicy:
+    """Choisit l'intervalle avant le prochain poll de /data/elements.
+
+    Par ordre de priorité :
+    - échecs : backoff exponentiel depuis l'intervalle de base (comportement historique) ;
+    - commande récente : `min_interval` pendant CONFIRM_WINDOW_SECONDS pour la confirmer ;
+    - chauffe en cours (operationStatus) : moitié de l'intervalle de base ;
+    - ballon au repos et stable depuis STABLE_POLLS polls (réglages inchangés,
+      dérive de température < STABLE_DRIFT) : l'intervalle double à chaque poll
+      stable, jusqu'à `max_interval` ;
+    - sinon : intervalle de base (scan_interval).
+    Le poll n'est jamais planifié au-delà du prochain changement de niveau de la
+    régulation (`edge_source`), et au plus `max_polls_per_hour` polls sont faits
+    par heure glissante. Le résultat est borné à [min_interval, max_interval],
+    puis repoussé SYNC_LAG_SECONDS après la remontée cloud attendue suivante,
+    sans dépasser `max_interval` ni le prochain changement de niveau.
+    """
+
+    CONFIRM_WINDOW_SECONDS = 180  # Polling rapide après une commande acceptée
+    STABLE_POLLS = 3  # Polls au repos inchangés avant ralentissement
+    STABLE_DRIFT = 1.0  # Dérive de température tolérée au repos (°C)
+    MAX_BACKOFF_EXPONENT = 4
+    SYNC_LAG_SECONDS = 5  # Marge après la remontée attendue de l'appareil
+
+    def __init__(
+        self,
+        base_interval=60,
+        min_interval=60,
+        max_interval=1200,
+        max_polls_per_hour=None,
+        clock=None,
+    ):
+        self.logger = logging.getLogger("Yutampo_ha_addon")
+        self.clock = clock or SYSTEM_CLOCK
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.max_polls_per_hour = max_polls_per_hour
+        self.base_interval = base_interval
+        self.edge_source = None  # () -> secondes avant le prochain changement de niveau, ou None
+        self._last_command_at = None
+        self._heating = False
+        self._stable_polls = 0
+        self._last_signature = None
+        self._reference_temperatures = None  # Températures en début de période stable
+        self._polls = deque()  # Horodatages des polls de l'heure glissante
+        self.sync = CloudSyncTracker(clock=self.clock)
+        self.last_reason = None
+        self.throttled_count = 0
+
+    def record_poll(self):
+        """À appeler à chaque poll, réussi ou non (budget horaire)."""
+        self._polls.append(self.clock.monotonic())
+        self._prune()
+
+    def _prune(self):
+        now = self.clock.monotonic()
+        while self._polls and now - self._polls[0] >= 3600:
+            self._polls.popleft()
+
+    def note_command(self):
+        """Une commande vient d'être acceptée : son effet est à confirmer."""
+        self._last_command_at = self.clock.monotonic()
+        self._stable_polls = 0
+
+    def observe(self, devices):
+        """Met à jour l'activité à partir de l'état rapporté par le dernier poll."""
+        self._heating = any(device.action == "heating" for device in devices)
+        signature = tuple(
+            (device.setting_temperature, device.mode, device.action) for device in devices
+        )
+        temperatures = [device.current_temperature for device in devices]
+        if (
+            not self._heating
+            and signature == self._last_signature
+            and self._within_drift(temperatures)
+        ):
+            self._stable_polls += 1
+        else:
+            self._stable_polls = 0
+            self._reference_temperatures = temperatures
+        self._last_signature = signature
+
+    def _within_drift(self, temperatures):
+        if self._reference_temperatures is None:
+            return False
+        return all(
+            current is not None
+            and reference is not None
+            and abs(current - reference) < self.STABLE_DRIFT
+            for current, reference in zip(temperatures, self._reference_temperatures)
+        )
+
+    def confirming(self):
+        return (
+            self._last_command_at is not None
+            and self.clock.monotonic() - self._last_command_at < self.CONFIRM_WINDOW_SECONDS
+        )
+
+    def next_interval(self, failures=0):
+        """Secondes avant le prochain poll ; la raison est gardée dans last_reason."""
+        if failures:
+            exponent = min(failures, self.MAX_BACKOFF_EXPONENT)
+            interval, reason = self.base_interval * (2 ** exponent), "backoff"
+        elif self.confirming():
+            interval, reason = self.min_interval, "confirmation"
+        elif self._heating:
+            interval, reason = self.base_interval / 2, "heating"
+        elif self._stable_polls >= self.STABLE_POLLS:
+            exponent = min(self._stable_polls - self.STABLE_POLLS + 1, self.MAX_BACKOFF_EXPONENT)
+            interval, reason = self.base_interval * (2 ** exponent), "idle"
+        else:
+            interval, reason = self.base_interval, "base"
+
+        edge = self._seconds_to_edge()
+        if edge is not None and not failures and edge < interval:
+            # Avoir un état frais quand la régulation change de niveau
+            interval, reason = edge, "window_edge"
+
+        interval = max(self.min_interval, min(self.max_interval, interval))
+
+        wait = self.budget_wait()
+        if wait > interval:
+            self.throttled_count += 1
+            self.logger.debug(
+                f"Budget de {self.max_polls_per_hour} polls/h atteint, prochain poll dans {wait:.0f}s"
+            )
+            interval, reason = wait, "budget"
+
+        self.last_reason = reason
+        # L'alignement ne franchit ni max_interval ni le prochain bord de fenêtre
+        ceiling = self.max_interval
+        if edge is not None and not failures:
+            ceiling = min(ceiling, edge)
+        return min(self._align(interval), max(interval, ceiling))
+
+    def _align(self, interval):
+        """Repousse le poll juste après la première remontée attendue à partir
+        de l'échéance : l'intervalle ne raccourcit jamais (bornes et budget tenus).
+        Un intervalle plus court que la période estimée n'est pas aligné : la
+        période n'a peut-être été mesurée qu'en multiples de la vraie cadence."""
+        period = self.sync.known_period()
+        if period is None or interval < period:
+            return interval
+        now = self.clock.timestamp()
+        upload = self.sync.next_upload(now + interval - self.SYNC_LAG_SECONDS)
+        return upload + self.SYNC_LAG_SECONDS - now
+
+    def _seconds_to_edge(self):
+        if not self.edge_source:
+            return None
+        try:
+            return self.edge_source()
+        except Exception as e:
+            self.logger.error(f"Erreur lors du calcul du prochain changement de niveau : {str(e)}")
+            return None
+
+    def budget_wait(self):
+        """Attente nécessaire pour rester dans le budget horaire (0 si disponible) ;
+        s'applique aussi aux polls de confirmation demandés hors politique."""
+        self._prune()
+        if not self.max_polls_per_hour or len(self._polls) < self.max_polls_per_hour:
+            return 0
+        oldest = self._polls[-self.max_polls_per_hour]
+        return max(0.0, oldest + 3600 - self.clock.monotonic())
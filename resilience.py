@@ -0,0 +1,111 @@
+# resilience.py — Politique de retry et disjoncteur pour les appels CSNet
+# Dépendances : random, threading, time
+
+import logging
+import random
+import threading
+
+from clock import SYSTEM_CLOCK
+
+
+class RetryPolicy:
+    """Retry avec backoff exponentiel et jitter complet.
+
+    Le délai avant la tentative n+1 est tiré uniformément dans
+    [0, min(max_delay, base_delay * 2^(n-1))] pour éviter que des échecs
+    simultanés ne se resynchronisent.
+    """
+
+    def __init__(self, max_attempts=3, base_delay=2.0, max_delay=30.0, clock=None):
+        self.clock = clock or SYSTEM_CLOCK
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def backoff(self, attempt):
+        """Délai (secondes) à attendre après l'échec de la tentative `attempt` (1-based)."""
+        ceiling = min(self.max_delay, self.base_delay * (2 ** (attempt - 1)))
+        return random.uniform(0, ceiling)
+
+    def wait(self, attempt):
+        delay = self.backoff(attempt)
+        logging.getLogger("Yutampo_ha_addon").debug(
+            f"Nouvelle tentative dans {delay:.1f}s (backoff après tentative {attempt})"
+        )
+        self.clock.sleep(delay)
+
+
+class CircuitBreaker:
+    """Disjoncteur à trois états devant l'API CSNet.
+
+    - closed : les appels passent ; `failure_threshold` échecs consécutifs ouvrent le circuit.
+    - open : les appels sont refusés sans trafic réseau pendant `recovery_timeout` secondes.
+    - half_open : un seul appel de sonde est autorisé ; son succès referme le
+      circuit, son échec le rouvre pour une nouvelle période.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self, failure_threshold=3, recovery_timeout=600, on_state_change=None, clock=None
+    ):
+        self.logger = logging.getLogger("Yutampo_ha_addon")
+        self.clock = clock or SYSTEM_CLOCK
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.on_state_change = on_state_change
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = None
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        return self._state
+
+    def allow_request(self):
+        """Retourne True si un appel peut être tenté maintenant."""
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN:
+                if self.clock.monotonic() - self._opened_at < self.recovery_timeout:
+                    return False
+                self._set_state(self.HALF_OPEN)
+            if self._probe_in_flight:
+                return False
+            self._probe_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._probe_in_flight = False
+            if self._state != self.CLOSED:
+                self._set_state(self.CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probe_in_flight = False
+            if self._state == self.HALF_OPEN or (
+                self._state == self.CLOSED and self._failures >= self.failure_threshold
+            ):
+                self._opened_at = self.clock.monotonic()
+                self._set_state(self.OPEN)
+
+    def _set_state(self, state):
+        previous, self._state = self._state, state
+        self.logger.warning(
+            f"Disjoncteur CSNet : {previous} -> {state} (échecs consécutifs : {self._failures})"
+        )
+        if self.on_state_change:
+            try:
+                self.on_state_change(state)
+            except Exception as e:
+                self.logger.error(
+                    f"Erreur lors de la notification d'état du disjoncteur : {str(e)}"
+                )
@@ -1,59 +1,149 @@
-from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.interval import IntervalTrigger
-from datetime import datetime, timedelta
+from clock import SYSTEM_CLOCK, remove_job
+from datetime import timedelta
+from metrics import (
+    POLL_INTERVAL_SECONDS,
+    POLL_STALENESS_SECONDS,
+    POLLS_SCHEDULED_TOTAL,
+    POLLS_UNCHANGED_TOTAL,
+)
+from polling_policy import AdaptivePollingPolicy
 import logging
 import os
 import sys
+import threading
 
 
 class Scheduler:
-    def __init__(self, api_client, mqtt_handler):
+    POLL_JOB_ID = "csnet_poll"
+
+    def __init__(
+        self, api_client, mqtt_handler, clock=None, scheduler=None, polling_policy=None
+    ):
         self.logger = logging.getLogger("Yutampo_ha_addon")
         self.api_client = api_client
         self.mqtt_handler = mqtt_handler
-        self.scheduler = BackgroundScheduler()
+        self.clock = clock or SYSTEM_CLOCK
+        # Ordonnanceur partagé fourni par l'addon, ou propre à ce composant
+        self._owns_scheduler = scheduler is None
+        self.scheduler = scheduler or self.clock.create_scheduler()
         self.devices = []
         self.failure_count = {}
         self.last_success_time = None
-        self.base_interval = 60
-        self.max_interval = 1200
+        self.polling_policy = polling_policy or AdaptivePollingPolicy(clock=self.clock)
+        self._next_poll_at = None
+        self._schedule_lock = threading.Lock()
+        self.optimistic_state = None  # Réconciliation des commandes en attente (OptimisticState)
 
     def schedule_updates(self, devices, interval=60):
         self.devices = devices
-        self.base_interval = interval
+        self.polling_policy.base_interval = interval
         for device in self.devices:
             self.failure_count[device.id] = 0
-        self.last_success_time = datetime.now()
+        self.last_success_time = self.clock.now()
         self._schedule_next_update()
-        self.scheduler.start()
+        if self._owns_scheduler:
+            self.scheduler.start()
 
     def _schedule_next_update(self):
         max_failures = max(self.failure_count.values()) if self.failure_count else 0
-        interval = self.base_interval * (2 ** min(max_failures, 4))
-        interval = min(interval, self.max_interval)
+        interval = self.polling_policy.next_interval(max_failures)
+        reason = self.polling_policy.last_reason
+        confirmation = self._confirmation_interval()
+        if not max_failures and confirmation is not None and confirmation < interval:
+            interval, reason = confirmation, "pending_command"
         self.logger.debug(
-            f"Planification prochaine mise à jour dans {interval} secondes (échecs max: {max_failures})"
+            f"Planification prochaine mise à jour dans {interval:.0f} secondes ({reason}, échecs max: {max_failures})"
         )
+        POLL_INTERVAL_SECONDS.set(interval)
+        POLLS_SCHEDULED_TOTAL.inc(reason=reason)
+        self._schedule_poll(interval)
+
+    def _schedule_poll(self, interval):
+        # Le trigger interval reste un filet de sécurité si un poll échoue sans replanifier
+        with self._schedule_lock:
+            self._next_poll_at = self.clock.timestamp() + interval
+            self.scheduler.add_job(
+                self._update_data,
+                trigger=IntervalTrigger(seconds=interval),
+                next_run_time=self.clock.now() + timedelta(seconds=interval),
+                id=self.POLL_JOB_ID,
+                replace_existing=True,
+            )
 
-        self.scheduler.add_job(
-            self._update_data,
-            trigger=IntervalTrigger(seconds=interval),
-            next_run_time=datetime.now() + timedelta(seconds=interval),
+    def _confirmation_interval(self):
+        """Tant qu'une commande attend sa confirmation, poll juste après la
+        prochaine remontée attendue de l'appareil (None sinon)."""
+        if not self.optimistic_state or not self.optimistic_state.has_pending():
+            return None
+        now = self.clock.timestamp()
+        upload = self.polling_policy.sync.next_upload(now)
+        if upload is None:
+            return None
+        lag = self.polling_policy.SYNC_LAG_SECONDS
+        return max(
+            self.optimistic_state.CONFIRM_DELAY_SECONDS,
+            upload + lag - now,
+            self.polling_policy.budget_wait(),
         )
 
+    def on_command_sent(self, event, data):
+        """Une commande a été acceptée : avance le prochain poll pour la confirmer."""
+        self.polling_policy.note_command()
+        if self._next_poll_at is None:
+            return
+        interval = self.polling_policy.next_interval()
+        if self.clock.timestamp() + interval < self._next_poll_at:
+            self.logger.debug(f"Commande envoyée, prochain poll avancé à {interval:.0f}s.")
+            self._schedule_poll(interval)
+
+    def request_poll(self, delay):
+        """Poll de confirmation demandé dans `delay` secondes (s'il est plus proche
+        que le poll planifié), hors politique de polling mais dans son budget horaire."""
+        if self._next_poll_at is None:
+            return
+        delay = max(delay, self.polling_policy.budget_wait())
+        if self.clock.timestamp() + delay < self._next_poll_at:
+            self.logger.debug(f"Poll de confirmation planifié dans {delay:.0f}s.")
+            self._schedule_poll(delay)
+
     def _update_data(self):
         self.logger.info("Mise à jour des données...")
+        self.polling_policy.record_poll()
         raw_data = self.api_client.get_raw_data()
         if raw_data and "data" in raw_data and "elements" in raw_data["data"]:
-            self.last_success_time = datetime.now()
+            self.last_success_time = self.clock.now()
+            if not self._has_new_upload(raw_data["data"]):
+                # Données inchangées mais CSNet répond : appareils de nouveau disponibles
+                for device in self.devices:
+                    if self.failure_count.get(device.id, 0) >= 3:
+                        # Rétablit l'état masqué par set_unavailable()
+                        self.mqtt_handler.publish_initial_state(device)
+                    else:
+                        self.mqtt_handler.publish_availability(device.id, "online")
+                    self.failure_count[device.id] = 0
+                self.polling_policy.observe(self.devices)
+                self._schedule_next_update()
+                return
             device_map = {device.id: device for device in self.devices}
             for element in raw_data["data"]["elements"]:
                 device_id = str(element["deviceId"])
                 if device_id in device_map:
                     device = device_map[device_id]
-                    device.update_state(self.mqtt_handler, element)
+                    # État réellement rapporté, avant maintien des valeurs optimistes
+                    self.api_client.confirm_device_state(
+                        device.parent_id,
+                        run_stop_dhw=1 if element.get("onOff") == 1 else 0,
+                        setting_temp_dhw=element.get("settingTemperature"),
+                    )
+                    pending = False
+                    if self.optimistic_state:
+                        element = self.optimistic_state.reconcile(device, element)
+                        pending = self.optimistic_state.is_pending(device.id)
+                    device.update_state(self.mqtt_handler, element, pending=pending)
                     self.mqtt_handler.publish_availability(device.id, "online")
                     self.failure_count[device.id] = 0
+            self.polling_policy.observe(self.devices)
             self.logger.info("Mise à jour réussie.")
         else:
             self.logger.warning("Échec de la récupération des données.")
@@ -68,7 +158,7 @@ class Scheduler:
                 )
 
             if self.last_success_time and (
-                datetime.now() - self.last_success_time
+                self.clock.now() - self.last_success_time
             ) > timedelta(hours=1):
                 self.logger.error(
                     "Échec persistant depuis plus d'une heure. Redémarrage de l'addon..."
@@ -76,8 +166,26 @@ class Scheduler:
                 self.shutdown()
                 os.execv(sys.executable, [sys.executable] + sys.argv)
 
-        self.scheduler.remove_all_jobs()
         self._schedule_next_update()
 
+    def _has_new_upload(self, data):
+        """False si l'appareil n'a rien remonté depuis le poll précédent (lastComm
+        inchangé) : les données sont identiques, leur traitement est inutile.
+        Une commande récente ou en attente de confirmation force le traitement."""
+        sync = self.polling_policy.sync
+        fresh = sync.observe(data.get("device_status", []))
+        if sync.last_staleness is not None:
+            POLL_STALENESS_SECONDS.observe(sync.last_staleness)
+        if fresh or self.polling_policy.confirming():
+            return True
+        if self.optimistic_state and self.optimistic_state.has_pending():
+            return True
+        POLLS_UNCHANGED_TOTAL.inc()
+        self.logger.debug("lastComm inchangé depuis le dernier poll, traitement ignoré.")
+        return False
+
     def shutdown(self):
-        self.scheduler.shutdown()
+        self._next_poll_at = None
+        remove_job(self.scheduler, self.POLL_JOB_ID)
+        if self._owns_scheduler and self.scheduler.running:
+            self.scheduler.shutdown(wait=False)
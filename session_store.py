@@ -0,0 +1,55 @@
+# session_store.py — Persistance de la session CSNet (cookies + token CSRF) sous /data
+# Dépendances : json, os
+
+import json
+import logging
+import os
+
+from clock import SYSTEM_CLOCK
+
+
+class SessionStore:
+    """Sauvegarde la session CSNet entre deux démarrages de l'addon.
+
+    Le fichier contient des identifiants de session : il est écrit de manière
+    atomique et n'est lisible que par l'utilisateur courant.
+    """
+
+    def __init__(self, path, clock=None):
+        self.logger = logging.getLogger("Yutampo_ha_addon")
+        self.path = path
+        self.clock = clock or SYSTEM_CLOCK
+
+    def load(self):
+        """Retourne {"cookies": [...], "csrf_token": str|None, "saved_at": float} ou None."""
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+            if not isinstance(data, dict) or not data.get("cookies"):
+                return None
+            return data
+        except (OSError, ValueError) as e:
+            self.logger.warning(f"Session CSNet persistée illisible, ignorée : {str(e)}")
+            return None
+
+    def save(self, cookies, csrf_token=None):
+        data = {"cookies": cookies, "csrf_token": csrf_token, "saved_at": self.clock.timestamp()}
+        tmp_path = f"{self.path}.tmp"
+        try:
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.path)
+            self.logger.debug(f"Session CSNet persistée dans {self.path}")
+        except OSError as e:
+            self.logger.warning(f"Impossible de persister la session CSNet : {str(e)}")
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            self.logger.warning(f"Impossible de supprimer la session persistée : {str(e)}")
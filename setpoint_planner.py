@@ -0,0 +1,95 @@
+# setpoint_planner.py — Plan de consigne sur 24h précalculé à la minute
+# Dépendances : array, datetime
+
+from array import array
+from datetime import timedelta
+import logging
+
+
+class SetpointPlan:
+    """Consigne et niveau pour chaque minute de la journée (indexés par heure locale)."""
+
+    MINUTES_PER_DAY = 24 * 60
+
+    def __init__(self, key, temperatures, levels):
+        self.key = key
+        self.temperatures = temperatures
+        self.levels = levels
+
+    @staticmethod
+    def slot_hour(minute):
+        # Même calcul que AutomationHandler._get_current_hour pour une minute donnée
+        return minute // 60 + (minute % 60) / 60.0
+
+    def lookup(self, current_hour):
+        """Retourne (consigne, niveau) pour l'heure décimale donnée."""
+        minute = int(round(current_hour * 60)) % self.MINUTES_PER_DAY
+        return self.temperatures[minute], self.levels[minute]
+
+    def minutes_to_level_change(self, current_hour):
+        """Minutes avant le prochain changement de niveau, None s'il n'y en a
+        aucun sur 24h."""
+        minute = int(round(current_hour * 60)) % self.MINUTES_PER_DAY
+        level = self.levels[minute]
+        for offset in range(1, self.MINUTES_PER_DAY):
+            if self.levels[(minute + offset) % self.MINUTES_PER_DAY] != level:
+                return offset
+        return None
+
+    def to_attributes(self, now, step_minutes=15):
+        """Points de changement des 24 prochaines heures, échantillonnés à
+        `step_minutes`, pour l'attribut MQTT du capteur de plan."""
+        start = now.replace(second=0, microsecond=0)
+        start_minute = start.hour * 60 + start.minute
+        points = []
+        previous = None
+        for offset in range(0, self.MINUTES_PER_DAY, step_minutes):
+            minute = (start_minute + offset) % self.MINUTES_PER_DAY
+            value = (self.temperatures[minute], self.levels[minute])
+            if value != previous:
+                points.append(
+                    {
+                        "time": (start + timedelta(minutes=offset)).isoformat(),
+                        "temperature": value[0],
+                        "level": value[1],
+                    }
+                )
+                previous = value
+        return {"step_minutes": step_minutes, "plan": points}
+
+
+class SetpointPlanner:
+    """Construit le plan de consigne et ne le reconstruit que si une entrée change.
+
+    `resolve_minute(current_hour, *key)` calcule (consigne, niveau) pour une minute ;
+    la clé regroupe toutes les entrées dont dépend le calcul (forecast, HC/HP,
+    amplitude, durée, consigne...). Chaque tick de régulation devient une lecture.
+    """
+
+    def __init__(self, resolve_minute, on_rebuild=None):
+        self.logger = logging.getLogger("Yutampo_ha_addon")
+        self.resolve_minute = resolve_minute
+        self.on_rebuild = on_rebuild
+        self.plan = None
+        self.rebuild_count = 0
+
+    def get(self, key):
+        if self.plan is None or self.plan.key != key:
+            self.plan = self._build(key)
+            self.rebuild_count += 1
+            self.logger.info(f"Plan de consigne recalculé (entrées : {key})")
+            if self.on_rebuild:
+                self.on_rebuild(self.plan)
+        return self.plan
+
+    def invalidate(self):
+        self.plan = None
+
+    def _build(self, key):
+        temperatures = array("d")
+        levels = []
+        for minute in range(SetpointPlan.MINUTES_PER_DAY):
+            temperature, level = self.resolve_minute(SetpointPlan.slot_hour(minute), *key)
+            temperatures.append(temperature)
+            levels.append(level)
+        return SetpointPlan(key, temperatures, levels)
@@ -0,0 +1,436 @@
+# simulation.py — Exécution de l'addon complet sur une horloge virtuelle
+# Dépendances : clock (VirtualClock), yutampo_addon ; aucun accès réseau
+#
+# Usage :
+#   python simulation.py --start 2025-03-30T00:00 --hours 24 --tz Europe/Paris
+
+import argparse
+import json
+import logging
+import math
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from urllib.parse import parse_qsl, urlsplit
+
+from clock import VirtualClock
+from csnet_transport import TransportResponse
+from fake_csnet import FakeCSNet
+from yutampo_addon import YutampoAddon
+
+
+class FakeTransport:
+    """Remplace CSNetTransport : même interface synchrone, servie par FakeCSNet."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.cookies = {}
+        self.request_count = 0
+
+    def request(self, method, url, data=None, headers=None, allow_redirects=True, timeout=None):
+        self.request_count += 1
+        parts = urlsplit(url)
+        params = {**dict(parse_qsl(parts.query)), **(data or {})}
+        status, response_headers, text, set_cookies = self.backend.handle(
+            method, parts.path or "/", params, self.cookies
+        )
+        self.cookies.update(set_cookies)
+        if status == 302 and allow_redirects:
+            return self.request("GET", response_headers["Location"])
+        return TransportResponse(status, response_headers, text, url)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        return self.request("POST", url, data=data, **kwargs)
+
+    def get_cookies(self):
+        return dict(self.cookies)
+
+    def export_cookies(self):
+        return [{"name": k, "value": v, "domain": "", "path": "/"} for k, v in self.cookies.items()]
+
+    def import_cookies(self, cookies, base_url):
+        self.cookies.update({c["name"]: c["value"] for c in cookies})
+
+    def clear_cookies(self):
+        self.cookies.clear()
+
+    def close(self):
+        pass
+
+
+class _MessageInfo:
+    rc = 0
+
+    def wait_for_publish(self, timeout=None):
+        return True
+
+    def is_published(self):
+        return True
+
+
+class FakeMqttClient:
+    """Client paho simulé : acquitte tout immédiatement et garde les derniers messages."""
+
+    def __init__(self):
+        self.on_connect = None
+        self.on_message = None
+        self.messages = {}  # topic -> dernier payload
+        self.publish_count = 0
+
+    def username_pw_set(self, username, password=None):
+        pass
+
+    def will_set(self, topic, payload=None, qos=0, retain=False):
+        pass
+
+    def connect(self, host, port=1883, keepalive=60):
+        pass
+
+    def loop_start(self):
+        self.on_connect(self, None, {}, 0)
+
+    def loop_stop(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def subscribe(self, topic, qos=0):
+        return 0, 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.publish_count += 1
+        self.messages[topic] = payload
+        return _MessageInfo()
+
+
+class FakeHaWebSocket:
+    """Session HA simulée : même interface que HaWebSocket, événements pilotés
+    par le harnais (set_state, push_forecast)."""
+
+    def __init__(self):
+        self.connected = False
+        self.states = {}
+        self.forecast = []
+        self._subscriptions = {}
+        self._next_handle = 1
+        self._listeners = []
+
+    def start(self):
+        self.connected = True
+        for handle in list(self._subscriptions):
+            self._deliver_initial(handle)
+        for on_connected, _ in self._listeners:
+            if on_connected:
+                on_connected()
+
+    def shutdown(self):
+        self.connected = False
+
+    def add_listener(self, on_connected=None, on_disconnected=None):
+        self._listeners.append((on_connected, on_disconnected))
+
+    def subscribe(self, message, on_event, on_result=None):
+        handle = self._next_handle
+        self._next_handle += 1
+        self._subscriptions[handle] = (message, on_event)
+        if self.connected:
+            self._deliver_initial(handle)
+        return handle
+
+    def unsubscribe(self, handle):
+        self._subscriptions.pop(handle, None)
+
+    def send_command(self, message, on_result=None, on_event=None):
+        return None
+
+    def subscription_id(self, handle):
+        return handle if self.connected and handle in self._subscriptions else None
+
+    def subscription_count(self):
+        return len(self._subscriptions) if self.connected else 0
+
+    def _deliver_initial(self, handle):
+        message, on_event = self._subscriptions[handle]
+        if message["type"] == "subscribe_entities":
+            on_event({
+                "a": {
+                    entity: {"s": self.states[entity]}
+                    for entity in message["entity_ids"]
+                    if entity in self.states
+                }
+            })
+        elif message["type"] == "weather/subscribe_forecast" and self.forecast:
+            on_event({"type": "hourly", "forecast": self.forecast})
+
+    def set_state(self, entity_id, state):
+        if self.states.get(entity_id) == state:
+            return
+        self.states[entity_id] = state
+        if not self.connected:
+            return
+        for message, on_event in list(self._subscriptions.values()):
+            if message["type"] == "subscribe_entities" and entity_id in message["entity_ids"]:
+                on_event({"c": {entity_id: {"+": {"s": state}}}})
+
+    def push_forecast(self, forecast):
+        self.forecast = forecast
+        if not self.connected:
+            return
+        for message, on_event in list(self._subscriptions.values()):
+            if message["type"] == "weather/subscribe_forecast":
+                on_event({"type": "hourly", "forecast": forecast})
+
+
+class Simulation:
+    """Fait tourner YutampoAddon sur une VirtualClock, CSNet, MQTT et HA simulés.
+
+    Scénario : prévision sinusoïdale (pic à `peak_hour`) republiée chaque heure,
+    HC/HP selon `off_peak_ranges` (heures décimales locales).
+    """
+
+    DEFAULT_OPTIONS = {
+        "username": "sim",
+        "password": "sim",
+        "mqtt_host": "simulation",
+        "ha_token": "simulation",
+        "scan_interval": 60,
+        "setpoint": 50.0,
+        "regulation_amplitude": 8,
+        "heating_duration_hours": 6.0,
+        "regulation": "gradual",
+        "regulation_priority": "off_peak",
+        "weather_entity": "weather.simulation",
+        "off_peak_entity": "binary_sensor.simulation_hc",
+        "log_level": "WARNING",
+    }
+
+    def __init__(self, start, options=None, off_peak_ranges=((22.0, 6.0),), peak_hour=15.0):
+        self.clock = VirtualClock(start)
+        self.start_time = start
+        self.off_peak_ranges = off_peak_ranges
+        self.peak_hour = peak_hour
+        self._tmpdir = tempfile.TemporaryDirectory(prefix="yutampo-sim-")
+        self.options = {
+            **self.DEFAULT_OPTIONS,
+            "session_store_path": os.path.join(self._tmpdir.name, "session.json"),
+            **(options or {}),
+        }
+        config_path = os.path.join(self._tmpdir.name, "options.json")
+        with open(config_path, "w") as f:
+            json.dump(self.options, f)
+
+        self.addon = YutampoAddon(config_path=config_path, clock=self.clock)
+        self.csnet = FakeCSNet(
+            self.clock, self.options["username"], self.options["password"]
+        )
+        self.mqtt = FakeMqttClient()
+        self.ha = FakeHaWebSocket()
+        self._install_fakes()
+        self._scenario = self.clock.create_scheduler()
+
+    def _install_fakes(self):
+        addon = self.addon
+        addon.api_client.transport.close()
+        addon.api_client.transport = FakeTransport(self.csnet)
+        self.mqtt.on_connect = addon.mqtt_handler._on_connect
+        self.mqtt.on_message = addon.mqtt_handler._on_message
+        addon.mqtt_handler.client = self.mqtt
+        addon.ha_ws = self.ha
+        addon.weather_client.ha_ws = self.ha
+        if addon.off_peak_client:
+            addon.off_peak_client.ha_ws = self.ha
+
+    def _is_off_peak(self, hour):
+        return any(
+            (start <= hour < end) or (start > end and (hour >= start or hour < end))
+            for start, end in self.off_peak_ranges
+        )
+
+    def _update_off_peak(self):
+        entity = self.options.get("off_peak_entity")
+        if entity:
+            now = self.clock.now()
+            state = "on" if self._is_off_peak(now.hour + now.minute / 60.0) else "off"
+            self.ha.set_state(entity, state)
+
+    def _publish_forecast(self):
+        base = self.clock.timestamp() // 3600 * 3600
+        forecast = []
+        for i in range(48):
+            moment = datetime.fromtimestamp(base + i * 3600).astimezone()
+            hour = moment.hour
+            temperature = 12 + 8 * math.cos((hour - self.peak_hour) / 24 * 2 * math.pi)
+            forecast.append(
+                {"datetime": moment.isoformat(), "temperature": round(temperature, 1)}
+            )
+        self.ha.push_forecast(forecast)
+
+    def run(self, hours=24):
+        """Simule `hours` heures et retourne un rapport (durée réelle incluse)."""
+        started = time.perf_counter()
+        self._update_off_peak()
+        self._publish_forecast()
+        self._scenario.add_job(self._update_off_peak, trigger="interval", minutes=1)
+        self._scenario.add_job(self._publish_forecast, trigger="interval", hours=1)
+        self._scenario.start()
+
+        self.addon.start(block=False)
+        self.clock.run_until(self.start_time + timedelta(hours=hours))
+        self.addon.shutdown()
+        self._scenario.shutdown()
+        elapsed = time.perf_counter() - started
+        return self.report(hours, elapsed)
+
+    def report(self, hours, elapsed):
+        return {
+            "simulated_hours": hours,
+            "wall_time_s": round(elapsed, 3),
+            "jobs_executed": self.clock.executed_jobs,
+            "csnet_logins": self.csnet.login_count,
+            "csnet_polls": self.csnet.elements_count,
+            "csnet_commands": [
+                {"time": moment.isoformat(), **fields}
+                for moment, fields in self.csnet.commands
+            ],
+            "mqtt_publishes": self.mqtt.publish_count,
+            "optimistic_state": self.addon.optimistic_state.get_metrics(),
+            "final_tank_temperature": self.csnet.elements[0]["currentTemperature"],
+        }
+
+
+def check_gradual_setpoints_confirmed(start):
+    """Consignes fractionnaires (gradual, priorité météo) : chaque commande
+    envoyée doit être confirmée par le poll suivant, sans renvoi ni rollback."""
+    report = Simulation(
+        start, options={"regulation": "gradual", "regulation_priority": "weather"}
+    ).run(24)
+    commands = report["optimistic_state"]
+    failures = []
+    if commands["confirmed"] == 0:
+        failures.append("aucune commande confirmée")
+    if commands["retried"] or commands["rolled_back"]:
+        failures.append(
+            f"{commands['retried']} renvoi(s), {commands['rolled_back']} rollback(s)"
+        )
+    return failures
+
+
+def check_refused_command_rolled_back(start):
+    """Commandes refusées par CSNet : l'état précédent est republié, sans
+    `pending`, et rien n'est compté comme confirmé."""
+    simulation = Simulation(start)
+    simulation.csnet.reject_commands = True
+    report = simulation.run(2)
+    commands = report["optimistic_state"]
+    failures = []
+    if not simulation.csnet.rejected_commands:
+        failures.append("aucune commande envoyée au CSNet simulé")
+    if commands["rolled_back"] < len(simulation.csnet.rejected_commands):
+        failures.append(
+            f"{commands['rolled_back']} rollback(s) pour "
+            f"{len(simulation.csnet.rejected_commands)} commande(s) refusée(s)"
+        )
+    if commands["confirmed"] or commands["pending"]:
+        failures.append(
+            f"{commands['confirmed']} confirmée(s), {commands['pending']} en attente"
+        )
+    device = simulation.addon.devices[0]
+    state = json.loads(simulation.mqtt.messages[f"yutampo/climate/{device.id}/state"])
+    reported = simulation.csnet.elements[0]["settingTemperature"]
+    if state["pending"] or state["temperature"] != reported:
+        failures.append(f"état publié {state}, consigne de l'appareil {reported}")
+    return failures
+
+
+def check_poll_budget(start, budget=12):
+    """Budget horaire de polls tenu sur toute heure glissante, polls de
+    confirmation des commandes compris (régulation gradual : une commande par heure)."""
+    simulation = Simulation(
+        start,
+        options={
+            "regulation": "gradual",
+            "regulation_priority": "weather",
+            "poll_budget_per_hour": budget,
+        },
+    )
+    simulation.run(24)
+    polls = simulation.csnet.polls
+    worst = max(
+        sum(1 for other in polls if poll <= other < poll + timedelta(hours=1))
+        for poll in polls
+    )
+    if worst > budget:
+        return [f"{worst} polls sur une heure glissante pour un budget de {budget}"]
+    return []
+
+
+CHECKS = [
+    check_gradual_setpoints_confirmed,
+    check_refused_command_rolled_back,
+    check_poll_budget,
+]
+
+
+def run_checks(start):
+    """Exécute les scénarios de CHECKS ; retourne le nombre d'échecs."""
+    logger = logging.getLogger("Yutampo_ha_addon")
+    failed = 0
+    for check in CHECKS:
+        failures = check(start)
+        for failure in failures:
+            logger.error(f"{check.__name__} : {failure}")
+        if failures:
+            failed += 1
+        else:
+            logger.warning(f"{check.__name__} : OK")
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Simulation accélérée de l'addon Yutampo sur une horloge virtuelle."
+    )
+    parser.add_argument("--start", help="Début (ISO, heure locale), défaut : minuit aujourd'hui")
+    parser.add_argument("--hours", type=float, default=24)
+    parser.add_argument("--tz", help="Fuseau horaire, ex. Europe/Paris (changements d'heure)")
+    parser.add_argument("--regulation", choices=["step", "gradual"])
+    parser.add_argument("--priority", choices=["off_peak", "weather"])
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="Exécute les scénarios de non-régression et sort en erreur en cas d'échec",
+    )
+    args = parser.parse_args(argv)
+
+    if args.tz:
+        os.environ["TZ"] = args.tz
+        time.tzset()
+    start = (
+        datetime.fromisoformat(args.start)
+        if args.start
+        else datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    )
+    if args.check:
+        return 1 if run_checks(start) else 0
+
+    options = {}
+    if args.regulation:
+        options["regulation"] = args.regulation
+    if args.priority:
+        options["regulation_priority"] = args.priority
+
+    report = Simulation(start, options=options).run(args.hours)
+    logging.getLogger("Yutampo_ha_addon").warning(
+        f"{args.hours}h simulées en {report['wall_time_s']}s"
+    )
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,10 +1,8 @@
 import logging
-import json
-import websocket
-from datetime import datetime
-from apscheduler.schedulers.background import BackgroundScheduler
-import threading
-import time
+from clock import SYSTEM_CLOCK, remove_job
+from event_bus import FORECAST_UPDATED
+from forecast_curve import ForecastCurve
+from metrics import FORECAST_PARSE_SECONDS
 
 logging.VERBOSE = 5
 logging.addLevelName(logging.VERBOSE, "VERBOSE")
@@ -19,19 +17,23 @@ logging.Logger.verbose = verbose
 
 
 class WeatherClient:
-    def __init__(self, config):
+    FORECAST_REFRESH_MINUTES = 15  # Réévaluation de l'heure la plus chaude (sans trafic)
+    REFRESH_JOB_ID = "forecast_refresh"
+
+    def __init__(self, config, ha_ws=None, clock=None, scheduler=None):
         self.logger = logging.getLogger("Yutampo_ha_addon")
         self.weather_entity = config.get("weather_entity")
-        self.ha_token = config["ha_token"]
         self.default_hottest_hour = config["default_hottest_hour"]
         self.hottest_hour = self.default_hottest_hour
-        self.scheduler = BackgroundScheduler()
-        self.ws_url = "ws://supervisor/core/websocket"
-        self.ws = None
-        self.ws_thread = None
-        self.message_id = 1
-        self.connected = False
+        self.clock = clock or SYSTEM_CLOCK
+        # Ordonnanceur partagé fourni par l'addon, ou propre à ce composant
+        self._owns_scheduler = scheduler is None
+        self.scheduler = scheduler or self.clock.create_scheduler()
+        self.ha_ws = ha_ws
         self.hottest_temperature = None
+        self._subscription = None
+        self.forecast_curve = ForecastCurve()
+        self.event_bus = None
 
     def start(self):
         if not self.weather_entity:
@@ -39,120 +41,101 @@ class WeatherClient:
                 "Aucune entité météo spécifiée, utilisation de default_hottest_hour."
             )
             return
-        self._connect_websocket()
+        self.ha_ws.add_listener(on_disconnected=self._on_disconnected)
+        self._subscribe_forecast()
+        # Les heures passées sortent du forecast : on réévalue périodiquement
+        # à partir de la dernière prévision reçue, sans nouvelle souscription.
         self.scheduler.add_job(
-            self._request_forecast,
+            self._refresh_from_last_forecast,
             trigger="interval",
-            minutes=15,
-            next_run_time=datetime.now(),
+            minutes=self.FORECAST_REFRESH_MINUTES,
+            id=self.REFRESH_JOB_ID,
+            replace_existing=True,
         )
-        self.scheduler.start()
+        if self._owns_scheduler:
+            self.scheduler.start()
         self.logger.info(f"Prévisions météo démarrées pour {self.weather_entity}.")
 
-    def _connect_websocket(self):
-        try:
-            self.ws = websocket.WebSocketApp(
-                self.ws_url,
-                on_open=self._on_open,
-                on_message=self._on_message,
-                on_error=self._on_error,
-                on_close=self._on_close,
-                header={"Authorization": f"Bearer {self.ha_token}"},
-            )
-            self.ws_thread = threading.Thread(target=self.ws.run_forever)
-            self.ws_thread.daemon = True
-            self.ws_thread.start()
-            self.logger.info("Connexion WebSocket démarrée.")
-            for _ in range(10):
-                if self.connected:
-                    break
-                time.sleep(0.5)
-        except Exception as e:
-            self.logger.error(f"Erreur lors de la connexion WebSocket : {str(e)}")
-
-    def _on_open(self, ws):
-        self.connected = True
-        self.logger.info("Connexion WebSocket ouverte.")
-
-    def _on_message(self, ws, message):
-        try:
-            data = json.loads(message)
-            if data.get("type") == "auth_required":
-                ws.send(json.dumps({"type": "auth", "access_token": self.ha_token}))
-            elif data.get("type") == "auth_ok":
-                self.logger.info("Authentification WebSocket réussie.")
-                self._request_forecast()
-            elif data.get("type") == "event" and "forecast" in data.get("event", {}):
-                self._parse_forecast(data["event"]["forecast"])
-        except Exception as e:
-            self.logger.error(
-                f"Erreur lors du traitement du message WebSocket : {str(e)}"
-            )
-
-    def _on_error(self, ws, error):
-        self.connected = False
-        self.logger.error(f"Erreur WebSocket : {str(error)}")
-        self.hottest_hour = self.default_hottest_hour
-
-    def _on_close(self, ws, close_status_code, close_msg):
-        self.connected = False
-        self.logger.info(
-            f"Connexion WebSocket fermée : {close_status_code} - {close_msg}"
-        )
-        self.hottest_hour = self.default_hottest_hour
-
-    def _request_forecast(self):
-        if (
-            not self.connected
-            or not self.ws
-            or not self.ws.sock
-            or not self.ws.sock.connected
-        ):
-            self.logger.warning("WebSocket non connecté, tentative de reconnexion.")
-            self._connect_websocket()
+    def _subscribe_forecast(self):
+        """Souscrit une seule fois ; la session HaWebSocket rejoue la
+        souscription après chaque reconnexion."""
+        if self._subscription is not None:
             return
         request = {
-            "id": self.message_id,
             "type": "weather/subscribe_forecast",
             "entity_id": self.weather_entity,
             "forecast_type": "hourly",
         }
-        self.ws.send(json.dumps(request))
-        self.message_id += 1
+        self._subscription = self.ha_ws.subscribe(
+            request, on_event=self._on_forecast_event
+        )
 
-    def _parse_forecast(self, forecast):
+    def _unsubscribe_forecast(self):
+        if self._subscription is None:
+            return
+        self.ha_ws.unsubscribe(self._subscription)
+        self._subscription = None
+        self.logger.info("Souscription aux prévisions météo résiliée.")
+
+    def live_subscription_count(self):
+        """Nombre de souscriptions forecast actuellement actives côté HA (0 ou 1)."""
+        if self._subscription is None:
+            return 0
+        return 1 if self.ha_ws.subscription_id(self._subscription) is not None else 0
+
+    def _on_disconnected(self):
+        previous = self.hottest_hour
+        self.hottest_hour = self.default_hottest_hour
+        self._notify_if_changed(previous)
+
+    def _notify_if_changed(self, previous_hour):
+        """Signale à la régulation un changement d'heure la plus chaude."""
+        if self.event_bus and self.hottest_hour != previous_hour:
+            self.event_bus.publish(FORECAST_UPDATED, hottest_hour=self.hottest_hour)
+
+    def _on_forecast_event(self, event):
+        if "forecast" in event:
+            with FORECAST_PARSE_SECONDS.time():
+                self._parse_forecast(event["forecast"])
+
+    def _refresh_from_last_forecast(self):
+        self.logger.debug(
+            f"Souscriptions forecast actives : {self.live_subscription_count()}"
+        )
+        if len(self.forecast_curve):
+            self._update_hottest(publish_updated=False)
+
+    def _parse_forecast(self, forecast, publish_updated=True):
         if not forecast:
             self.logger.error("Prévisions vides, utilisation de default_hottest_hour.")
+            previous = self.hottest_hour
             self.hottest_hour = self.default_hottest_hour
             self.hottest_temperature = None
+            self._notify_if_changed(previous)
             return
 
-        now = datetime.now().astimezone()
-        hottest_temp = float("-inf")
-        hottest_hour = self.default_hottest_hour
-        future_count = 0
-
-        for entry in forecast:
-            dt = datetime.strptime(entry["datetime"], "%Y-%m-%dT%H:%M:%S%z")
-            if dt <= now:
-                continue  # Ignorer les heures passées
-            future_count += 1
-            temp = entry.get("temperature", float("-inf"))
-            hour = dt.hour + dt.minute / 60.0
-            if temp > hottest_temp:
-                hottest_temp = temp
-                hottest_hour = hour
-
-        if future_count == 0:
+        changed = self.forecast_curve.update(forecast)
+        self.logger.debug(
+            f"Prévisions intégrées : {changed}/{len(self.forecast_curve)} entrées modifiées."
+        )
+        self._update_hottest(publish_updated)
+
+    def _update_hottest(self, publish_updated=True):
+        """Recalcule l'heure la plus chaude future depuis la courbe en cache."""
+        now = self.clock.timestamp()
+        if self.forecast_curve.count_after(now) == 0:
             self.logger.warning(
                 "Aucune prévision future, conservation de la valeur précédente."
             )
             return
 
-        self.hottest_hour = hottest_hour
-        self.hottest_temperature = (
-            hottest_temp if hottest_temp != float("-inf") else None
-        )
+        previous = self.hottest_hour
+        hottest = self.forecast_curve.hottest(start=now)
+        if hottest is None:
+            self.hottest_hour = self.default_hottest_hour
+            self.hottest_temperature = None
+        else:
+            _, self.hottest_temperature, self.hottest_hour = hottest
 
         self.logger.info(
             f"Heure la plus chaude : {self.hottest_hour:.2f}h, Température : {self.hottest_temperature}°C"
@@ -162,7 +145,20 @@ class WeatherClient:
             self.mqtt_handler.publish_sensor_states(
                 self.hottest_hour, self.hottest_temperature
             )
-            self.mqtt_handler.publish_forecast_updated()
+            if publish_updated:
+                self.mqtt_handler.publish_forecast_updated()
+        self._notify_if_changed(previous)
+
+    def get_hottest_in_window(self, start, end):
+        """Heure et température les plus chaudes prévues dans ]start, end]
+        (datetimes avec fuseau), sans reparser les prévisions.
+
+        Retourne (heure décimale, température) ou (None, None).
+        """
+        hottest = self.forecast_curve.hottest(start.timestamp(), end.timestamp())
+        if hottest is None:
+            return None, None
+        return hottest[2], hottest[1]
 
     def get_hottest_hour(self):
         return self.hottest_hour
@@ -171,7 +167,8 @@ class WeatherClient:
         return self.hottest_temperature
 
     def shutdown(self):
-        self.scheduler.shutdown()
-        if self.ws:
-            self.ws.close()
+        self._unsubscribe_forecast()
+        remove_job(self.scheduler, self.REFRESH_JOB_ID)
+        if self._owns_scheduler and self.scheduler.running:
+            self.scheduler.shutdown()
         self.logger.info("WeatherClient arrêté.")
@@ -1,13 +1,19 @@
 import json
 import os
 import logging
-import time
+import signal
+import threading
 from api_client import ApiClient
+from clock import SYSTEM_CLOCK
 from mqtt_handler import MqttHandler
 from scheduler import Scheduler
 from weather_client import WeatherClient
 from automation_handler import AutomationHandler
 from off_peak_client import OffPeakClient
+from event_bus import COMMAND_SENT, EventBus
+from ha_websocket import HaWebSocket
+from metrics import MetricsServer
+from polling_policy import AdaptivePollingPolicy
 
 logging.VERBOSE = 5
 logging.addLevelName(logging.VERBOSE, "VERBOSE")
@@ -24,8 +30,9 @@ logging.Logger.verbose = verbose
 class YutampoAddon:
     VALID_LOG_LEVELS = ["VERBOSE", "DEBUG", "INFO", "WARNING", "ERROR"]
     VALID_REGULATION_MODES = ["gradual", "step"]
+    SCHEDULER_WORKERS = 2  # Polling et régulation peuvent attendre CSNet en parallèle
 
-    def __init__(self, config_path="/data/options.json"):
+    def __init__(self, config_path="/data/options.json", clock=None):
         logging.basicConfig(level=logging.INFO)
         self.logger = logging.getLogger("Yutampo_ha_addon")
         self.config = self._load_config(config_path)
@@ -38,22 +45,69 @@ class YutampoAddon:
         logging.getLogger().setLevel(getattr(logging, log_level))
         self.logger.info(f"Log level configuré à : {log_level}")
 
-        self.api_client = ApiClient(self.config)
-        self.mqtt_handler = MqttHandler(self.config, api_client=self.api_client)
-        self.scheduler = Scheduler(self.api_client, self.mqtt_handler)
+        # Horloge unique : système en production, virtuelle en simulation
+        self.clock = clock or SYSTEM_CLOCK
+        # Ordonnanceur unique : tous les jobs périodiques et différés des composants
+        self.job_scheduler = self.clock.create_scheduler(
+            max_workers=self.SCHEDULER_WORKERS
+        )
+        self._stop_event = threading.Event()
+        self.api_client = ApiClient(self.config, clock=self.clock)
+        self.mqtt_handler = MqttHandler(
+            self.config, api_client=self.api_client, clock=self.clock
+        )
+        self.api_client.mqtt_handler = self.mqtt_handler
+        self.polling_policy = AdaptivePollingPolicy(
+            base_interval=self.config["scan_interval"],
+            min_interval=self.config["poll_min_interval"],
+            max_interval=self.config["poll_max_interval"],
+            max_polls_per_hour=self.config["poll_budget_per_hour"],
+            clock=self.clock,
+        )
+        self.scheduler = Scheduler(
+            self.api_client,
+            self.mqtt_handler,
+            clock=self.clock,
+            scheduler=self.job_scheduler,
+            polling_policy=self.polling_policy,
+        )
+        # Commandes publiées en attente puis confirmées (ou annulées) par les polls
+        self.optimistic_state = self.mqtt_handler.optimistic_state
+        self.optimistic_state.request_poll = self.scheduler.request_poll
+        self.scheduler.optimistic_state = self.optimistic_state
         self.devices = []
-        self.weather_client = WeatherClient(self.config)
+        # Session WebSocket HA unique, partagée par la météo et le HC/HP
+        self.ha_ws = HaWebSocket(self.config)
+        self.weather_client = WeatherClient(
+            self.config,
+            ha_ws=self.ha_ws,
+            clock=self.clock,
+            scheduler=self.job_scheduler,
+        )
         self.weather_client.mqtt_handler = self.mqtt_handler
+        # Bus d'événements : les sources d'entrée déclenchent la réévaluation
+        self.event_bus = EventBus()
+        self.weather_client.event_bus = self.event_bus
+        self.api_client.event_bus = self.event_bus
+        self.event_bus.subscribe(COMMAND_SENT, self.scheduler.on_command_sent)
         self.automation_handler = None
 
         # Instanciation conditionnelle du client HC/HP
         off_peak_entity = self.config.get("off_peak_entity")
         if off_peak_entity:
-            self.off_peak_client = OffPeakClient(self.config)
+            self.off_peak_client = OffPeakClient(
+                self.config, ha_ws=self.ha_ws, clock=self.clock
+            )
             self.off_peak_client.mqtt_handler = self.mqtt_handler
+            self.off_peak_client.event_bus = self.event_bus
         else:
             self.off_peak_client = None
 
+        # Endpoint de métriques optionnel (format texte Prometheus)
+        # Port interne fixe (déclaré dans config.yaml) ; le port publié sur l'hôte
+        # se choisit dans l'onglet Réseau de l'addon
+        self.metrics_server = MetricsServer() if self.config.get("metrics") else None
+
     def _load_config(self, config_path):
         if not os.path.exists(config_path):
             self.logger.error("Fichier de configuration introuvable ! Arrêt.")
@@ -86,6 +140,18 @@ class YutampoAddon:
                 f"scan_interval ({scan_interval}) doit être >= 60s. Réglé à 60s."
             )
             scan_interval = 60
+        # Bornes et budget du polling adaptatif
+        poll_min_interval = config.get("poll_min_interval") or min(60, scan_interval)
+        if poll_min_interval < 30:
+            self.logger.warning(
+                f"poll_min_interval ({poll_min_interval}) doit être >= 30s. Réglé à 30s."
+            )
+            poll_min_interval = 30
+        poll_max_interval = max(config.get("poll_max_interval") or 1200, scan_interval)
+        # Par défaut : deux fois le rythme nominal (chauffe à scan_interval / 2)
+        poll_budget_per_hour = config.get("poll_budget_per_hour") or max(
+            4, int(2 * 3600 / scan_interval)
+        )
         discovery_prefix = config.get("discovery_prefix") or "homeassistant"
         weather_entity = config.get("weather_entity")
         default_hottest_hour = config.get("default_hottest_hour", 15.0)
@@ -110,6 +176,9 @@ class YutampoAddon:
             "username": config.get("username"),
             "password": config.get("password"),
             "scan_interval": scan_interval,
+            "poll_min_interval": poll_min_interval,
+            "poll_max_interval": poll_max_interval,
+            "poll_budget_per_hour": poll_budget_per_hour,
             "setpoint": setpoint,
             "regulation_amplitude": regulation_amplitude,
             "heating_duration_hours": heating_duration_hours,
@@ -126,12 +195,24 @@ class YutampoAddon:
             "off_peak_entity": off_peak_entity if off_peak_entity else None,
             "regulation_priority": regulation_priority,
             "eco_ratio": eco_ratio,
+            "session_store_path": config.get("session_store_path"),
+            "csnet_base_url": config.get("csnet_base_url"),
+            "ha_websocket_url": config.get("ha_websocket_url"),
+            "metrics": bool(config.get("metrics", False)),
         }
 
-    def start(self):
+    def start(self, block=True):
+        """Démarre l'addon ; avec block=False, rend la main une fois les
+        composants démarrés (harnais de simulation)."""
         self.logger.info("Démarrage de l'addon...")
+        if self.metrics_server:
+            try:
+                self.metrics_server.start()
+            except OSError as e:
+                self.logger.error(f"Impossible de démarrer l'endpoint de métriques : {str(e)}")
+                self.metrics_server = None
 
-        if not self.api_client.authenticate():
+        if not self.api_client.restore_session() and not self.api_client.authenticate():
             self.logger.error("Échec de l'authentification. Arrêt.")
             exit(1)
 
@@ -143,6 +224,7 @@ class YutampoAddon:
         self.devices = devices_data
 
         self.mqtt_handler.connect()
+        self.job_scheduler.start()
 
         for device in self.devices:
             device.register(self.mqtt_handler)
@@ -150,6 +232,7 @@ class YutampoAddon:
         self.scheduler.schedule_updates(self.devices, self.config["scan_interval"])
         self.mqtt_handler.register_numbers()
         self.mqtt_handler.register_sensors()
+        self.mqtt_handler.flush_discovery()
 
         if self.devices:
             # Initialisation de l'amplitude : priorité aux options, sinon valeur par défaut
@@ -180,13 +263,20 @@ class YutampoAddon:
                 off_peak_client=self.off_peak_client,
                 regulation_priority=self.config["regulation_priority"],
                 eco_ratio=self.config["eco_ratio"],
+                event_bus=self.event_bus,
+                clock=self.clock,
+                scheduler=self.job_scheduler,
+                optimistic_state=self.optimistic_state,
             )
             self.mqtt_handler.automation_handler = self.automation_handler
+            self.polling_policy.edge_source = self.automation_handler.seconds_to_next_edge
 
             # Démarrage des clients
             self.weather_client.start()
             if self.off_peak_client:
                 self.off_peak_client.start()
+            if self.config.get("weather_entity") or self.off_peak_client:
+                self.ha_ws.start()
             self.automation_handler.start()
 
             # Publier les états initiaux des capteurs
@@ -207,12 +297,20 @@ class YutampoAddon:
                     self.off_peak_client.is_off_peak()
                 )
 
+        if not block:
+            return
         self.logger.info("Addon démarré. Appuyez sur Ctrl+C pour arrêter.")
+        # Le superviseur HA arrête l'addon par SIGTERM
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
         try:
-            while True:
-                time.sleep(1)
+            self._stop_event.wait()
         except (KeyboardInterrupt, SystemExit):
-            self.shutdown()
+            pass
+        self.shutdown()
+
+    def stop(self):
+        """Débloque start() qui procède alors à l'arrêt."""
+        self._stop_event.set()
 
     def shutdown(self):
         self.logger.info("Arrêt de l'addon...")
@@ -221,11 +319,18 @@ class YutampoAddon:
             device.set_unavailable(self.mqtt_handler)
         self.scheduler.shutdown()
         if self.automation_handler:
-            self.automation_handler.scheduler.shutdown()
+            self.automation_handler.shutdown()
         if self.off_peak_client:
             self.off_peak_client.shutdown()
         self.weather_client.shutdown()
+        # Attend la fin des jobs en cours avant de fermer MQTT et le transport
+        if self.job_scheduler.running:
+            self.job_scheduler.shutdown()
+        self.ha_ws.shutdown()
         self.mqtt_handler.disconnect()
+        self.api_client.close()
+        if self.metrics_server:
+            self.metrics_server.stop()
         self.logger.info("Arrêt du programme.")
 
 